@@ -13,7 +13,7 @@ config.read('config.ini')
 
 with open('similarity_tsne.pck', 'rb') as fp:
     stsne = pickle.load(fp)
-    similarity_tsne = Similarity.factory(stsne)
+    similarity_tsne = Similarity.factory(stsne, lazy=True)
 
 #
 # Run the display program
@@ -12,6 +12,6 @@ config.read('config.ini')
 
 with open('similarity_tsne.pck', 'rb') as fp:
     similarity_tsne_dict = pickle.load(fp)
-    similarity_tsne = Similarity.factory(similarity_tsne_dict)
+    similarity_tsne = Similarity.factory(similarity_tsne_dict, lazy=True)
 
 sd = SimilarityDisplay(similarity_tsne)
@@ -1,8 +1,20 @@
 import os
+import pickle
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
 import numpy as np
 
 import imageio
 
+from transfer_learning.cache import ImageCache, image_cache, disk_cache
+from transfer_learning.cutout import Cutout, BoundingBox
+from transfer_learning.data import Data, DataCollection
+from transfer_learning.misc.image_processing import FlipLR
+
 def load_jpg(filename):
     return np.array(imageio.imread(filename))
 
@@ -11,3 +23,139 @@ def test_load_data():
     data = load_jpg('{}/data/j8za09050_drz_small.jpg'.format(SCRIPTLOC))
     cmp = np.array([[255, 252, 246, 255], [255, 241, 255, 241], [255, 255, 246, 13], [248, 255, 255, 0]])
     assert np.allclose(data[10:14, 10:14], cmp, atol=1)
+
+
+def test_meta_table():
+
+    datas = [Data(meta={'exposure': str(ii), 'instrument': 'ACS'}) for ii in range(5)]
+    collection = DataCollection(datas)
+    datas[2].meta = {'exposure': 'long', 'filter': 'F814W'}
+
+    table = collection.meta_table
+    rows = table.rows([d.uuid for d in datas])
+
+    assert np.allclose(table.numbers('exposure', rows), [0, 1, np.nan, 3, 4], equal_nan=True)
+    assert list(table.values('instrument', rows)) == ['ACS', 'ACS', None, 'ACS', 'ACS']
+    assert list(table.values('filter', rows)) == [None, None, 'F814W', None, None]
+
+    # Changing the meta in place updates the table
+    datas[0].meta['instrument'] = 'WFC3'
+    datas[1].meta.update(filter='F606W')
+    assert list(table.values('instrument', rows)) == ['WFC3', 'ACS', None, 'ACS', 'ACS']
+    assert list(table.values('filter', rows)) == [None, 'F606W', 'F814W', None, None]
+
+    # Unpickled data (e.g., in a celery worker) is added to the table
+    data = Data(meta={'instrument': 'NIRCam'})
+    data._uuid = 'pickled-in-another-process'
+    unpickled = pickle.loads(pickle.dumps(data))
+    assert list(table.values('instrument', table.rows([unpickled.uuid]))) == ['NIRCam']
+    unpickled.meta['instrument'] = 'MIRI'
+    assert list(table.values('instrument', table.rows([unpickled.uuid]))) == ['MIRI']
+
+
+def test_image_cache():
+
+    cache = ImageCache(max_bytes=3 * 800)
+    for ii in range(4):
+        cache.get(ii, lambda: np.zeros(100))
+    cache.get(1, lambda: None)
+
+    assert cache.stats['hits'] == 1 and cache.stats['misses'] == 4 and cache.stats['evictions'] == 1
+    assert 0 not in cache and cache.nbytes == 3 * 800
+
+    # One decode of the image shared by its cutouts
+    SCRIPTLOC = os.path.dirname(__file__)
+    data = Data(location='{}/data/j8za09050_drz_small.jpg'.format(SCRIPTLOC))
+    cutouts = [Cutout(data=data, bounding_box=BoundingBox(ii, ii + 20, 0, 20)) for ii in range(3)]
+
+    misses = image_cache.misses
+    assert all(c.get_data().shape[:2] == (20, 20) for c in cutouts)
+    assert image_cache.misses - misses == 1
+    assert not data.get_data().flags.writeable
+
+    # Unprocessed cutouts are views, processed ones are cached compactly
+    assert np.shares_memory(cutouts[1].get_data(), data.get_data())
+    assert np.array_equal(cutouts[1].get_data(), data.get_data()[1:21, 0:20])
+
+    flipped = cutouts[1].duplicate_with_processing([FlipLR()])
+    assert flipped.get_data().dtype == np.uint8
+    assert flipped.get_data() is flipped.get_data()
+    assert np.array_equal(flipped.get_data(), np.fliplr(cutouts[1].get_data()))
+
+    # Processing the data again is not hidden by the cached processed cutout
+    before = flipped.get_data()
+    data.add_processing(FlipLR())
+    assert np.array_equal(flipped.get_data(), np.fliplr(data.get_data()[1:21, 0:20]))
+    assert not np.array_equal(flipped.get_data(), before)
+
+
+def test_image_cache_threads(monkeypatch):
+
+    SCRIPTLOC = os.path.dirname(__file__)
+    datas = [Data(location='{}/data/j8za09050_drz_small.jpg'.format(SCRIPTLOC)) for _ in range(3)]
+
+    # Count the loads, slowed down so the threads all miss the cache at once
+    loads = []
+    load = Data._load
+
+    def counted_load(self):
+        loads.append(self.uuid)
+        time.sleep(0.05)
+        return load(self)
+
+    monkeypatch.setattr(Data, '_load', counted_load)
+
+    barrier = threading.Barrier(12)
+
+    def get_data(data):
+        barrier.wait()
+        return data.get_data()
+
+    with ThreadPoolExecutor(max_workers=12) as executor:
+        arrays = list(executor.map(get_data, datas * 4))
+
+    assert sorted(loads) == sorted(data.uuid for data in datas)
+    assert all(array is arrays[ii % 3] for ii, array in enumerate(arrays))
+
+
+def test_disk_cache(tmpdir):
+
+    SCRIPTLOC = os.path.dirname(__file__)
+    location = '{}/data/j8za09050_drz_small.jpg'.format(SCRIPTLOC)
+
+    disk_cache.directory = str(tmpdir)
+    try:
+        hits, misses = disk_cache.hits, disk_cache.misses
+        first = Data(location=location).get_data()
+        second = Data(location=location).get_data()
+        flipped = Data(location=location, processing=[FlipLR()]).get_data()
+
+        assert (disk_cache.hits - hits, disk_cache.misses - misses) == (1, 2)
+        assert isinstance(second, np.memmap)
+        assert np.array_equal(first, second)
+        assert np.array_equal(flipped, first[:, ::-1])
+    finally:
+        disk_cache.directory = None
+
+
+def test_prefetch():
+
+    SCRIPTLOC = os.path.dirname(__file__)
+    handler = partial(SimpleHTTPRequestHandler, directory='{}/data'.format(SCRIPTLOC))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        url = 'http://127.0.0.1:{}/{{}}'.format(server.server_address[1])
+        datas = [Data(location=url.format('j8za09050_drz_small.jpg?{}'.format(ii))) for ii in range(4)]
+        datas.append(Data(location=url.format('missing.jpg')))
+
+        assert DataCollection(datas).prefetch(workers=3) == 4
+        assert all(data.uuid in image_cache for data in datas[:4])
+        assert datas[4].uuid not in image_cache
+
+        local = load_jpg('{}/data/j8za09050_drz_small.jpg'.format(SCRIPTLOC))
+        assert np.array_equal(datas[0].get_data()[:, :, 0], local)
+    finally:
+        server.shutdown()
+        server.server_close()
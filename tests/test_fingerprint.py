@@ -1,9 +1,24 @@
 import os
 import numpy as np
 
+import json
+import asyncio
+import time
+import pytest
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import imageio
 
-from transfer_learning.fingerprint.processing import FingerprintCalculatorResnet
+from transfer_learning.cutout import Cutout, CutoutCollection, BoundingBox
+from transfer_learning.data import Data, DataCollection
+from transfer_learning.fingerprint import Fingerprint, FingerprintCollection, FingerprintMatrix
+from transfer_learning.fingerprint import save_fingerprints, load_fingerprints
+from transfer_learning.fingerprint.fingerprint import FingerprintFilter
+from transfer_learning.fingerprint.processing import FingerprintCalculator, FingerprintCalculatorResnet, _fingerprint_batch
+from transfer_learning.fingerprint.processing import _prefetch_batches
+from transfer_learning.cutout.generators import BasicCutoutGenerator
+from transfer_learning.pipeline import Pipeline
+from transfer_learning.similarity.filter import FingerprintTable
 
 def load_jpg(filename):
     return np.array(imageio.imread(filename))
@@ -23,3 +38,344 @@ def test_calculate_fingerprint():
 
     assert predictions[2][:2] == ('n03857828', 'oscilloscope')
     assert np.allclose(predictions[2][2], 0.051630393, atol=0.1)
+
+
+def test_fingerprint_matrix():
+
+    predictions = [
+        [('n1', 'doormat', 0.5), ('n2', 'window_screen', 0.3)],
+        [('n2', 'window_screen', 0.6), ('n3', 'oscilloscope', 0.1)],
+        [('n3', 'oscilloscope', 0.9)],
+    ]
+    fingerprints = [Fingerprint(cutout_uuid=str(ii), predictions=p) for ii, p in enumerate(predictions)]
+
+    fm = FingerprintMatrix(fingerprints)
+
+    assert fm.labels == ['doormat', 'window_screen', 'oscilloscope']
+    assert np.allclose(fm.matrix, [[0.5, 0.3, 0.0], [0.0, 0.6, 0.1], [0.0, 0.0, 0.9]])
+
+    fm_sparse = FingerprintMatrix(fingerprints, sparse=True)
+    assert np.allclose(fm_sparse.matrix.toarray(), fm.matrix)
+
+    # A label predicted twice, e.g., by another predictor
+    duplicate = Fingerprint(cutout_uuid='3', predictions=[('n1', 'doormat', 0.7), ('x1', 'doormat', 0.2)])
+    assert np.allclose(FingerprintMatrix([duplicate]).matrix, [[0.2]])
+    assert np.allclose(FingerprintMatrix([duplicate], duplicates='first').matrix, [[0.7]])
+    assert np.allclose(FingerprintTable([duplicate]).prediction_column('doormat'), [0.7])
+
+
+def test_fingerprint_prediction_store():
+
+    predictions = [('n1', 'cat', 0.25), ('n2', 'dog', 0.5), ('n3', 'crane', 0.125)]
+    fp = Fingerprint(cutout_uuid='a', predictions=predictions)
+
+    assert fp.predictions == tuple(sorted(predictions, key=lambda x: x[2], reverse=True))
+
+    ids, scores = fp.prediction_arrays
+    assert ids.dtype == np.int16 and scores.dtype == np.float32
+    assert np.allclose(scores, [0.5, 0.25, 0.125])
+
+    fp.add_other_predictor('other', [('o1', 'blob', 0.3)])
+    assert [p[1] for p in fp.predictions] == ['dog', 'blob', 'cat', 'crane']
+
+    # Reloading reuses the slice rather than growing the store
+    store = FingerprintCollection._predictions
+    fp = Fingerprint(cutout=Cutout(data=Data(meta={}), bounding_box=BoundingBox(0, 10, 0, 10)), predictions=predictions)
+    size = len(store)
+    fp.load(fp.save())
+    assert len(store) == size
+    assert fp.predictions == tuple(sorted(predictions, key=lambda x: x[2], reverse=True))
+
+    # New labels added from several threads at once
+    def add(thread):
+        return [Fingerprint(cutout_uuid='t', predictions=[('t', 'thread{}_{}'.format(thread, ii), 0.5)])
+                for ii in range(200)]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        added = list(executor.map(add, range(4)))
+    for thread, fingerprints in enumerate(added):
+        assert [fp.predictions[0][1] for fp in fingerprints] == ['thread{}_{}'.format(thread, ii) for ii in range(200)]
+
+
+def test_fingerprint_filter():
+
+    datas = [Data(meta={'instrument': 'ACS', 'target': 'NGC 1'}), Data(meta={'instrument': 'WFC3', 'target': 'M 31'})]
+    fingerprints = [Fingerprint(cutout=Cutout(data=data, bounding_box=BoundingBox(0, 10, 0, 10)),
+                                predictions=[('n1', 'cat', 0.5)]) for data in datas]
+
+    assert FingerprintFilter(inclusion_patterns=['NGC']).filter(fingerprints) == {fingerprints[0]}
+    assert FingerprintFilter(inclusion_patterns=[{'instrument': 'WFC'}, {'target': 'NGC 1'}]).filter(fingerprints) == \
+        set(fingerprints)
+    assert FingerprintFilter(inclusion_patterns=[{'exposure': '1'}]).filter(fingerprints) == set()
+
+    # Uses the meta as changed since
+    datas[1].meta['target'] = 'NGC 2'
+    assert FingerprintFilter(inclusion_patterns=['NGC'], exclusion_patterns=[{'instrument': 'ACS'}]).filter(
+        fingerprints) == {fingerprints[1]}
+
+
+def test_save_load_fingerprints(tmpdir):
+
+    fp = Fingerprint(cutout=Cutout(data=Data(meta={}), bounding_box=BoundingBox(0, 10, 0, 10)),
+                     predictions=[('n1', 'cat', 0.5)])
+    fp.add_other_predictor('other', [('o1', 'blob', 0.3)])
+    saved = fp.save()
+
+    save_fingerprints([fp], str(tmpdir))
+    FingerprintCollection._collection.pop(fp.uuid)
+    loaded, = load_fingerprints(str(tmpdir))
+
+    # The other predictions are not also saved as the fingerprint's own
+    assert loaded is not fp
+    assert loaded.save()['predictions'] == saved['predictions']
+    assert [tuple(p) for p in loaded.predictions] == [tuple(p) for p in fp.predictions]
+
+
+def test_fingerprint_collection_normalized():
+
+    data = Data(meta={'instrument': 'ACS'})
+    cutouts = [Cutout(data=data, bounding_box=BoundingBox(ii, ii + 10, 0, 10)) for ii in range(2)]
+    fingerprints = [Fingerprint(cutout=cutouts[ii % 2], predictions=[('n1', 'cat', 0.1 * ii)]) for ii in range(4)]
+    collection = FingerprintCollection(fingerprints)
+
+    saved = collection.save()
+    normalized = collection.save(normalized=True)
+
+    assert [x['uuid'] for x in normalized['datas']] == [data.uuid]
+    assert [x['uuid'] for x in normalized['cutouts']] == [c.uuid for c in cutouts]
+    assert [x['cutout'] for x in normalized['fingerprint_collection']] == [c.uuid for c in cutouts] * 2
+    assert len(json.dumps(normalized)) < len(json.dumps(saved))
+
+    # Reload from scratch
+    for fp in fingerprints:
+        FingerprintCollection._collection.pop(fp.uuid)
+    for cutout in cutouts:
+        CutoutCollection._collection.pop(cutout.uuid)
+    DataCollection._collection.pop(data.uuid)
+
+    loaded = FingerprintCollection()
+    loaded.load(json.loads(json.dumps(normalized)))
+
+    assert json.dumps(loaded.save()) == json.dumps(saved)
+
+
+class MeanCalculator(FingerprintCalculator):
+    """
+    Predicts the mean of each image, so the pipeline can run without a network.
+    """
+
+    def calculate_batch(self, arrays, batch_size=32, return_embeddings=False):
+        return [[('n0', 'mean', float(np.mean(data)))] for data in arrays]
+
+
+def test_pipeline():
+
+    SCRIPTLOC = os.path.dirname(__file__)
+    location = '{}/data/j8za09050_drz_small.jpg'.format(SCRIPTLOC)
+    datas = [Data(location=location) for _ in range(3)] + [Data(location='missing.jpg')]
+
+    pipeline = Pipeline(BasicCutoutGenerator(output_size=64, step_size=64), MeanCalculator(),
+                        batch_size=4, fetch_workers=2, queue_size=1)
+    fingerprints = pipeline.calculate(datas)
+
+    assert len(fingerprints) == 27
+    assert sorted(set(fp.cutout.data.uuid for fp in fingerprints)) == sorted(d.uuid for d in datas[:3])
+    for fp in fingerprints:
+        assert np.isclose(fp.predictions[0][2], np.mean(fp.cutout.get_data()))
+
+
+class FailingPipeline(Pipeline):
+    """
+    Pipeline whose fetch stage fails before any data is fetched.
+    """
+
+    async def _fetch(self, datas, data_queue, executor):
+        raise RuntimeError('Fetch failed')
+
+
+def test_pipeline_errors():
+
+    pipeline = FailingPipeline(BasicCutoutGenerator(output_size=64, step_size=64), MeanCalculator())
+
+    # The error of a stage ends the stream rather than it waiting for more batches
+    with pytest.raises(RuntimeError, match='Fetch failed'):
+        asyncio.run(asyncio.wait_for(pipeline.run([Data(location='missing.jpg')]), timeout=10))
+
+    async def calculate_in_loop():
+        return pipeline.calculate([])
+
+    with pytest.raises(RuntimeError, match='running event loop'):
+        asyncio.run(calculate_in_loop())
+
+
+class StubModel(object):
+    """
+    Predicts the mean of each image and records the shape of each batch.
+    """
+
+    def __init__(self):
+        self.batches = []
+
+    def predict(self, x, batch_size=None):
+        if np.any(x < 0):
+            raise ValueError('Negative input')
+        self.batches.append(x.shape)
+        return x.reshape(x.shape[0], -1).mean(axis=1, keepdims=True)
+
+
+class StubEmbeddingModel(object):
+    """
+    Outputs the per channel mean of each image as its embedding, and the predictions of the model.
+    """
+
+    output_shape = [(None, 3), (None, 1)]
+
+    def __init__(self, model):
+        self._model = model
+
+    def predict(self, x, batch_size=None):
+        return x.mean(axis=(1, 2)), self._model.predict(x, batch_size)
+
+
+class StubCalculator(FingerprintCalculator):
+    """
+    Calculator with the keras model and functions replaced by StubModel, so
+    calculate_batch runs without a network.
+    """
+
+    def __init__(self, max_fingerprints=5, embedding=False):
+        super(StubCalculator, self).__init__(embedding=embedding)
+        self._model = StubModel()
+        self._max_fingerprints = max_fingerprints
+
+    def _keras_functions(self):
+        return (lambda x: x), (lambda preds, top: [[('n0', 'mean', float(p[0]))] for p in preds])
+
+    def _get_embedding_model(self):
+        return StubEmbeddingModel(self._model)
+
+    def save(self):
+        return {
+            'class_name': self.__class__.__name__,
+            'uuid': self._uuid,
+            'max_fingerprints': self._max_fingerprints,
+            'embedding': self._embedding
+        }
+
+
+def test_calculate_batch():
+
+    fc = StubCalculator()
+    arrays = [np.full((4, 4, 3), 1.0), np.full((4, 4, 3), 2.0), np.full((4, 4, 3), 3.0),
+              np.zeros((4, 4, 3)), np.full((2, 2, 3), 5.0), np.full((4, 4), 6.0)]
+
+    predictions = fc.calculate_batch(arrays, batch_size=2)
+
+    # Split on batch_size and on shape changes, all-zero images are not sent to the model
+    assert fc._model.batches == [(2, 4, 4, 3), (1, 4, 4, 3), (1, 2, 2, 3), (1, 4, 4, 3)]
+    assert [p[0][1] for p in predictions] == ['mean', 'mean', 'mean', 'beaver', 'mean', 'mean']
+    assert [p[0][2] for p in predictions if p[0][1] == 'mean'] == [1.0, 2.0, 3.0, 5.0, 6.0]
+
+    # A failing batch falls back to one image at a time
+    arrays = [np.full((4, 4, 3), 1.0), np.full((4, 4, 3), -1.0), np.full((4, 4, 3), 3.0)]
+    fingerprints = _fingerprint_batch(fc, [None] * 3, arrays, batch_size=3)
+    assert [fp.predictions for fp in fingerprints] == [(('n0', 'mean', 1.0),), (), (('n0', 'mean', 3.0),)]
+
+    # With embeddings the cutouts that succeed keep theirs and the failing one is skipped
+    fc = StubCalculator(embedding=True)
+    cutouts = [Cutout(data=Data(meta={}), bounding_box=BoundingBox(0, 4, 0, 4)) for _ in range(3)]
+    fingerprints = _fingerprint_batch(fc, cutouts, arrays, batch_size=3)
+    assert [fp.cutout for fp in fingerprints] == [cutouts[0], cutouts[2]]
+    assert np.allclose(FingerprintMatrix(fingerprints, feature='embedding').matrix, [[1.0] * 3, [3.0] * 3])
+
+
+class StubCutout(object):
+    """
+    Cutout whose get_data records that it has started.
+    """
+
+    started = []
+    lock = threading.Lock()
+
+    def __init__(self, index):
+        self.index = index
+
+    def get_data(self):
+        with StubCutout.lock:
+            StubCutout.started.append(self.index)
+        time.sleep(0.001 * (self.index % 3))
+        return np.full((2, 2), self.index)
+
+
+def test_prefetch_batches():
+
+    batch_size, prefetch = 4, 2
+    cutouts = [StubCutout(ii) for ii in range(30)]
+    StubCutout.started = []
+
+    batches = []
+    for start, batch, nparrays in _prefetch_batches(cutouts, batch_size, prefetch, workers=3):
+
+        # At most prefetch batches after this one have been started
+        with StubCutout.lock:
+            assert max(StubCutout.started) < start + (prefetch + 1) * batch_size
+
+        batches.append(start)
+        assert [c.index for c in batch] == list(range(start, min(start + batch_size, 30)))
+        assert [a[0, 0] for a in nparrays] == [c.index for c in batch]
+        time.sleep(0.01)
+
+    assert batches == list(range(0, 30, batch_size))
+
+
+class SlowCalculator(FingerprintCalculator):
+    """
+    Calculator whose network takes until release is set to build.
+    """
+
+    release = threading.Event()
+
+    def __init__(self, max_fingerprints=5, embedding=False):
+        super(SlowCalculator, self).__init__(embedding=embedding)
+        SlowCalculator.release.wait(timeout=10)
+
+
+def test_shared_calculator():
+
+    try:
+        shared = FingerprintCalculator.shared('StubCalculator', 3)
+        assert FingerprintCalculator.shared('StubCalculator', 3) is shared
+        assert FingerprintCalculator.shared('StubCalculator', 4) is not shared
+        assert FingerprintCalculator.shared('StubCalculator', 3, embedding=True) is not shared
+
+        # The default max_fingerprints of the class is used if not given
+        FingerprintCalculator.warm_up(['StubCalculator'])
+        assert ('StubCalculator', 5, False) in FingerprintCalculator._registry
+
+        # Older save() dicts without max_fingerprints or embedding
+        fc = FingerprintCalculator.load_parameters({'class_name': 'StubCalculator', 'uuid': None})
+        assert fc is FingerprintCalculator._registry[('StubCalculator', 5, False)]
+
+        # An existing instance is found by uuid
+        assert FingerprintCalculator.load_parameters(shared.save()) is shared
+
+        # Otherwise the saved parameters are loaded on a copy sharing the network
+        saved = dict(StubCalculator(max_fingerprints=3).save(), uuid='saved-calculator')
+        fc = FingerprintCalculator.load_parameters(saved)
+        assert fc.save() == saved and fc._model is shared._model
+        assert FingerprintCalculator.load_parameters(saved) is fc
+
+        with pytest.raises(ValueError):
+            FingerprintCalculator.shared('NoSuchCalculator')
+
+        # Building one calculator does not hold up the others, nor build it twice
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            slow = [executor.submit(FingerprintCalculator.shared, 'SlowCalculator') for _ in range(2)]
+            assert FingerprintCalculator.shared('StubCalculator', 6) is not None
+            assert not any(future.done() for future in slow)
+            SlowCalculator.release.set()
+            assert slow[0].result() is slow[1].result()
+    finally:
+        SlowCalculator.release.set()
+        for key in [k for k in FingerprintCalculator._registry if k[0] in ('StubCalculator', 'SlowCalculator')]:
+            del FingerprintCalculator._registry[key]
@@ -1,15 +1,17 @@
 import os
 import json
 import numpy as np
+import pytest
 
 from transfer_learning.data import Data, DataCollection
-from transfer_learning.cutout import CutoutCollection
-from transfer_learning.fingerprint import FingerprintCollection
+from transfer_learning.cutout import Cutout, CutoutCollection, BoundingBox, BoundingBoxIndex
+from transfer_learning.fingerprint import Fingerprint, FingerprintCollection
 from transfer_learning.fingerprint.processing import calculate as fingerprint_calculate
 from transfer_learning.fingerprint.processing import FingerprintCalculatorResnet
-from transfer_learning.similarity import Similarity
+from transfer_learning.similarity import Similarity, save_similarity, load_similarity
 from transfer_learning.similarity import calculate as similarity_calculate
 from transfer_learning.cutout.generators import BasicCutoutGenerator
+from transfer_learning.similarity.neighbors import AdjacencyIndex
 
 
 def test_carina():
@@ -96,3 +98,256 @@ def test_end2end():
     new_similarity_tsne = Similarity.factory(similarity_tsne.save())
 
     assert json.dumps(new_similarity_tsne.save(), sort_keys=True) == json.dumps(similarity_tsne.save(), sort_keys=True)
+
+
+def _fingerprints(n=50, n_labels=30, seed=0):
+    """
+    Fingerprints with random predictions (no cutouts) for the similarity tests.
+    """
+    rs = np.random.RandomState(seed)
+    fingerprints = []
+    for ii in range(n):
+        labels = rs.choice(n_labels, 10, replace=False)
+        scores = np.sort(rs.rand(10))[::-1]
+        fingerprints.append(Fingerprint(cutout_uuid=str(ii),
+                                        predictions=[('n{}'.format(l), 'label{}'.format(l), float(s))
+                                                     for l, s in zip(labels, scores)]))
+    return fingerprints
+
+
+def test_jaccard_top_k():
+
+    fingerprints = _fingerprints()
+
+    dense = similarity_calculate(fingerprints, 'jaccard')
+    sparse = similarity_calculate(fingerprints, 'jaccard', top_k=5, block_size=7)
+
+    assert sparse.data.shape == dense.data.shape
+    assert np.all(sparse.data.getnnz(axis=1) <= 5)
+
+    # The kept similarities are the largest in each row of the dense version
+    for row in range(len(fingerprints)):
+        kept = np.sort(sparse.data[row].data)[::-1]
+        assert np.allclose(kept, np.sort(dense.data[row])[::-1][:len(kept)])
+
+
+def test_distance_blocked(tmpdir):
+
+    fingerprints = _fingerprints()
+
+    full = similarity_calculate(fingerprints, 'distance')
+    blocked = similarity_calculate(fingerprints, 'distance', block_size=7, n_jobs=2)
+    mapped = similarity_calculate(fingerprints, 'distance', block_size=7, filename=str(tmpdir.join('d.npy')))
+    nearest = similarity_calculate(fingerprints, 'distance', block_size=7, top_k=5)
+
+    assert np.allclose(blocked.data, full.data)
+    assert np.allclose(mapped.data, full.data, atol=1e-5)
+    assert np.all(nearest.data.getnnz(axis=1) == 5)
+    assert np.allclose(nearest.data.max(axis=1).toarray().ravel(), np.sort(full.data, axis=1)[:, 4])
+
+    # Non-neighbours are missing, not a distance of 0
+    dense = nearest.data_filtered
+    assert np.all(np.isnan(dense).sum(axis=1) == len(fingerprints) - 5)
+    assert np.allclose(dense[~np.isnan(dense)], nearest.data.toarray()[~np.isnan(dense)])
+
+
+def test_find_similar_index():
+
+    fingerprints = _fingerprints()
+
+    for neighbor_index in ['auto', 'balltree', 'brute', 'adjacency']:
+        distance = similarity_calculate(fingerprints, 'distance', neighbor_index=neighbor_index)
+        if neighbor_index == 'auto':
+            assert isinstance(distance._neighbor_index, AdjacencyIndex)
+        distance._set_filter_inds(range(0, len(fingerprints), 2))
+
+        similar = distance.find_similar((3, 0), n=5)
+
+        # Same as sorting the filtered adjacency row
+        row = distance.data[6]
+        expected = [ind for ind in np.argsort(row) if ind % 2 == 0][:5]
+        assert [fingerprints.index(s['fingerprint']) for s in similar] == expected
+        assert np.allclose([s['distance'] for s in similar], row[expected])
+
+
+def test_non_overlapping_bounding_boxes():
+
+    fingerprints = _fingerprints()
+    datas = [Data(meta={}), Data(meta={})]
+    rng = np.random.RandomState(1)
+    for ii, fp in enumerate(fingerprints):
+        left, bottom = rng.randint(0, 40, size=2)
+        fp._cutout = Cutout(data=datas[ii % 2], bounding_box=BoundingBox(left, left + 10, bottom, bottom + 10))
+
+    # Same as BoundingBox.overlap for cutouts of the same Data, never for another Data
+    index = BoundingBoxIndex([fp.cutout for fp in fingerprints])
+    for ii, fp in enumerate(fingerprints):
+        for jj, other in enumerate(fingerprints):
+            expected = fp.cutout.data is other.cutout.data and fp.cutout.bounding_box.overlap(other.cutout.bounding_box)
+            assert index.overlaps(ii, [jj]) == expected
+
+    distance = similarity_calculate(fingerprints, 'distance')
+    similar = distance.find_similar((3, 0), n=10, allow_overlapping_bounding_boxes=False)
+
+    # Same as keeping, nearest first, each fingerprint that overlaps none kept so far
+    expected = []
+    for ind in np.argsort(distance.data[3], kind='stable'):
+        cutout = fingerprints[ind].cutout
+        if not any(cutout.data is fingerprints[jj].cutout.data and
+                   cutout.bounding_box.overlap(fingerprints[jj].cutout.bounding_box) for jj in expected):
+            expected.append(ind)
+    assert [fingerprints.index(s['fingerprint']) for s in similar] == expected[:10]
+
+
+def test_filter_fingerprints():
+
+    fingerprints = _fingerprints()
+    for ii, fp in enumerate(fingerprints):
+        data = Data(meta={'instrument': 'WFC3' if ii % 2 else 'ACS', 'exposure': ii, 'target': 'NGC {}'.format(ii)})
+        fp._cutout = Cutout(data=data, bounding_box=BoundingBox(0, 10, 0, 10))
+
+    distance = similarity_calculate(fingerprints, 'distance')
+
+    def expected(test):
+        return [ii for ii, fp in enumerate(fingerprints) if test(fp.cutout.data.meta, dict((p[1], p[2]) for p in fp.predictions))]
+
+    filters = [
+        ("instrument == 'WFC3'", lambda m, p: m['instrument'] == 'WFC3'),
+        ("exposure >= 10 and exposure < 20", lambda m, p: 10 <= m['exposure'] < 20),
+        ("'NGC 1' in target or πlabel3 > 0.5", lambda m, p: 'NGC 1' in m['target'] or p.get('label3', 0) > 0.5),
+    ]
+    for thefilter, test in filters:
+        assert distance.set_filter_fingerprints(thefilter) == len(expected(test))
+        assert list(distance._fingerprint_filter_inds) == expected(test)
+
+    assert distance.set_filter_fingerprints('') == len(fingerprints)
+
+    # Without a filter the adjacency itself is used, not a copy
+    assert distance.data_filtered is distance.data
+
+
+def test_save_load_binary(tmpdir):
+
+    fingerprints = _fingerprints()
+    data = Data(meta={'instrument': 'ACS'})
+    for ii, fp in enumerate(fingerprints):
+        fp._cutout = Cutout(data=data, bounding_box=BoundingBox(ii, ii + 10, 0, 10))
+
+    for similarity_type, kwargs in [('jaccard', {'top_k': 5}), ('distance', {})]:
+        similarity = similarity_calculate(fingerprints, similarity_type, **kwargs)
+        path = str(tmpdir.join(similarity_type))
+        save_similarity(similarity, path)
+        loaded = load_similarity(path)
+
+        assert loaded.uuid == similarity.uuid
+        assert loaded.save()['parameters'] == similarity.save()['parameters']
+        assert json.dumps(loaded.save()['fingerprint']) == json.dumps(similarity.save()['fingerprint'])
+        if similarity_type == 'jaccard':
+            assert (loaded.data != similarity.data).nnz == 0
+        else:
+            assert np.array_equal(loaded.data, similarity.data)
+
+
+def test_load_lazy():
+
+    fingerprints = _fingerprints()
+    data = Data(meta={'instrument': 'ACS'})
+    for ii, fp in enumerate(fingerprints):
+        fp._cutout = Cutout(data=data, bounding_box=BoundingBox(ii, ii + 10, 0, 10))
+
+    saved = {}
+    for similarity_type, kwargs in [('jaccard', {}), ('distance', {}), ('distance', {'top_k': 10})]:
+        similarity = similarity_calculate(fingerprints, similarity_type, **kwargs)
+        thedict = json.loads(json.dumps(similarity.save(normalized=True)))
+        saved[similarity_type, 'top_k' in kwargs] = thedict, [
+            [(fingerprints.index(s['fingerprint']), s['distance'])
+             for s in similarity.find_similar((3, 0), n=5, allow_overlapping_bounding_boxes=allow)]
+            for allow in [True, False]]
+
+    # Load as if in a new process
+    for fp in fingerprints:
+        FingerprintCollection._collection.pop(fp.uuid)
+        CutoutCollection._collection.pop(fp.cutout.uuid)
+    DataCollection._collection.pop(data.uuid)
+
+    for thedict, expected in saved.values():
+        loaded = Similarity.factory(thedict, lazy=True)
+        assert loaded._fingerprints.n_loaded == 0
+
+        # Only the fingerprints returned are loaded, also when skipping overlapping ones
+        for allow, expected_similar in zip([True, False], expected):
+            similar = loaded.find_similar((3, 0), n=5, allow_overlapping_bounding_boxes=allow)
+            assert [(s['fingerprint'].uuid, s['distance']) for s in similar] == \
+                [(fingerprints[ii].uuid, d) for ii, d in expected_similar]
+        assert loaded._fingerprints.n_loaded == len(set(ii for similar in expected for ii, _ in similar))
+        assert similar[0]['fingerprint'].cutout.data.meta == {'instrument': 'ACS'}
+
+        for fp in fingerprints:
+            FingerprintCollection._collection.pop(fp.uuid, None)
+            CutoutCollection._collection.pop(fp.cutout.uuid, None)
+        DataCollection._collection.pop(data.uuid, None)
+
+
+def test_tsne_add_fingerprints():
+
+    fingerprints = _fingerprints()
+
+    tsne = similarity_calculate(fingerprints[:40], 'tsne')
+    Y = tsne.data.copy()
+
+    # A copy of an existing fingerprint lands on it when only the nearest counts
+    copy = Fingerprint(cutout_uuid='copy', predictions=fingerprints[3].predictions)
+    tsne.add_fingerprints(fingerprints[40:] + [copy], perplexity=1)
+
+    assert tsne.data.shape == (51, 2)
+    assert len(tsne._fingerprints) == 51
+    assert np.array_equal(tsne.data[:40], Y)
+    assert np.allclose(tsne.data[50], Y[3])
+
+
+def test_tsne_embedding_options():
+
+    fingerprints = _fingerprints()
+
+    tsne = similarity_calculate(fingerprints, 'tsne', reduce_components=5, perplexity=10,
+                                n_jobs=2, random_state=0)
+    again = similarity_calculate(fingerprints, 'tsne', reduce_components=5, perplexity=10,
+                                 n_jobs=2, random_state=0)
+
+    assert tsne.data.shape == (50, 2)
+    assert np.allclose(tsne.data, again.data)
+
+    assert tsne._save_parameters()['embedding'] == dict(tsne._embedding_defaults, reduce_components=5,
+                                                        perplexity=10, n_jobs=2, random_state=0)
+
+
+def test_embedding_feature():
+
+    rs = np.random.RandomState(1)
+    data = Data(meta={})
+    embeddings = rs.rand(40, 16).astype(np.float32)
+    fingerprints = [Fingerprint(cutout=Cutout(data=data, bounding_box=BoundingBox(ii, ii + 10, 0, 10)),
+                                predictions=[('n1', 'cat', 0.5)], embedding=embedding)
+                    for ii, embedding in enumerate(embeddings)]
+
+    # The embedding is saved and loaded with the fingerprint
+    thedict = json.loads(json.dumps(fingerprints[0].save()))
+    FingerprintCollection._collection.pop(fingerprints[0].uuid)
+    loaded = Fingerprint.factory(thedict)
+    assert loaded is not fingerprints[0]
+    assert loaded.embedding.dtype == np.float32 and np.array_equal(loaded.embedding, embeddings[0])
+
+    distance = similarity_calculate(fingerprints, 'distance', feature='embedding')
+    expected = np.sqrt(((embeddings[:, None, :] - embeddings[None, :, :])**2).sum(axis=2))
+    assert np.allclose(distance.data, expected, atol=1e-5)
+    assert distance.save()['parameters']['feature'] == 'embedding'
+
+    tsne = similarity_calculate(fingerprints, 'tsne', feature='embedding', perplexity=10, random_state=0)
+    assert tsne.data.shape == (40, 2)
+    assert tsne.save()['parameters']['feature'] == 'embedding'
+
+    # Every fingerprint needs an embedding
+    missing = fingerprints + [Fingerprint(cutout_uuid='none', predictions=[('n1', 'cat', 0.5)])]
+    for similarity_type in ['distance', 'tsne']:
+        with pytest.raises(ValueError):
+            similarity_calculate(missing, similarity_type, feature='embedding')
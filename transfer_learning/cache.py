@@ -0,0 +1,295 @@
+import os
+import json
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+from .tl_logging import get_logger
+log = get_logger('cache')
+
+
+class ImageCache(object):
+    """
+    Least recently used cache of numpy arrays bounded by their total size
+    in bytes rather than by a number of entries. The cached arrays are
+    made read-only as they are shared by every caller.
+
+    The decoded image of a Data is cached in image_cache, so it is loaded
+    once for all of its cutouts, and processed cutouts are cached in
+    cutout_cache so they do not evict the images.
+
+    Concurrent get() calls for a key that is being loaded wait for that load
+    rather than loading it again.
+    """
+
+    def __init__(self, max_bytes=1024**3):
+        """
+        Parameters
+        ----------
+        max_bytes : int
+            Maximum total number of bytes of the cached arrays.
+        """
+        self._max_bytes = max_bytes
+        self._arrays = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.RLock()
+
+        # Maps key -> Future of the load in progress
+        self._loading = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._arrays)
+
+    def __contains__(self, key):
+        return key in self._arrays
+
+    #
+    # Properties
+    #
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value):
+        with self._lock:
+            self._max_bytes = value
+            self._evict(0)
+
+    @property
+    def nbytes(self):
+        """
+        Total number of bytes of the cached arrays.
+        """
+        return self._nbytes
+
+    @property
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._arrays),
+            'nbytes': self._nbytes,
+            'max_bytes': self._max_bytes
+        }
+
+    #
+    # Regular methods
+    #
+
+    def get(self, key, load):
+        """
+        The array for the key, calling load() to create it (and caching it)
+        if it is not cached.
+
+        Parameters
+        ----------
+        key : hashable
+            The cache key, e.g., the Data uuid.
+        load : function
+            Called with no arguments to create the array on a miss.
+
+        Returns
+        -------
+        numpy array
+            The read-only array.
+        """
+        with self._lock:
+            array = self._arrays.get(key)
+            if array is not None:
+                self._arrays.move_to_end(key)
+                self.hits += 1
+                return array
+
+            future = self._loading.get(key)
+            loading = future is None
+            if loading:
+                future = self._loading[key] = Future()
+                self.misses += 1
+
+        if not loading:
+            return future.result()
+
+        # Load outside the lock so different keys can load in parallel.
+        try:
+            array = load()
+        except BaseException as e:
+            with self._lock:
+                if self._loading.get(key) is future:
+                    del self._loading[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            # Not cached if the key was discarded while loading
+            if self._loading.get(key) is future:
+                del self._loading[key]
+                self.put(key, array)
+            elif isinstance(array, np.ndarray):
+                array.flags.writeable = False
+        future.set_result(array)
+        return array
+
+    def put(self, key, array):
+        """
+        Cache the array (made read-only), evicting the least recently used
+        arrays as needed. An array larger than max_bytes is not cached.
+        """
+        if isinstance(array, np.ndarray):
+            array.flags.writeable = False
+
+        nbytes = getattr(array, 'nbytes', 0)
+
+        with self._lock:
+            self.discard(key)
+
+            if nbytes > self._max_bytes:
+                log.debug('Not caching {}, {} bytes is more than the cache size'.format(key, nbytes))
+                return
+
+            self._evict(nbytes)
+            self._arrays[key] = array
+            self._nbytes += nbytes
+
+    def discard(self, key):
+        """
+        Remove the key from the cache, if it is there. A load of the key in
+        progress is not cached.
+        """
+        with self._lock:
+            self._loading.pop(key, None)
+            array = self._arrays.pop(key, None)
+            if array is not None:
+                self._nbytes -= getattr(array, 'nbytes', 0)
+
+    def clear(self):
+        with self._lock:
+            self._loading.clear()
+            self._arrays.clear()
+            self._nbytes = 0
+
+    #
+    # Internal methods
+    #
+
+    def _evict(self, nbytes):
+        """
+        Remove the least recently used arrays until nbytes more will fit.
+        """
+        while self._arrays and self._nbytes + nbytes > self._max_bytes:
+            key, array = self._arrays.popitem(last=False)
+            self._nbytes -= getattr(array, 'nbytes', 0)
+            self.evictions += 1
+            log.debug('Evicted {} from the image cache'.format(key))
+
+
+class DiskCache(object):
+    """
+    Persistent cache of arrays as .npy files in a directory, named by a
+    hash of the key, so they can be memory-mapped on later runs rather than
+    downloaded (or decoded) and processed again.
+
+    It is disabled, and get() just calls load(), until the directory is set.
+    """
+
+    def __init__(self, directory=None, mmap_mode='r'):
+        """
+        Parameters
+        ----------
+        directory : str, optional
+            Directory of the .npy files, created if it does not exist.
+        mmap_mode : str or None
+            Memory-map mode of the loaded arrays, None to read them into memory.
+        """
+        self._directory = None
+        self.directory = directory
+        self._mmap_mode = mmap_mode
+
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def directory(self):
+        return self._directory
+
+    @directory.setter
+    def directory(self, value):
+        if value is not None:
+            os.makedirs(value, exist_ok=True)
+        self._directory = value
+
+    @staticmethod
+    def key(*parts):
+        """
+        Hash of the JSON serializable parts, e.g., a location and processing save() dicts.
+        """
+        return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self._directory, key[:2], '{}.npy'.format(key))
+
+    def get(self, key, load):
+        """
+        The array for the key, calling load() to create it (and saving it)
+        if it is not in the directory.
+
+        Parameters
+        ----------
+        key : str
+            The cache key, from key().
+        load : function
+            Called with no arguments to create the array on a miss.
+
+        Returns
+        -------
+        numpy array
+            The array, memory-mapped if it was read from the directory.
+        """
+        if self._directory is None:
+            return load()
+
+        path = self.path(key)
+        if os.path.exists(path):
+            try:
+                array = np.load(path, mmap_mode=self._mmap_mode)
+                self.hits += 1
+                return array
+            except (ValueError, OSError) as e:
+                log.warning('Could not read {} from the disk cache, {}'.format(path, e))
+
+        self.misses += 1
+        array = load()
+        self.put(key, array)
+        return array
+
+    def put(self, key, array):
+        """
+        Save the array. It is written to a temporary file and then renamed so
+        other processes never read a partial file.
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        temporary = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        with open(temporary, 'wb') as fp:
+            np.save(fp, np.asarray(array))
+        os.replace(temporary, path)
+
+    def discard(self, key):
+        if self._directory is not None and os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+
+image_cache = ImageCache()
+disk_cache = DiskCache()
+cutout_cache = ImageCache(max_bytes=256 * 1024**2)
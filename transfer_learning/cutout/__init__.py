@@ -1 +1 @@
-from .cutout import Cutout, CutoutCollection, BoundingBox
+from .cutout import Cutout, CutoutCollection, BoundingBox, BoundingBoxIndex
@@ -1,15 +1,33 @@
 import uuid
 
-from cachetools.func import lru_cache
 import numpy as np
 
 from transfer_learning.data import Data
 from transfer_learning.misc.image_processing import ImageProcessing
 
+from ..cache import cutout_cache
+
 from ..tl_logging import get_logger
 log = get_logger('cutout')
 
 
+def _compact(data):
+    """
+    Processed cutout as uint8 if it is integer valued in [0, 255],
+    otherwise as float32.
+    """
+    data = np.asarray(data)
+
+    # A view (e.g., a flip) would keep the whole image in memory.
+    if data.dtype == np.uint8:
+        return data if data.base is None else data.copy()
+
+    if data.size > 0 and data.min() >= 0 and data.max() <= 255 and np.array_equal(data, np.round(data)):
+        return data.astype(np.uint8)
+
+    return data.astype(np.float32)
+
+
 class CutoutCollection(object):
     """
     This is a collection of Data objects. There isn't necessarily
@@ -115,13 +133,38 @@ class CutoutCollection(object):
     # Load and save
     #
 
-    def save(self):
+    def save(self, normalized=False):
+        """
+        Save the cutouts. If normalized then each cutout refers to its data by
+        uuid and each data is saved once in 'datas'.
+        """
+        cutouts = [CutoutCollection._collection[x] for x in self._collection]
+
+        if not normalized:
+            return {
+                'cutout_collection': [cutout.save() for cutout in cutouts]
+            }
+
         return {
-            'cutout_collection': [CutoutCollection._collection[x].save()
-                                  for x in self._collection]
+            'cutout_collection': [cutout.save(normalized=True) for cutout in cutouts],
+            'datas': CutoutCollection._save_datas(cutouts)
         }
 
+    @staticmethod
+    def _save_datas(cutouts):
+        """
+        The save() dict of each data of the cutouts, once.
+        """
+        datas = {}
+        for cutout in cutouts:
+            if cutout.data.uuid not in datas:
+                datas[cutout.data.uuid] = cutout.data.save()
+        return list(datas.values())
+
     def load(self, thedict):
+        for data_dict in thedict.get('datas', []):
+            Data.factory(data_dict)
+
         for cutout_dict in thedict['cutout_collection']:
             c = Cutout().load(cutout_dict)
             self.add(c)
@@ -250,6 +293,79 @@ class BoundingBox(object):
         return self._bounding_box[3] - self._bounding_box[2]
 
 
+class BoundingBoxIndex(object):
+    """
+    The bounding boxes of a list of cutouts stored as an N x 4 array
+    (left, right, bottom, top) and grouped by the Data each cutout
+    comes from, so overlaps are only checked against cutouts of the
+    same image and in one vectorized comparison.
+    """
+
+    def __init__(self, cutouts):
+        """
+        Parameters
+        -----------
+        cutouts : list of Cutout
+            The cutouts to index, the index of each is its position in the list.
+        """
+        self._set([cutout.bounding_box._bounding_box for cutout in cutouts],
+                  [cutout.data.uuid if cutout.data is not None else None for cutout in cutouts])
+
+    @classmethod
+    def from_bounding_boxes(cls, bounding_boxes, data_uuids):
+        """
+        Index bounding boxes without their Cutout objects, e.g., read from save() dicts.
+
+        Parameters
+        -----------
+        bounding_boxes : list
+            The (left, right, bottom, top) of each bounding box.
+        data_uuids : list of str
+            The uuid of the Data of each bounding box.
+        """
+        index = cls.__new__(cls)
+        index._set(bounding_boxes, data_uuids)
+        return index
+
+    def _set(self, bounding_boxes, data_uuids):
+        groups = {}
+        self._boxes = np.array(bounding_boxes, dtype=np.float64).reshape(-1, 4)
+        self._groups = np.array([groups.setdefault(data_uuid, len(groups)) for data_uuid in data_uuids],
+                                dtype=np.int64)
+
+    def __len__(self):
+        return len(self._boxes)
+
+    def overlaps(self, index, others):
+        """
+        Does the bounding box at index overlap any of the others from the same Data.
+        Same test as BoundingBox.overlap().
+
+        Parameters
+        -----------
+        index : int
+            Index of the bounding box to check.
+        others : list of int
+            Indices of the bounding boxes to check against.
+
+        Return
+        ------
+        bool
+            True if there is an overlap otherwise False
+        """
+        others = np.asarray(others, dtype=np.int64)
+        others = others[self._groups[others] == self._groups[index]]
+
+        if len(others) == 0:
+            return False
+
+        left, right, bottom, top = self._boxes[index]
+        boxes = self._boxes[others]
+
+        return bool(np.any((boxes[:, 0] <= right) & (boxes[:, 1] >= left) &
+                           (boxes[:, 2] <= top) & (boxes[:, 3] >= bottom)))
+
+
 class Cutout(object):
     """
     This cutout class represents one cutout of an image.  Likely a fingerprint
@@ -258,6 +374,11 @@ class Cutout(object):
 
     @staticmethod
     def factory(parameter):
+
+        # A uuid refers to a cutout that has already been loaded (normalized save).
+        if isinstance(parameter, str):
+            return CutoutCollection._collection[parameter]
+
         if parameter['uuid'] in CutoutCollection._collection:
             return CutoutCollection._collection[parameter['uuid']]
         else:
@@ -314,7 +435,6 @@ class Cutout(object):
         # This is the "original data"
         #
         self._original_data = None
-        self._cached_output = None
 
         CutoutCollection._add(self)
 
@@ -340,10 +460,11 @@ class Cutout(object):
 
     @data.setter
     def data(self, value):
-        if not isinstance(Data, value):
+        if not isinstance(value, Data):
             log.error('Data must be of type data')
             raise Exception('Data must be of type data')
 
+        cutout_cache.discard(self._cache_key())
         self._data = value
 
     @property
@@ -358,6 +479,7 @@ class Cutout(object):
             raise Exception('Bounding box must be a list of 4 integers')
 
         self._bounding_box = BoundingBox(*value)
+        cutout_cache.discard(self._cache_key())
 
     @property
     def cutout_processing(self):
@@ -366,6 +488,7 @@ class Cutout(object):
     @cutout_processing.setter
     def cutout_processing(self, value):
         self._cutout_processing = value
+        cutout_cache.discard(self._cache_key())
 
     def add_processing(self, cutout_processing, base_cutout_uuid=None):
         """
@@ -384,6 +507,7 @@ class Cutout(object):
         log.info('Adding processing {}'.format(cutout_processing))
 
         self._cutout_processing = cutout_processing
+        cutout_cache.discard(self._cache_key())
 
         #
         # Add in info about the base cutout uuid
@@ -424,10 +548,11 @@ class Cutout(object):
 
         return cutout
 
-    @lru_cache(maxsize=1024)
     def get_data(self):
         """
-        Retrieve the data
+        Retrieve the data, which is read-only. Without processing this is a
+        view of the data image, otherwise the processed cutout is kept in the
+        cutout cache as float32 (or uint8 if it fits).
 
         Return
         ------
@@ -436,27 +561,43 @@ class Cutout(object):
         """
         log.info('')
 
-        #
-        # Cache the original data if not already set.
-        #
+        if not self._cutout_processing:
+            return self._cutout()
+
+        return cutout_cache.get(self._cache_key(), self._load)
 
+    def _cache_key(self):
+        """
+        Key of the processed cutout in the cutout cache, which changes with the data version.
+        """
+        return self._uuid, self._data.version if self._data is not None else None
+
+    def _cutout(self):
+        """
+        View of the bounding box of the (cached) data.
+        """
         bb = self._bounding_box
-        data = self._data.get_data()[bb.left:bb.right, bb.bottom:bb.top]
+        return self._data.get_data()[bb.left:bb.right, bb.bottom:bb.top]
 
-        #
-        # Apply the processing
-        #
+    def _load(self):
+        """
+        Apply the processing to the cutout.
+        """
+        data = self._cutout()
 
         for processing in self._cutout_processing:
             data = processing.process(data)
 
-        return data
+        return _compact(data)
 
-    def save(self):
+    def save(self, normalized=False):
+        """
+        Save the cutout, with the data referenced by uuid if normalized.
+        """
         log.info('')
         return {
             'uuid': self._uuid,
-            'data': self._data.save(),
+            'data': self._data.uuid if normalized else self._data.save(),
             'bounding_box': self._bounding_box.save(),
             'generator_parameters': self._generator_parameters,
             'base_cutout_uuid': self._base_cutout_uuid,
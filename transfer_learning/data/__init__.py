@@ -1 +1,2 @@
 from .data import Data, DataCollection
+from .meta import MetaDict, MetaTable
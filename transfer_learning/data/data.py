@@ -1,18 +1,54 @@
+import os
 import uuid
 import re
+import threading
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import numpy as np
 import imageio
 import requests
-from cachetools.func import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from ..cache import image_cache, disk_cache
 from ..misc.image_processing import ImageProcessing
+from .meta import MetaDict, MetaTable
 
 from ..tl_logging import get_logger
 log = get_logger('data')
 
 
+#
+# HTTP session shared by all the Data so connections to the same host are
+# reused, with retries (and backoff) of connection errors and server errors.
+#
+
+HTTP_TIMEOUT = 60
+HTTP_POOL_SIZE = 32
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def http_session():
+    """
+    The shared requests.Session, created on first use.
+    """
+    global _http_session
+
+    with _http_session_lock:
+        if _http_session is None:
+            retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE,
+                                  max_retries=retry)
+            _http_session = requests.Session()
+            _http_session.mount('http://', adapter)
+            _http_session.mount('https://', adapter)
+
+    return _http_session
+
+
 def stringify(dictionary):
     """
     Used to make everything a string in the value part of the
@@ -31,9 +67,13 @@ class DataCollection(object):
     # data elements.
     _collection = {}
 
+    # Columnar meta of all the data, updated as data are added.
+    _meta_table = MetaTable()
+
     @staticmethod
     def _add(data):
         DataCollection._collection[data.uuid] = data
+        DataCollection._meta_table.set(data.uuid, data.meta)
 
     def __init__(self, datas=None):
 
@@ -75,6 +115,14 @@ class DataCollection(object):
         """
         yield [DataCollection._collection[x] for x in self._collection]
 
+    @property
+    def meta_table(self):
+        """
+        The MetaTable of the data, query with the rows of this collection,
+        e.g., meta_table.numbers('exposure', meta_table.rows(collection_uuids)).
+        """
+        return DataCollection._meta_table
+
     #
     # Internal methods
     #
@@ -122,11 +170,43 @@ class DataCollection(object):
 
         # Add to the main collection. Essentially an update
         # if it already exists in the data collection
-        DataCollection._collection[data.uuid] = data
+        DataCollection._add(data)
 
         # Add to this collection.
         self._collection.append(data.uuid)
 
+    def prefetch(self, workers=8):
+        """
+        Load (download and decode, or read from the disk cache) and process
+        the data of this collection in parallel, so it is in the image cache.
+        Data that fails to load is logged and skipped. The image cache
+        must be large enough to hold the data for this to be useful.
+
+        Parameters
+        ----------
+        workers : int
+            Maximum number of data loaded at the same time.
+
+        Returns
+        -------
+        int
+            Number of data loaded.
+        """
+        datas = [DataCollection._collection[x] for x in self._collection]
+        log.info('Prefetching {} data with {} workers'.format(len(datas), workers))
+
+        loaded = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(data.get_data): data for data in datas}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    loaded += 1
+                except Exception as e:
+                    log.error('Problem prefetching {}: {}'.format(futures[future].location, e))
+
+        return loaded
+
     #
     # Save and load
     #
@@ -153,6 +233,10 @@ class Data:
     @staticmethod
     def factory(parameter):
 
+        # A uuid refers to data that has already been loaded (normalized save).
+        if isinstance(parameter, str):
+            return DataCollection._collection[parameter]
+
         if parameter['uuid'] in DataCollection._collection:
             return DataCollection._collection[parameter['uuid']]
         else:
@@ -207,13 +291,10 @@ class Data:
             self._processing = []
         else:
             self._processing = [ImageProcessing.load(p) if isinstance(p, dict) else p for p in processing]
-        self._meta = meta
+        self._meta = self._wrap_meta(meta)
 
-        #
-        # Cache of the 2D or 3D numpy array data
-        #
-
-        self._cached_data = None
+        # Incremented when the location or processing changes, see version.
+        self._version = 0
 
         #
         # Store self in the data_collection.
@@ -240,6 +321,15 @@ class Data:
     @location.setter
     def location(self, value):
         self._location = value
+        self._changed()
+
+    @property
+    def version(self):
+        """
+        Number of times the location or processing has changed. It is part of
+        the cutout cache keys so processed cutouts of the old image are not used.
+        """
+        return self._version
 
     @property
     def radec(self):
@@ -259,69 +349,22 @@ class Data:
     def meta(self, value):
         if not isinstance(value, dict):
             raise ValueError('Meta must be a dict')
-        self._meta = value
-
-    @property
-    def shape(self):
-        if self._cached_data is None:
-            self._cached_data = self.get_data()
-        return self._cached_data.shape
-
-    def _load_and_process(self):
-        # If we have the data already loaded then don't
-        # need to reload all the data.
-
-        if self._cached_data is not None:
-            return self._cached_data
-
-        log.debug('Data is not cached, so will need to load it')
-        regex = r".*[jpg|tif|tiff]$"
-
-        #
-        # Load the dataset from a URL
-        #
+        self._meta = self._wrap_meta(value)
+        self._meta_changed(self._meta)
 
-        if 'http' in self.location:
-            success = True
-            try:
-                response = requests.get(self.location)
-            except requests.exceptions.RequestException as e:
-                success = False
-
-            if not response.status_code == 200 or not success:
-                log.error('Problem loading the data {}'.format(self.location))
-                raise Exception('Problem loading the data {}'.format(self.location))
-
-            self._cached_data = np.array(imageio.imread(BytesIO(response.content)))
-
-        #
-        # Load a local dataset.
-        #
-
-        elif re.match(regex, self.location):
-            self._cached_data = np.array(imageio.imread(self.location))
-
-        #
-        # Unknown dataset - raise an exception
-        #
-
-        else:
-            log.error('Unknown file type of file {}'.format(self.location))
-            raise Exception('Unknown type of file {}'.format(self.location))
-
-        #
-        # Apply the processing and store in the cached data
-        #
-
-        for processor in self._processing:
-            self._cached_data = processor.process(self._cached_data)
+    def _wrap_meta(self, meta):
+        """
+        The meta as a MetaDict, so changing it in place updates the MetaTable.
+        """
+        return None if meta is None else MetaDict(meta, self._meta_changed)
 
-        #
-        # If 2D, make 3D
-        #
+    def _meta_changed(self, meta):
+        if self._uuid in DataCollection._collection:
+            DataCollection._meta_table.set(self._uuid, meta)
 
-        if len(self._cached_data.shape) == 2:
-            self._cached_data = self._gray2rgb(self._cached_data)
+    @property
+    def shape(self):
+        return self.get_data().shape
 
     def _gray2rgb(self, data):
         """
@@ -336,18 +379,39 @@ class Data:
         data_out[:, :, 2] = data
         return data_out
 
-    @lru_cache(maxsize=1024)
     def get_data(self):
         """
-        Retrieve the numpy array of data
+        Retrieve the numpy array of data. It is loaded once and then
+        kept in the image cache (so is read-only). If the disk cache
+        directory is set then the processed data is also saved there.
 
         :return: 2D or 3D data array
         """
         log.info('Retrieving data...')
+        return image_cache.get(self._uuid, self._load_cached)
+
+    def _disk_cache_key(self):
+        """
+        Key of the processed data in the disk cache, the location and processing
+        (and the modification time and size of a local file so edits are seen).
+        """
+        try:
+            stat = os.stat(self.location)
+            version = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            version = None
+
+        return disk_cache.key(self.location, [p.save() for p in self._processing], version)
 
-        # If we have the data already loaded then don't
-        # need to reload all the data.
+    def _load_cached(self):
+        if disk_cache.directory is None:
+            return self._load()
+        return disk_cache.get(self._disk_cache_key(), self._load)
 
+    def _load(self):
+        """
+        Load the data and apply the processing.
+        """
         log.debug('Data is not cached, so will need to load it')
         regex = r".*[jpg|tif|tiff]$"
 
@@ -356,13 +420,14 @@ class Data:
         #
 
         if 'http' in self.location:
-            success = True
             try:
-                response = requests.get(self.location)
+                response = http_session().get(self.location, timeout=HTTP_TIMEOUT)
+                success = response.status_code == 200
             except requests.exceptions.RequestException as e:
+                log.error('Request for {} failed: {}'.format(self.location, e))
                 success = False
 
-            if not response.status_code == 200 or not success:
+            if not success:
                 log.error('Problem loading the data {}'.format(self.location))
                 raise Exception('Problem loading the data {}'.format(self.location))
 
@@ -399,25 +464,26 @@ class Data:
 
         return data 
 
-    def get_data_OLD(self):
-        """
-        Retrieve the numpy array of data
-
-        :return: 2D or 3D data array
-        """
-        log.info('Retrieving data...')
-
-        if self._cached_data is None:
-            self._load_and_process()
-
-        return self._cached_data
-
     def add_processing(self, processing):
 
         if not isinstance(processing, ImageProcessing):
             raise Exception('Must be a ImageProcessing instance.')
 
         self._processing.append(processing)
+        self._changed()
+
+    def _changed(self):
+        """
+        The image changed, so the cached image (and cutouts) are stale.
+        """
+        self._version += 1
+        image_cache.discard(self._uuid)
+
+    def __setstate__(self, state):
+        # Register unpickled data (e.g., in a celery worker) so its meta is in the MetaTable.
+        self.__dict__.update(state)
+        self._meta = self._wrap_meta(self._meta)
+        DataCollection._add(self)
 
     def save(self):
         return {
@@ -433,7 +499,7 @@ class Data:
         self._location = thedict['location']
         self._radec = thedict['radec']
         self._processing = [ImageProcessing.load(x) for x in thedict['processing']]
-        self._meta = thedict['meta']
+        self._meta = self._wrap_meta(thedict['meta'])
 
         # Add data to the main collection
         DataCollection._add(self)
@@ -0,0 +1,225 @@
+import numpy as np
+
+from ..tl_logging import get_logger
+log = get_logger('meta')
+
+
+class MetaDict(dict):
+    """
+    The meta dictionary of a Data. It calls on_change(self) after every
+    change so the MetaTable is kept up to date when the meta is changed
+    in place. It is pickled (and copied) as a plain dict.
+    """
+
+    def __init__(self, values=(), on_change=None):
+        super(MetaDict, self).__init__(values)
+        self._on_change = on_change
+
+    def _changed(self):
+        if self._on_change is not None:
+            self._on_change(self)
+
+    def __setitem__(self, key, value):
+        super(MetaDict, self).__setitem__(key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        super(MetaDict, self).__delitem__(key)
+        self._changed()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        super(MetaDict, self).clear()
+        self._changed()
+
+    def pop(self, *args):
+        value = super(MetaDict, self).pop(*args)
+        self._changed()
+        return value
+
+    def popitem(self):
+        item = super(MetaDict, self).popitem()
+        self._changed()
+        return item
+
+    def setdefault(self, key, default=None):
+        value = super(MetaDict, self).setdefault(key, default)
+        self._changed()
+        return value
+
+    def update(self, *args, **kwargs):
+        super(MetaDict, self).update(*args, **kwargs)
+        self._changed()
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+class MetaTable(object):
+    """
+    Columnar store of the meta dictionaries of a set of Data, one row per
+    Data (by uuid) and one column per meta key. Each column keeps the
+    original values and, parsed once when the value is set, the value as a
+    float (NaN if missing or not a number) so numeric filters do not have
+    to re-parse the strings written by Data.save().
+    """
+
+    def __init__(self):
+        # Maps data uuid -> row
+        self._rows = {}
+        self._size = 0
+        self._capacity = 0
+
+        # Maps key -> object array of values (None if missing) and
+        # key -> float64 array of the numeric values.
+        self._values = {}
+        self._numbers = {}
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, key):
+        return key in self._values
+
+    @property
+    def keys(self):
+        return list(self._values.keys())
+
+    #
+    # Update methods
+    #
+
+    def set(self, data_uuid, meta):
+        """
+        Add or replace the meta for the data.
+
+        Parameters
+        ----------
+        data_uuid : str
+            UUID of the Data.
+        meta : dict
+            The meta dictionary.
+        """
+        row = self._rows.get(data_uuid)
+
+        if row is None:
+            row = self._size
+            self._grow(row + 1)
+            self._rows[data_uuid] = row
+            self._size += 1
+        else:
+            # Clear the old values
+            for key in self._values:
+                self._values[key][row] = None
+                self._numbers[key][row] = np.nan
+
+        for key, value in meta.items():
+            if key not in self._values:
+                self._add_column(key)
+            self._values[key][row] = value
+            self._numbers[key][row] = self._number(value)
+
+    def _grow(self, size):
+        if size <= self._capacity:
+            return
+
+        capacity = max(size, 2 * self._capacity, 16)
+        for key in self._values:
+            values = np.empty(capacity, dtype=object)
+            values[:self._capacity] = self._values[key]
+            numbers = np.full(capacity, np.nan)
+            numbers[:self._capacity] = self._numbers[key]
+            self._values[key], self._numbers[key] = values, numbers
+
+        self._capacity = capacity
+
+    def _add_column(self, key):
+        self._values[key] = np.empty(self._capacity, dtype=object)
+        self._numbers[key] = np.full(self._capacity, np.nan)
+
+    @staticmethod
+    def _number(value):
+        if isinstance(value, bool) or value is None:
+            return np.nan
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return np.nan
+
+    #
+    # Query methods
+    #
+
+    def rows(self, data_uuids):
+        """
+        Row for each data uuid, -1 if the data is not in the table.
+        """
+        return np.array([self._rows.get(data_uuid, -1) for data_uuid in data_uuids], dtype=np.int64)
+
+    def values(self, key, rows=None):
+        """
+        Object array of the original values of the key, None where missing.
+
+        Raises
+        ------
+        KeyError
+            If no Data has the key in its meta.
+        """
+        return self._take(self._values[key], rows, None)
+
+    def numbers(self, key, rows=None):
+        """
+        Float array of the values of the key, NaN where missing or not a number.
+        """
+        return self._take(self._numbers[key], rows, np.nan)
+
+    def matches(self, pattern, rows=None):
+        """
+        Boolean mask of the rows whose meta matches the pattern.
+
+        Parameters
+        ----------
+        pattern : str or dict
+            A string matches if it is in (the string of) any value. A dict
+            matches if each of its values is in the value of its key.
+        rows : numpy array, optional
+            Rows to check, from rows(), all of them if None.
+        """
+        size = self._size if rows is None else len(rows)
+
+        if isinstance(pattern, str):
+            mask = np.zeros(size, dtype=bool)
+            for key in self._values:
+                mask |= self._contains(self.values(key, rows), pattern, as_string=True)
+            return mask
+
+        mask = np.ones(size, dtype=bool)
+        for key, value in pattern.items():
+            if key not in self._values:
+                return np.zeros(size, dtype=bool)
+            mask &= self._contains(self.values(key, rows), value)
+        return mask
+
+    @staticmethod
+    def _contains(values, item, as_string=False):
+        def contains(value):
+            if value is None:
+                return False
+            try:
+                return item in (str(value) if as_string else value)
+            except TypeError:
+                return False
+
+        return np.array([contains(value) for value in values], dtype=bool)
+
+    def _take(self, column, rows, missing):
+        if rows is None:
+            return column[:self._size].copy()
+
+        found = rows >= 0
+        out = np.full(len(rows), missing, dtype=column.dtype)
+        out[found] = column[rows[found]]
+        return out
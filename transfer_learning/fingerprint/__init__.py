@@ -1,2 +1,5 @@
 from .image_processing import add_zernike_moment
-from .fingerprint import Fingerprint, FingerprintCollection
+from .fingerprint import Fingerprint, FingerprintCollection, LazyFingerprints
+from .matrix import FingerprintMatrix
+from .store import PredictionStore
+from .storage import save_fingerprints, load_fingerprints
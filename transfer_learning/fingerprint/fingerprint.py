@@ -1,7 +1,11 @@
 import uuid
 
+import numpy as np
+
 from ..tl_logging import get_logger
-from transfer_learning.cutout import Cutout
+from transfer_learning.cutout import Cutout, CutoutCollection
+from transfer_learning.data import Data, DataCollection
+from .store import PredictionStore
 log = get_logger('fingerprint')
 
 
@@ -18,6 +22,9 @@ class FingerprintCollection(object):
 
     _collection = {}
 
+    # The predictions of all the fingerprints, each fingerprint is a view of a slice.
+    _predictions = PredictionStore()
+
     @staticmethod
     def _add(cutout):
         FingerprintCollection._collection[cutout.uuid] = cutout
@@ -104,18 +111,155 @@ class FingerprintCollection(object):
     # Load and save
     #
 
-    def save(self):
+    def save(self, normalized=False):
+        """
+        Save the fingerprints. If normalized then each fingerprint refers to its
+        cutout (and each cutout to its data) by uuid, and each cutout and data is
+        saved once in 'cutouts' and 'datas'.
+        """
+        fingerprints = [FingerprintCollection._collection[x] for x in self._collection]
+
+        thedict = {
+            'fingerprint_collection': [fp.save(normalized=normalized) for fp in fingerprints]
+        }
+
+        if normalized:
+            thedict.update(FingerprintCollection._save_records(fingerprints))
+
+        return thedict
+
+    @staticmethod
+    def _save_records(fingerprints):
+        """
+        The normalized save() dicts of each cutout, and each data, of the fingerprints once.
+        """
+        cutouts = {}
+        for fp in fingerprints:
+            if fp.cutout is not None and fp.cutout.uuid not in cutouts:
+                cutouts[fp.cutout.uuid] = fp.cutout
+
         return {
-            'fingerprint_collection': [FingerprintCollection._collection[x].save()
-                                       for x in self._collection]
+            'cutouts': [cutout.save(normalized=True) for cutout in cutouts.values()],
+            'datas': CutoutCollection._save_datas(cutouts.values())
         }
 
+    @staticmethod
+    def _load_records(thedict):
+        """
+        Load the data and cutouts saved by _save_records(), if there are any, so
+        the fingerprints referencing them by uuid can be loaded.
+        """
+        for data_dict in thedict.get('datas', []):
+            Data.factory(data_dict)
+
+        for cutout_dict in thedict.get('cutouts', []):
+            Cutout.factory(cutout_dict)
+
     def load(self, thedict):
+        FingerprintCollection._load_records(thedict)
+
         for fingerprint_dict in thedict['fingerprint_collection']:
             f = Fingerprint.factory(fingerprint_dict)
             self.add(f)
 
 
+class LazyFingerprints(object):
+    """
+    List of fingerprints kept as their save() dicts (normalized or not). Each
+    Fingerprint, and its cutout and data, is only created the first time it is
+    accessed, so loading a large similarity does not build every object up front.
+    """
+
+    def __init__(self, records, cutouts=None, datas=None):
+        """
+        Parameters
+        ----------
+        records : list
+            Fingerprint save() dicts (or Fingerprints).
+        cutouts : list, optional
+            Normalized cutout save() dicts the records refer to by uuid.
+        datas : list, optional
+            Data save() dicts the cutouts refer to by uuid.
+        """
+        self._records = list(records)
+        self._fingerprints = [None] * len(self._records)
+        self._cutouts = {x['uuid']: x for x in cutouts or []}
+        self._datas = {x['uuid']: x for x in datas or []}
+
+    @property
+    def n_loaded(self):
+        """
+        Number of fingerprints created so far.
+        """
+        return sum(fp is not None for fp in self._fingerprints)
+
+    def extend(self, fingerprints):
+        fingerprints = list(fingerprints)
+        self._records.extend(fingerprints)
+        self._fingerprints.extend(fingerprints)
+
+    def bounding_boxes(self):
+        """
+        The (left, right, bottom, top) of the cutout of each fingerprint and the
+        uuid of its data, read from the records so no fingerprint is created.
+
+        Returns
+        -------
+        (bounding_boxes, data_uuids) : tuple of lists
+        """
+        bounding_boxes, data_uuids = [], []
+        for record, fingerprint in zip(self._records, self._fingerprints):
+            if fingerprint is None and isinstance(record, Fingerprint):
+                fingerprint = record
+            cutout = fingerprint.cutout if fingerprint is not None else record['cutout']
+            if isinstance(cutout, str):
+                cutout = self._cutouts.get(cutout) or CutoutCollection._collection[cutout]
+
+            if isinstance(cutout, dict):
+                data = cutout['data']
+                bounding_boxes.append(cutout['bounding_box']['bounding_box'])
+                data_uuids.append(data if isinstance(data, str) else data['uuid'])
+            else:
+                bounding_boxes.append(cutout.bounding_box._bounding_box)
+                data_uuids.append(cutout.data.uuid if cutout.data is not None else None)
+
+        return bounding_boxes, data_uuids
+
+    #
+    # Internal methods
+    #
+
+    def _load(self, record):
+        if isinstance(record, Fingerprint):
+            return record
+
+        # Load the cutout, and its data, only when this fingerprint needs them.
+        cutout = record['cutout']
+        if isinstance(cutout, str) and cutout not in CutoutCollection._collection:
+            cutout_record = self._cutouts[cutout]
+            data = cutout_record['data']
+            if isinstance(data, str) and data not in DataCollection._collection:
+                Data.factory(self._datas[data])
+            Cutout.factory(cutout_record)
+
+        return Fingerprint.factory(record)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[ii] for ii in range(*index.indices(len(self)))]
+
+        fingerprint = self._fingerprints[index]
+        if fingerprint is None:
+            fingerprint = self._fingerprints[index] = self._load(self._records[index])
+        return fingerprint
+
+    def __iter__(self):
+        return (self[ii] for ii in range(len(self)))
+
+
 class FingerprintFilter(object):
     """
     Simple fingerprint filter object, primarily used for
@@ -154,37 +298,34 @@ class FingerprintFilter(object):
     def multi_filter(self, fingerprints, patterns):
         """
         Generator function which yields the names that match one or more of the patterns.
+        The patterns are matched against the columns of the DataCollection MetaTable
+        rather than the meta of each fingerprint's data.
         """
-        for fingerprint in fingerprints:
-            if any(self._fingerprint_meta_checker(fingerprint, pattern) for pattern in patterns):
-                yield fingerprint
+        fingerprints = list(fingerprints)
 
-    def _fingerprint_meta_checker(self, fingerprint, pattern):
-        """
-        Check to see that the pattern is in the meta of the fingerprint
-        which lives in fingerprint.cutout.data.meta.
-        """
+        table = DataCollection._meta_table
+        rows = table.rows([fp.cutout.data.uuid if fp.cutout is not None and fp.cutout.data is not None else None
+                           for fp in fingerprints])
 
-        # Grab the meta
-        print('fingerprint {}'.format(fingerprint))
-        print('cutout {}'.format(fingerprint.cutout))
-        print('data {}'.format(fingerprint.cutout.data))
-        print('meta {}'.format(fingerprint.cutout.data.meta))
-        meta = fingerprint.cutout.data.meta
+        matched = np.zeros(len(fingerprints), dtype=bool)
+        for pattern in patterns:
+            log.debug('pattern is {}'.format(pattern))
+            matched |= table.matches(pattern, rows)
 
-        # If a string, then just see if it fits in any value
-        log.debug('pattern is {}'.format(pattern))
-        log.debug('meta is {}'.format(meta))
-        if isinstance(pattern, str):
-            return any(pattern in str(v) for k, v in meta.items())
-
-        # If pattern is a dict then check each key, value pair and
-        # they should all be true for this to pass.
-        elif isinstance(pattern, dict):
-            return all(pv in meta[pk] for pk, pv in pattern.items())
+        for fingerprint, match in zip(fingerprints, matched):
+            if match:
+                yield fingerprint
 
 
 class Fingerprint(object):
+    """
+    Fingerprint of a cutout. The predictions are held in the
+    FingerprintCollection PredictionStore and the fingerprint keeps the
+    slice of it, so the instance itself is small.
+    """
+
+    __slots__ = ['_uuid', '_cutout_uuid', '_cutout', '_prediction_slice', '_other_predictors',
+                 '_embedding', '_sorted_predictions']
 
     @staticmethod
     def factory(parameter):
@@ -195,9 +336,22 @@ class Fingerprint(object):
             return Fingerprint(cutout=cutout,
                                predictions=parameter['predictions'],
                                other_predictors=parameter['other_predictors'],
+                               embedding=parameter.get('embedding'),
                                uuid_in=parameter['uuid'])
 
-    def __init__(self, cutout_uuid=None, cutout=None, predictions=[], other_predictors=None, uuid_in=None):
+    @staticmethod
+    def from_store(prediction_slice, cutout=None, other_predictors=None, embedding=None, uuid_in=None):
+        """
+        Create the fingerprint from predictions already in the FingerprintCollection
+        PredictionStore, e.g., when loading many fingerprints at once.
+        """
+        fingerprint = Fingerprint(cutout=cutout, predictions=[], other_predictors=other_predictors,
+                                  embedding=embedding, uuid_in=uuid_in)
+        fingerprint._prediction_slice = prediction_slice
+        return fingerprint
+
+    def __init__(self, cutout_uuid=None, cutout=None, predictions=[], other_predictors=None,
+                 embedding=None, uuid_in=None):
         if uuid_in is not None:
             self._uuid = uuid_in
         else:
@@ -208,18 +362,45 @@ class Fingerprint(object):
         else:
             self._cutout = cutout
             self._cutout_uuid = cutout.uuid
-        self._predictions = predictions
+        self._prediction_slice = FingerprintCollection._predictions.add(predictions)
 
         if other_predictors is not None:
             self._other_predictors = other_predictors
         else:
             self._other_predictors = {}
 
+        # Penultimate layer feature vector from the network, if calculated.
+        self._embedding = None if embedding is None else np.asarray(embedding, dtype=np.float32)
+
+        # Merged and sorted predictions when there are other predictors, see the predictions property.
+        self._sorted_predictions = None
+
         FingerprintCollection._add(self)
 
+    def __getstate__(self):
+        # The prediction slice only makes sense in this process's store.
+        return {
+            'uuid': self._uuid,
+            'cutout_uuid': self._cutout_uuid,
+            'cutout': self._cutout,
+            'predictions': self._own_predictions(),
+            'other_predictors': self._other_predictors,
+            'embedding': self._embedding
+        }
+
+    def __setstate__(self, state):
+        self._uuid = state['uuid']
+        self._cutout_uuid = state['cutout_uuid']
+        self._cutout = state['cutout']
+        self._prediction_slice = FingerprintCollection._predictions.replace(getattr(self, '_prediction_slice', None),
+                                                                            state['predictions'])
+        self._other_predictors = state['other_predictors']
+        self._embedding = state['embedding']
+        self._sorted_predictions = None
+
     def __str__(self):
         return 'Fingerprint {} based on cutout {} with predictions {}'.format(
-                self._uuid, self._cutout_uuid, [x for x in self._predictions[:3]])
+                self._uuid, self._cutout_uuid, self._own_predictions()[:3])
 
     @property
     def uuid(self):
@@ -241,15 +422,54 @@ class Fingerprint(object):
     def cutout_uuid(self, value):
         self._cutout_uuid = value
 
+    @property
+    def embedding(self):
+        return self._embedding
+
     @property
     def predictions(self):
+        """
+        The predictions and other predictors merged and sorted by decreasing
+        value. The store already holds the predictions sorted, so these are
+        decoded directly. With other predictors the merged list is computed on
+        the first access and cached until add_other_predictor or load is called,
+        so it must not be modified.
+        """
+        if not self._other_predictors:
+            return tuple(self._own_predictions())
+
+        if self._sorted_predictions is None:
+            return_prediction = self._own_predictions()
 
-        return_prediction = [x for x in self._predictions]
+            for key, val in self._other_predictors.items():
+                return_prediction.extend(val)
 
-        for key, val in self._other_predictors.items():
-            return_prediction.extend(val)
+            self._sorted_predictions = tuple(sorted(return_prediction, key=lambda x: x[2], reverse=True))
+
+        return self._sorted_predictions
+
+    @property
+    def prediction_arrays(self):
+        """
+        The predictions as (ids, scores) arrays, sorted by decreasing score, where
+        the ids index FingerprintCollection._predictions.entries.
+        """
+        if not self._other_predictors:
+            return FingerprintCollection._predictions.arrays(*self._prediction_slice)
+
+        return FingerprintCollection._predictions.encode(self.predictions)
+
+    @property
+    def own_prediction_arrays(self):
+        """
+        The (ids, scores) arrays of the fingerprint's own predictions, without
+        those of the other predictors.
+        """
+        return FingerprintCollection._predictions.arrays(*self._prediction_slice)
 
-        return sorted(return_prediction, key=lambda x: x[2], reverse=True)
+    def _own_predictions(self):
+        store = FingerprintCollection._predictions
+        return store.decode(*store.arrays(*self._prediction_slice))
 
 #    @predictions.setter
 #    def predictions(self, value):
@@ -264,21 +484,27 @@ class Fingerprint(object):
             raise ValueError('Second parameter must be a list of values')
 
         self._other_predictors[name] = values
+        self._sorted_predictions = None
 
     def load(self, thedict, db=None):
         self._uuid = thedict['uuid']
         self._cutout = Cutout.factory(thedict['cutout'])
-        self._predictions = thedict['predictions']
+        self._prediction_slice = FingerprintCollection._predictions.replace(getattr(self, '_prediction_slice', None),
+                                                                            thedict['predictions'])
         self._other_predictors = thedict['other_predictors']
+        self._sorted_predictions = None
+        embedding = thedict.get('embedding')
+        self._embedding = None if embedding is None else np.asarray(embedding, dtype=np.float32)
 
         # Add to the fingerprint collection
         FingerprintCollection._add(self)
 
-    def save(self):
+    def save(self, normalized=False):
         return {
              'uuid': self._uuid,
-             'cutout': self._cutout.save(),
+             'cutout': self._cutout.uuid if normalized else self._cutout.save(),
              'other_predictors': self._other_predictors,
              'predictions': [(x[0], x[1], float(x[2]))
-                             for x in self._predictions]
+                             for x in self._own_predictions()],
+             'embedding': None if self._embedding is None else self._embedding.tolist()
         }
@@ -0,0 +1,162 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from ..tl_logging import get_logger
+log = get_logger('fingerprint matrix')
+
+
+class FingerprintMatrix(object):
+    """
+    Matrix representation of a list of fingerprints with one row
+    per fingerprint.
+
+    For the 'predictions' feature there is one column per unique
+    prediction label (in the order the labels are first seen) and
+    the value is the prediction probability. For the 'embedding'
+    feature the rows are the fingerprint embeddings.
+    """
+
+    _features = ['predictions', 'embedding']
+    _duplicates = ['last', 'first']
+
+    def __init__(self, fingerprints, feature='predictions', sparse=False, dtype=np.float32,
+                 top=None, binary=False, duplicates='last'):
+        """
+        Build the matrix in one pass over the fingerprints.
+
+        Parameters
+        ----------
+        fingerprints : list of Fingerprint
+            The fingerprints, one per row.
+        feature : str
+            'predictions' or 'embedding'.
+        sparse : bool
+            If True the matrix is a scipy.sparse CSR matrix, otherwise a dense numpy array.
+        dtype : numpy dtype
+            Type of the values in the matrix.
+        top : int, optional
+            Only use the first ``top`` predictions of each fingerprint.
+        binary : bool
+            If True the prediction values are set to 1 (i.e., set inclusion).
+        duplicates : str
+            Which value to keep if a label is in a fingerprint more than once,
+            'last' (the same as assigning them in order) or 'first' (the highest
+            as predictions are sorted by decreasing score).
+        """
+        if feature not in self._features:
+            raise ValueError('Feature {} not one of {}'.format(feature, self._features))
+        if duplicates not in self._duplicates:
+            raise ValueError('Duplicates {} not one of {}'.format(duplicates, self._duplicates))
+
+        self._feature = feature
+        self._sparse = sparse
+        self._dtype = dtype
+        self._top = top
+        self._binary = binary
+        self._keep = duplicates
+
+        # Maps label -> column index
+        self._vocabulary = {}
+
+        if feature == 'predictions':
+            self._matrix = self._build_predictions(fingerprints)
+        else:
+            self._matrix = self._build_embedding(fingerprints)
+
+        log.debug('Built {} matrix of shape {}'.format(feature, self._matrix.shape))
+
+    #
+    # Properties
+    #
+
+    @property
+    def matrix(self):
+        return self._matrix
+
+    @property
+    def shape(self):
+        return self._matrix.shape
+
+    @property
+    def vocabulary(self):
+        """
+        Dictionary mapping each prediction label to its column.
+        """
+        return self._vocabulary
+
+    @property
+    def labels(self):
+        """
+        List of the prediction labels in column order.
+        """
+        return sorted(self._vocabulary, key=self._vocabulary.get)
+
+    #
+    # Internal methods
+    #
+
+    def _build_predictions(self, fingerprints):
+        """
+        Create the N x L matrix of prediction values, where L
+        is the number of unique labels.
+        """
+        from .fingerprint import FingerprintCollection
+
+        vocabulary = self._vocabulary
+
+        # Concatenate the prediction store ids and scores of the fingerprints
+        arrays = [fp.prediction_arrays for fp in fingerprints]
+        ids = [a[0][:self._top] for a in arrays]
+        scores = [a[1][:self._top] for a in arrays]
+
+        rows = np.repeat(np.arange(len(fingerprints), dtype=np.int64), [len(x) for x in ids])
+        ids = np.concatenate(ids).astype(np.int64) if ids else np.zeros(0, dtype=np.int64)
+        values = np.concatenate(scores).astype(self._dtype) if scores else np.zeros(0, dtype=self._dtype)
+
+        # Map the store ids to columns by label, in the order the labels are first seen.
+        entries = FingerprintCollection._predictions.entries
+        first = np.full(len(entries), len(ids), dtype=np.int64)
+        first[ids[::-1]] = np.arange(len(ids) - 1, -1, -1)
+        seen = np.flatnonzero(first < len(ids))
+
+        id_columns = np.zeros(len(entries), dtype=np.int64)
+        for vid in seen[np.argsort(first[seen], kind='stable')]:
+            id_columns[vid] = vocabulary.setdefault(entries[vid][1], len(vocabulary))
+        cols = id_columns[ids]
+
+        shape = (len(fingerprints), len(vocabulary))
+        if self._binary:
+            values = np.ones(len(values), dtype=self._dtype)
+
+        # If a label is in a fingerprint more than once then keep the
+        # last (or first) value.
+        keys = rows * shape[1] + cols
+        if self._keep == 'first':
+            _, keep = np.unique(keys, return_index=True)
+        else:
+            _, last = np.unique(keys[::-1], return_index=True)
+            keep = len(keys) - 1 - last
+        rows, cols, values = rows[keep], cols[keep], values[keep]
+
+        if self._sparse:
+            return csr_matrix((values, (rows, cols)), shape=shape, dtype=self._dtype)
+        else:
+            X = np.zeros(shape, dtype=self._dtype)
+            X[rows, cols] = values
+            return X
+
+    def _build_embedding(self, fingerprints):
+        """
+        Stack the embedding of each fingerprint into an N x D matrix.
+        """
+        embeddings = [fp.embedding for fp in fingerprints]
+
+        if any(embedding is None for embedding in embeddings):
+            raise ValueError('All fingerprints must have an embedding, calculate them with embedding=True')
+
+        X = np.vstack(embeddings).astype(self._dtype)
+
+        if self._sparse:
+            return csr_matrix(X)
+        else:
+            return X
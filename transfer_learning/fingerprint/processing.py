@@ -1,22 +1,31 @@
+import copy
 import uuid
 import time
 import numpy as np
 import weakref
+import inspect
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from transfer_learning.utils import gray2rgb
 from transfer_learning.fingerprint.fingerprint import Fingerprint, FingerprintCollection
-from transfer_learning.cutout import Cutout, CutoutCollection
+from transfer_learning.cutout import CutoutCollection
 
 from ..tl_logging import get_logger
 import logging
 log = get_logger('fingerprint processing')
 
 
-def calculate(cutouts, fc_save, task=None):
+def calculate(cutouts, fc_save, task=None, batch_size=32, prefetch=2, workers=4):
     """
     Calculate the fingerprint from a list of data.  The data
     must be of the form
          [ {'uuid': <somtehing>, 'location': <somewhere>, 'meta': {<meta data} }... ]
+
+    The cutouts are sent through the fingerprint calculator ``batch_size``
+    at a time. While the model runs on one batch, the next ``prefetch``
+    batches are loaded and processed by a pool of ``workers`` threads.
     """
     log.info('')
 
@@ -27,34 +36,93 @@ def calculate(cutouts, fc_save, task=None):
     # Load the fingerprint calculator based on dictionary information
     fc = FingerprintCalculator.load_parameters(fc_save)
 
-    # Now run through each datum and calculate the fingerprint
+    # Now run through each batch of cutouts and calculate the fingerprints
     fingerprints_collection = FingerprintCollection()
-    for ii, cutout in enumerate(cutouts):
+    for start, batch, nparrays in _prefetch_batches(cutouts, batch_size, prefetch, workers):
 
         # Update the progress if we are using the task version of this.
         if task is not None:
-            task.update_state(state='PROGRESS', meta={'progress': ii})
+            task.update_state(state='PROGRESS', meta={'progress': start})
 
-        # Load the data
-        nparray = cutout.get_data()
+        for fingerprint in _fingerprint_batch(fc, batch, nparrays, batch_size):
+            fingerprints_collection.add(fingerprint)
 
-        # Calculate the predictions
-        log.debug('calcuating predictions for  {} data is {}'.format(cutout.data.location, type(nparray)))
-        try:
-            predictions = fc.calculate(nparray)
-        except Exception as e:
-            log.error('Problem calculating predictions, {}'.format(e))
-            predictions = []
+    return fingerprints_collection
+
+
+def _fingerprint_batch(fc, batch, nparrays, batch_size=32):
+    """
+    The Fingerprints of a batch of cutouts given their data arrays.
+    """
+    log.debug('calcuating predictions for {} cutouts'.format(len(batch)))
+    try:
+        if fc.embedding:
+            batch_predictions, batch_embeddings = fc.calculate_batch(nparrays, batch_size=batch_size,
+                                                                     return_embeddings=True)
+        else:
+            batch_predictions = fc.calculate_batch(nparrays, batch_size=batch_size)
+            batch_embeddings = [None] * len(batch)
+    except Exception as e:
+        # Fall back to one at a time so a single bad cutout
+        # does not lose the predictions for the whole batch.
+        log.error('Problem calculating batch predictions, {}'.format(e))
+        results = [_calculate_single(fc, nparray) for nparray in nparrays]
+
+        # A cutout that fails has no predictions. It is skipped if embeddings are
+        # calculated, as a fingerprint without one can not be in an embedding matrix.
+        if fc.embedding:
+            batch = [cutout for cutout, result in zip(batch, results) if result is not None]
+            results = [result for result in results if result is not None]
+        batch_predictions = [[] if result is None else result[0] for result in results]
+        batch_embeddings = [None if result is None else result[1] for result in results]
+
+    fingerprints = []
+    for cutout, predictions, embedding in zip(batch, batch_predictions, batch_embeddings):
 
         # Clean the predictions so the json conversion is happy
         cleaned_predictions = [(x[0], x[1], float(x[2])) for x in predictions]
 
         log.info('calculated fingerprints {}'.format(cleaned_predictions[:10]))
 
-        # Load up the return list.
-        fingerprints_collection.add(Fingerprint(cutout=cutout, predictions=cleaned_predictions))
+        fingerprints.append(Fingerprint(cutout=cutout, predictions=cleaned_predictions, embedding=embedding))
 
-    return fingerprints_collection
+    return fingerprints
+
+
+def _prefetch_batches(cutouts, batch_size, prefetch, workers):
+    """
+    Generator that yields ``(start, batch, nparrays)`` for each batch of
+    cutouts. The data for the following ``prefetch`` batches is loaded in
+    a bounded thread pool while the caller works on the current batch.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for start in range(0, len(cutouts), batch_size):
+            batch = [cutouts[ii] for ii in range(start, min(start + batch_size, len(cutouts)))]
+            pending.append((start, batch, [executor.submit(cutout.get_data) for cutout in batch]))
+
+            if len(pending) > prefetch:
+                start, batch, futures = pending.popleft()
+                yield start, batch, [future.result() for future in futures]
+
+        while len(pending) > 0:
+            start, batch, futures = pending.popleft()
+            yield start, batch, [future.result() for future in futures]
+
+
+def _calculate_single(fc, nparray):
+    """
+    Calculate the (predictions, embedding) for one array, the embedding is None
+    unless fc.embedding. Returns None if there is a problem.
+    """
+    try:
+        if fc.embedding:
+            predictions, embeddings = fc.calculate_batch([nparray], batch_size=1, return_embeddings=True)
+            return predictions[0], embeddings[0]
+        return fc.calculate_batch([nparray], batch_size=1)[0], None
+    except Exception as e:
+        log.error('Problem calculating predictions, {}'.format(e))
+        return None
 
 
 class FingerprintCalculator:
@@ -65,6 +133,12 @@ class FingerprintCalculator:
     # already exists for that uuid, and if it does, return it, otherwise create a new one.
     _instances = set()
 
+    # Process level registry of calculators keyed by (class name, max_fingerprints, embedding)
+    # so the network for each is only built once per process, and the Futures of those being built.
+    _registry = {}
+    _registry_building = {}
+    _registry_lock = threading.Lock()
+
     @classmethod
     def getinstances(cls, search_uuid=None):
         dead = set()
@@ -77,19 +151,157 @@ class FingerprintCalculator:
         cls._instances -= dead
         return None
 
-    def __init__(self):
+    def __init__(self, embedding=False):
         self._uuid = str(uuid.uuid4())
         self._predictions = []
 
+        # If embedding is True then the pooled penultimate layer of the
+        # network is returned along with the decoded predictions.
+        self._embedding = embedding
+        self._embedding_model = None
+
         self._instances.add(weakref.ref(self))
 
     @property
     def uuid(self):
         return self._uuid
 
+    @property
+    def embedding(self):
+        return self._embedding
+
     def save(self, output_directory):
         raise NotImplementedError("Please Implement this method")
 
+    def _keras_functions(self):
+        """
+        Return the ``(preprocess_input, decode_predictions)`` pair from the
+        keras application module that matches ``self._model``.
+        """
+        raise NotImplementedError("Please Implement this method")
+
+    def calculate(self, data):
+        """
+        Calculate the predictions for a single image.
+
+        Parameters
+        ----------
+        data : numpy array
+            2D or 3D image (e.g., 224x224x3).
+
+        Return
+        ------
+        predictions : list
+            List of (class, description, probability) tuples.
+        """
+        self._predictions = self.calculate_batch([data], batch_size=1)[0]
+        return self._predictions
+
+    def calculate_batch(self, arrays, batch_size=32, return_embeddings=False):
+        """
+        Calculate the predictions for a list of images. Consecutive images
+        of the same shape are stacked into N x rows x cols x 3 tensors and
+        passed through the model ``batch_size`` at a time, so the per-call
+        overhead of ``predict`` is paid once per batch rather than once per image.
+
+        Parameters
+        ----------
+        arrays : list of numpy array
+            2D or 3D images (e.g., 224x224x3).
+        batch_size : int
+            Maximum number of images sent to the model in one call.
+        return_embeddings : bool
+            If True, also return the pooled penultimate layer output for each image.
+
+        Return
+        ------
+        predictions : list of lists
+            One list of (class, description, probability) tuples per image,
+            in the same order as ``arrays``.
+        embeddings : list of numpy array
+            Only if ``return_embeddings`` is True. One float32 vector per image.
+        """
+        preprocess_input, decode_predictions = self._keras_functions()
+
+        if return_embeddings:
+            model = self._get_embedding_model()
+            embedding_size = int(model.output_shape[0][-1])
+        else:
+            model = self._model
+
+        start_time = time.time()
+
+        predictions = []
+        embeddings = []
+        for batch in self._batches(arrays, batch_size):
+
+            # Set the data into the expected format
+            x = np.stack([gray2rgb(data) if len(data.shape) < 3 else data.astype(np.float64)
+                          for data in batch])
+
+            # Do keras model image pre-processing
+            x = preprocess_input(x)
+
+            # There was an error at one point when the image was completely 0
+            # In this case I just set a single prediction with low weight.
+            # TODO:  Check to see if this is still an issue.
+            nonzero = np.sum(np.abs(x.reshape(x.shape[0], -1)), axis=1) > 0.0001
+
+            batch_predictions = [[('test', 'beaver', 0.0000000000001), ] for _ in batch]
+            batch_embeddings = [np.zeros(embedding_size, dtype=np.float32) for _ in batch] if return_embeddings else []
+            if np.any(nonzero):
+                if return_embeddings:
+                    features, preds = model.predict(x[nonzero], batch_size=len(batch))
+                    features = features.reshape(features.shape[0], -1).astype(np.float32)
+                    for ii, feature in zip(np.flatnonzero(nonzero), features):
+                        batch_embeddings[ii] = feature
+                else:
+                    preds = model.predict(x[nonzero], batch_size=len(batch))
+
+                # decode the results into a list of tuples (class, description, probability)
+                # (one such list for each sample in the batch)
+                decoded = decode_predictions(preds, top=self._max_fingerprints)
+                for ii, prediction in zip(np.flatnonzero(nonzero), decoded):
+                    batch_predictions[ii] = prediction
+
+            predictions.extend(batch_predictions)
+            embeddings.extend(batch_embeddings)
+
+        end_time = time.time()
+        log.info('Calculate predictions for {} images took {}s'.format(len(arrays), end_time - start_time))
+
+        if return_embeddings:
+            return predictions, embeddings
+        else:
+            return predictions
+
+    def _get_embedding_model(self):
+        """
+        Model that outputs both the penultimate (pooled) layer and the
+        predictions of ``self._model`` so they come from one forward pass.
+        """
+        if self._embedding_model is None:
+            from keras.models import Model
+            self._embedding_model = Model(inputs=self._model.input,
+                                          outputs=[self._model.layers[-2].output, self._model.output])
+        return self._embedding_model
+
+    @staticmethod
+    def _batches(arrays, batch_size):
+        """
+        Split the arrays into lists of at most ``batch_size`` consecutive
+        arrays that all have the same shape (so they can be stacked).
+        """
+        batch = []
+        for data in arrays:
+            if len(batch) == batch_size or (len(batch) > 0 and batch[0].shape != data.shape):
+                yield batch
+                batch = []
+            batch.append(data)
+
+        if len(batch) > 0:
+            yield batch
+
     @staticmethod
     def select_fingerprint():
         """
@@ -123,6 +335,87 @@ class FingerprintCalculator:
             except Exception:
                 pass
 
+    @staticmethod
+    def _subclass(class_name):
+        """
+        Find the FingerprintCalculator subclass with the given name.
+        """
+        for class_ in FingerprintCalculator.__subclasses__():
+            if class_.__name__ == class_name:
+                return class_
+
+        raise ValueError('Unknown fingerprint calculator {}'.format(class_name))
+
+    @staticmethod
+    def shared(class_name, max_fingerprints=None, embedding=False):
+        """
+        Return the calculator for this process given the class name and
+        max_fingerprints. The calculator (and therefore the network weights)
+        is built the first time it is asked for and is then re-used by every
+        later call in the same process, e.g., every celery task run by a worker.
+
+        Parameters
+        ----------
+        class_name : str
+            Name of the FingerprintCalculator subclass (e.g., 'FingerprintCalculatorResnet').
+        max_fingerprints : int, optional
+            Number of predictions to keep, defaults to the default of the subclass.
+        embedding : bool
+            Whether the calculator also returns the penultimate layer embedding.
+
+        Return
+        ------
+        calculator : FingerprintCalculator
+            The shared instance.
+        """
+        class_ = FingerprintCalculator._subclass(class_name)
+
+        if max_fingerprints is None:
+            max_fingerprints = inspect.signature(class_.__init__).parameters['max_fingerprints'].default
+
+        key = (class_.__name__, max_fingerprints, embedding)
+        with FingerprintCalculator._registry_lock:
+            if key in FingerprintCalculator._registry:
+                return FingerprintCalculator._registry[key]
+
+            future = FingerprintCalculator._registry_building.get(key)
+            building = future is None
+            if building:
+                future = FingerprintCalculator._registry_building[key] = Future()
+
+        if not building:
+            return future.result()
+
+        # Build outside the lock, it takes a while and other calculators need not wait.
+        log.info('Building shared {} with max_fingerprints {} embedding {}'.format(*key))
+        try:
+            calculator = class_(max_fingerprints=max_fingerprints, embedding=embedding)
+        except BaseException as e:
+            with FingerprintCalculator._registry_lock:
+                del FingerprintCalculator._registry_building[key]
+            future.set_exception(e)
+            raise
+
+        with FingerprintCalculator._registry_lock:
+            FingerprintCalculator._registry[key] = calculator
+            del FingerprintCalculator._registry_building[key]
+        future.set_result(calculator)
+        return calculator
+
+    @staticmethod
+    def warm_up(class_names):
+        """
+        Build the shared calculators up front (e.g., when a worker process
+        starts) so the first task does not pay for loading the weights.
+
+        Parameters
+        ----------
+        class_names : list of str
+            Names of the FingerprintCalculator subclasses to build.
+        """
+        for class_name in class_names:
+            FingerprintCalculator.shared(class_name)
+
     @staticmethod
     def load_parameters(parameters):
         # First let's see if we have an instance with this UUID already created
@@ -133,16 +426,22 @@ class FingerprintCalculator:
             newinstance = None
 
         log.debug('newinstance is {}'.format(newinstance))
-        if newinstance is None:
-            # If there is not an instance with that uuid, THEN we will create a new instance of that subclass
-            for class_ in FingerprintCalculator.__subclasses__():
-                if class_.__name__ == parameters['class_name']:
-                    tt = class_()
-                    tt.load(parameters)
-                    return tt
-        else:
+        if newinstance is not None:
             return newinstance
 
+        # If there is not an instance with that uuid, THEN use the network of the shared instance of that subclass
+        shared = FingerprintCalculator.shared(parameters['class_name'], parameters.get('max_fingerprints'),
+                                              parameters.get('embedding', False))
+        if parameters['uuid'] is None:
+            return shared
+
+        # A light copy of the shared instance with the saved parameters, so it keeps the saved uuid
+        newinstance = copy.copy(shared)
+        newinstance._predictions = []
+        newinstance.load(parameters)
+        FingerprintCalculator._instances.add(weakref.ref(newinstance))
+        return newinstance
+
     def load(self, parameters):
         """
         Load the instance information from the parameters
@@ -152,12 +451,14 @@ class FingerprintCalculator:
         """
 
         self._uuid = parameters['uuid']
+        self._max_fingerprints = parameters.get('max_fingerprints', self._max_fingerprints)
+        self._embedding = parameters.get('embedding', self._embedding)
 
 
 class FingerprintCalculatorResnet(FingerprintCalculator):
 
-    def __init__(self, max_fingerprints=50):
-        super(FingerprintCalculatorResnet, self).__init__()
+    def __init__(self, max_fingerprints=50, embedding=False):
+        super(FingerprintCalculatorResnet, self).__init__(embedding=embedding)
 
         from keras.applications.resnet50 import ResNet50
 
@@ -170,57 +471,24 @@ class FingerprintCalculatorResnet(FingerprintCalculator):
     def __str__(self):
         return 'FingerprintCalculator (renet50, imagenet)'
 
-    def calculate(self, data):
-        from keras.applications.resnet50 import preprocess_input as preprocess_input
-        from keras.applications.resnet50 import decode_predictions as decode_predictions
-
-        log.debug('FingerprintCalculatorResnet: calculate')
-
-        # if self._model is None:
-        #     self._model = ResNet50(weights='imagenet')
-
-        start_time = time.time()
-
-        # Set the data into the expected format
-        if len(data.shape) < 3:
-            x = gray2rgb(data)
-        else:
-            x = data.astype(np.float64)
-
-        # Set the data into th expected format
-        x = np.expand_dims(x, axis=0)
-
-        # Do keras model image pre-processing
-        x = preprocess_input(x)
-
-        # There was an error at one point when the image was completely 0
-        # In this case I just set a single prediction with low weight.
-        # TODO:  Check to see if this is still an issue.
-        if np.sum(np.abs(x)) > 0.0001:
-            preds = self._model.predict(x)
-            # decode the results into a list of tuples (class, description, probability)
-            # (one such list for each sample in the batch)
-            self._predictions = decode_predictions(preds, top=self._max_fingerprints)[0]
-        else:
-            self._predictions = [('test', 'beaver', 0.0000000000001), ]
-
-        end_time = time.time()
-        log.debug('Top 10 redictions: {}'.format(self._predictions[:10]))
-        log.info('Calculate prediction took {}s'.format(end_time - start_time))
-
-        return self._predictions
+    def _keras_functions(self):
+        from keras.applications.resnet50 import preprocess_input
+        from keras.applications.resnet50 import decode_predictions
+        return preprocess_input, decode_predictions
 
     def save(self):
         return {
             'class_name': self.__class__.__name__,
-            'uuid': self._uuid
+            'uuid': self._uuid,
+            'max_fingerprints': self._max_fingerprints,
+            'embedding': self._embedding
         }
 
 
 class FingerprintCalculatorVGG16(FingerprintCalculator):
 
-    def __init__(self, max_fingerprints=200):
-        super(FingerprintCalculatorVGG16, self).__init__()
+    def __init__(self, max_fingerprints=200, embedding=False):
+        super(FingerprintCalculatorVGG16, self).__init__(embedding=embedding)
 
         from keras.applications.vgg16 import VGG16
         self._model = VGG16(weights='imagenet')
@@ -230,52 +498,24 @@ class FingerprintCalculatorVGG16(FingerprintCalculator):
     def __str__(self):
         return 'FingerprintCalculator (vgg16, imagenet)'
 
-    def calculate(self, data):
+    def _keras_functions(self):
         from keras.applications.vgg16 import preprocess_input
         from keras.applications.vgg16 import decode_predictions
-
-        start_time = time.time()
-
-        # Set the data into the expected format
-        if len(data.shape) < 3:
-            x = gray2rgb(data)
-        else:
-            x = data.astype(np.float64)
-
-        # Set the data into the expected format
-        x = np.expand_dims(x, axis=0)
-
-        # Do keras model image pre-processing
-        x = preprocess_input(x)
-
-        # There was an error at one point when the image was completely 0
-        # In this case I just set a single prediction with low weight.
-        # TODO:  Check to see if this is still an issue.
-        if np.sum(np.abs(x)) > 0.0001:
-            preds = self._model.predict(x)
-            # decode the results into a list of tuples (class, description, probability)
-            # (one such list for each sample in the batch)
-            self._predictions = decode_predictions(preds, top=self._max_fingerprints)[0]
-        else:
-            self._predictions = [('test', 'beaver', 0.0000000000001), ]
-
-        end_time = time.time()
-        log.debug('Predictions: {}'.format(self._predictions[:10]))
-        log.info('Calculate {} predictions took {}s'.format(len(self._predictions), end_time - start_time))
-
-        return self._predictions
+        return preprocess_input, decode_predictions
 
     def save(self):
         return {
             'class_name': self.__class__.__name__,
-            'uuid': self._uuid
+            'uuid': self._uuid,
+            'max_fingerprints': self._max_fingerprints,
+            'embedding': self._embedding
         }
 
 
 class FingerprintCalculatorVGG19(FingerprintCalculator):
 
-    def __init__(self, max_fingerprints=200):
-        super(FingerprintCalculatorVGG19, self).__init__()
+    def __init__(self, max_fingerprints=200, embedding=False):
+        super(FingerprintCalculatorVGG19, self).__init__(embedding=embedding)
 
         from keras.applications.vgg19 import VGG19
         self._model = VGG19(weights='imagenet')
@@ -285,52 +525,24 @@ class FingerprintCalculatorVGG19(FingerprintCalculator):
     def __str__(self):
         return 'FingerprintCalculator (vgg19, imagenet)'
 
-    def calculate(self, data):
+    def _keras_functions(self):
         from keras.applications.vgg19 import preprocess_input
         from keras.applications.vgg19 import decode_predictions
-
-        start_time = time.time()
-
-        # Set the data into the expected format
-        if len(data.shape) < 3:
-            x = gray2rgb(data)
-        else:
-            x = data.astype(np.float64)
-
-        # Set the data into the expected format
-        x = np.expand_dims(x, axis=0)
-
-        # Do keras model image pre-processing
-        x = preprocess_input(x)
-
-        # There was an error at one point when the image was completely 0
-        # In this case I just set a single prediction with low weight.
-        # TODO:  Check to see if this is still an issue.
-        if np.sum(np.abs(x)) > 0.0001:
-            preds = self._model.predict(x)
-            # decode the results into a list of tuples (class, description, probability)
-            # (one such list for each sample in the batch)
-            self._predictions = decode_predictions(preds, top=self._max_fingerprints)[0]
-        else:
-            self._predictions = [('test', 'beaver', 0.0000000000001), ]
-
-        end_time = time.time()
-        log.debug('Predictions: {}'.format(self._predictions[:10]))
-        log.info('Calculate {} predictions took {}s'.format(len(self._predictions), end_time - start_time))
-
-        return self._predictions
+        return preprocess_input, decode_predictions
 
     def save(self):
         return {
             'class_name': self.__class__.__name__,
-            'uuid': self._uuid
+            'uuid': self._uuid,
+            'max_fingerprints': self._max_fingerprints,
+            'embedding': self._embedding
         }
 
 
 class FingerprintCalculatorInceptionV3(FingerprintCalculator):
 
-    def __init__(self, max_fingerprints=200):
-        super(FingerprintCalculatorInceptionV3, self).__init__()
+    def __init__(self, max_fingerprints=200, embedding=False):
+        super(FingerprintCalculatorInceptionV3, self).__init__(embedding=embedding)
 
         from keras.applications.inception_v3 import InceptionV3
         self._model = InceptionV3(weights='imagenet')
@@ -340,52 +552,24 @@ class FingerprintCalculatorInceptionV3(FingerprintCalculator):
     def __str__(self):
         return 'FingerprintCalculator (inception_v3, imagenet)'
 
-    def calculate(self, data):
+    def _keras_functions(self):
         from keras.applications.inception_v3 import preprocess_input
         from keras.applications.inception_v3 import decode_predictions
-
-        start_time = time.time()
-
-        # Set the data into the expected format
-        if len(data.shape) < 3:
-            x = gray2rgb(data)
-        else:
-            x = data.astype(np.float64)
-
-        # Set the data into the expected format
-        x = np.expand_dims(x, axis=0)
-
-        # Do keras model image pre-processing
-        x = preprocess_input(x)
-
-        # There was an error at one point when the image was completely 0
-        # In this case I just set a single prediction with low weight.
-        # TODO:  Check to see if this is still an issue.
-        if np.sum(np.abs(x)) > 0.0001:
-            preds = self._model.predict(x)
-            # decode the results into a list of tuples (class, description, probability)
-            # (one such list for each sample in the batch)
-            self._predictions = decode_predictions(preds, top=self._max_fingerprints)[0]
-        else:
-            self._predictions = [('test', 'beaver', 0.0000000000001), ]
-
-        end_time = time.time()
-        log.debug('Predictions: {}'.format(self._predictions[:10]))
-        log.info('Calculate {} predictions took {}s'.format(len(self._predictions), end_time - start_time))
-
-        return self._predictions
+        return preprocess_input, decode_predictions
 
     def save(self):
         return {
             'class_name': self.__class__.__name__,
-            'uuid': self._uuid
+            'uuid': self._uuid,
+            'max_fingerprints': self._max_fingerprints,
+            'embedding': self._embedding
         }
 
 
 class FingerprintCalculatorInceptionResNetV2(FingerprintCalculator):
 
-    def __init__(self, max_fingerprints):
-        super(FingerprintCalculatorInceptionResNetV2, self).__init__()
+    def __init__(self, max_fingerprints=200, embedding=False):
+        super(FingerprintCalculatorInceptionResNetV2, self).__init__(embedding=embedding)
 
         from keras.applications.inception_resnet_v2 import InceptionResNetV2
         self._model = InceptionResNetV2(weights='imagenet')
@@ -395,43 +579,15 @@ class FingerprintCalculatorInceptionResNetV2(FingerprintCalculator):
     def __str__(self):
         return 'FingerprintCalculator (inception_resnet_v2, imagenet)'
 
-    def calculate(self, data):
+    def _keras_functions(self):
         from keras.applications.inception_resnet_v2 import preprocess_input
         from keras.applications.inception_resnet_v2 import decode_predictions
-
-        start_time = time.time()
-
-        # Set the data into the expected format
-        if len(data.shape) < 3:
-            x = gray2rgb(data)
-        else:
-            x = data.astype(np.float64)
-
-        # Set the data into the expected format
-        x = np.expand_dims(x, axis=0)
-
-        # Do keras model image pre-processing
-        x = preprocess_input(x)
-
-        # There was an error at one point when the image was completely 0
-        # In this case I just set a single prediction with low weight.
-        # TODO:  Check to see if this is still an issue.
-        if np.sum(np.abs(x)) > 0.0001:
-            preds = self._model.predict(x)
-            # decode the results into a list of tuples (class, description, probability)
-            # (one such list for each sample in the batch)
-            self._predictions = decode_predictions(preds, top=self._max_fingerprints)[0]
-        else:
-            self._predictions = [('test', 'beaver', 0.0000000000001), ]
-
-        end_time = time.time()
-        log.debug('Predictions: {}'.format(self._predictions[:10]))
-        log.info('Calculate {} predictions took {}s'.format(len(self._predictions), end_time - start_time))
-
-        return self._predictions
+        return preprocess_input, decode_predictions
 
     def save(self):
         return {
             'class_name': self.__class__.__name__,
-            'uuid': self._uuid
+            'uuid': self._uuid,
+            'max_fingerprints': self._max_fingerprints,
+            'embedding': self._embedding
         }
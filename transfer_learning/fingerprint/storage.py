@@ -0,0 +1,216 @@
+import os
+import json
+
+import numpy as np
+
+from transfer_learning.cutout import Cutout, CutoutCollection, BoundingBox
+from transfer_learning.data import Data
+
+from .fingerprint import Fingerprint, FingerprintCollection
+
+from ..tl_logging import get_logger
+log = get_logger('fingerprint storage')
+
+
+#
+# Binary layout of a list of fingerprints in a directory. Each array is a
+# .npy file (so it can be memory-mapped) and manifest.json holds the
+# rest. Data and cutouts are stored once however many fingerprints
+# refer to them, and the repeated cutout generator parameters and
+# processing are stored once per unique value.
+#
+#   manifest.json               datas, labels, cutout records, other predictors
+#   uuid.npy                    fingerprint uuids
+#   cutout.npy                  index of the cutout of each fingerprint (-1 if none)
+#   prediction_indptr.npy       predictions of fingerprint i are [indptr[i], indptr[i + 1])
+#   prediction_ids.npy          index into the manifest labels
+#   prediction_scores.npy       float32 scores
+#   embedding.npy               N x D float32, if every fingerprint has an embedding
+#   cutout_uuid.npy             cutout uuids
+#   cutout_data.npy             index into the manifest datas
+#   cutout_bounding_box.npy     C x 4 (left, right, bottom, top)
+#   cutout_record.npy           index into the manifest cutout records
+#
+
+FORMAT_VERSION = 1
+
+
+def _save_array(path, name, array):
+    np.save(os.path.join(path, '{}.npy'.format(name)), array)
+
+
+def _load_array(path, name, mmap_mode=None):
+    return np.load(os.path.join(path, '{}.npy'.format(name)), mmap_mode=mmap_mode)
+
+
+def save_fingerprints(fingerprints, path):
+    """
+    Save the fingerprints (and their cutouts and data) to the directory.
+
+    Parameters
+    ----------
+    fingerprints : list of Fingerprint
+        The fingerprints to save.
+    path : str
+        Directory, created if it does not exist.
+    """
+    log.info('Saving {} fingerprints to {}'.format(len(fingerprints), path))
+
+    os.makedirs(path, exist_ok=True)
+
+    store = FingerprintCollection._predictions
+
+    #
+    # Cutouts and data, each stored once.
+    #
+
+    cutout_index, data_index, record_index = {}, {}, {}
+    datas, records = [], []
+    cutout_uuids, cutout_data, cutout_bounding_box, cutout_record = [], [], [], []
+
+    fingerprint_cutout = np.full(len(fingerprints), -1, dtype=np.int32)
+    for ii, fp in enumerate(fingerprints):
+        cutout = fp.cutout
+        if cutout is None:
+            continue
+
+        if cutout.uuid not in cutout_index:
+            if cutout.data.uuid not in data_index:
+                data_index[cutout.data.uuid] = len(datas)
+                datas.append(cutout.data.save())
+
+            record = json.dumps({
+                'generator_parameters': cutout.generator_parameters,
+                'base_cutout_uuid': cutout._base_cutout_uuid,
+                'cutout_processing': [x.save() for x in cutout.cutout_processing]
+            }, sort_keys=True)
+
+            cutout_index[cutout.uuid] = len(cutout_uuids)
+            cutout_uuids.append(cutout.uuid)
+            cutout_data.append(data_index[cutout.data.uuid])
+            cutout_bounding_box.append(cutout.bounding_box._bounding_box)
+            if record not in record_index:
+                record_index[record] = len(records)
+                records.append(record)
+            cutout_record.append(record_index[record])
+
+        fingerprint_cutout[ii] = cutout_index[cutout.uuid]
+
+    #
+    # Predictions as CSR style arrays with ids into the labels used here.
+    #
+
+    # Only the own predictions, the other predictors are saved in the manifest
+    arrays = [fp.own_prediction_arrays for fp in fingerprints]
+    indptr = np.zeros(len(fingerprints) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(ids) for ids, _ in arrays])
+
+    ids = np.concatenate([ids for ids, _ in arrays]).astype(np.int64) if arrays else np.zeros(0, dtype=np.int64)
+    scores = np.concatenate([scores for _, scores in arrays]) if arrays else np.zeros(0, dtype=np.float32)
+    used, local_ids = np.unique(ids, return_inverse=True)
+    labels = [list(store.entries[vid]) for vid in used]
+    id_dtype = np.int16 if len(labels) <= np.iinfo(np.int16).max else np.int32
+
+    _save_array(path, 'uuid', np.array([fp.uuid for fp in fingerprints], dtype=str))
+    _save_array(path, 'cutout', fingerprint_cutout)
+    _save_array(path, 'prediction_indptr', indptr)
+    _save_array(path, 'prediction_ids', local_ids.ravel().astype(id_dtype))
+    _save_array(path, 'prediction_scores', scores.astype(np.float32))
+
+    _save_array(path, 'cutout_uuid', np.array(cutout_uuids, dtype=str))
+    _save_array(path, 'cutout_data', np.array(cutout_data, dtype=np.int32))
+    _save_array(path, 'cutout_bounding_box', np.array(cutout_bounding_box).reshape(-1, 4))
+    _save_array(path, 'cutout_record', np.array(cutout_record, dtype=np.int32))
+
+    has_embedding = len(fingerprints) > 0 and all(fp.embedding is not None for fp in fingerprints)
+    if has_embedding:
+        _save_array(path, 'embedding', np.vstack([fp.embedding for fp in fingerprints]).astype(np.float32))
+
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'n_fingerprints': len(fingerprints),
+        'datas': datas,
+        'labels': labels,
+        'cutout_records': [json.loads(record) for record in records],
+        'other_predictors': {str(ii): fp._other_predictors for ii, fp in enumerate(fingerprints)
+                             if fp._other_predictors},
+        'embedding': has_embedding
+    }
+
+    with open(os.path.join(path, 'manifest.json'), 'w') as fp:
+        json.dump(manifest, fp)
+
+
+def load_fingerprints(path, mmap_mode='r'):
+    """
+    Load the fingerprints saved with save_fingerprints(). Fingerprints, cutouts
+    and data that are already loaded are reused.
+
+    Parameters
+    ----------
+    path : str
+        Directory the fingerprints were saved to.
+    mmap_mode : str or None
+        Memory-map mode for the embeddings, None to read them into memory.
+
+    Returns
+    -------
+    list of Fingerprint
+        The fingerprints.
+    """
+    log.info('Loading fingerprints from {}'.format(path))
+
+    with open(os.path.join(path, 'manifest.json')) as fp:
+        manifest = json.load(fp)
+
+    if manifest['format_version'] > FORMAT_VERSION:
+        raise ValueError('Fingerprint format version {} is not supported'.format(manifest['format_version']))
+
+    #
+    # Data and cutouts
+    #
+
+    datas = [Data.factory(data) for data in manifest['datas']]
+    records = manifest['cutout_records']
+
+    cutout_data = _load_array(path, 'cutout_data')
+    cutout_bounding_box = _load_array(path, 'cutout_bounding_box').tolist()
+    cutout_record = _load_array(path, 'cutout_record')
+
+    cutouts = []
+    for ii, cutout_uuid in enumerate(_load_array(path, 'cutout_uuid').tolist()):
+        cutout = CutoutCollection._collection.get(cutout_uuid)
+        if cutout is None:
+            record = records[cutout_record[ii]]
+            cutout = Cutout(datas[cutout_data[ii]], BoundingBox(*cutout_bounding_box[ii]),
+                            record['generator_parameters'], record['cutout_processing'], uuid_in=cutout_uuid)
+            cutout._base_cutout_uuid = record['base_cutout_uuid']
+        cutouts.append(cutout)
+
+    #
+    # Predictions go straight into the prediction store
+    #
+
+    store = FingerprintCollection._predictions
+    indptr = _load_array(path, 'prediction_indptr')
+    label_ids = np.array([store.intern(*label) for label in manifest['labels']], dtype=np.int64)
+    ids = label_ids[_load_array(path, 'prediction_ids')]
+    scores = _load_array(path, 'prediction_scores')
+
+    embeddings = _load_array(path, 'embedding', mmap_mode) if manifest['embedding'] else None
+    other_predictors = manifest['other_predictors']
+
+    fingerprints = []
+    for ii, (fingerprint_uuid, cutout) in enumerate(zip(_load_array(path, 'uuid').tolist(),
+                                                        _load_array(path, 'cutout').tolist())):
+        fingerprint = FingerprintCollection._collection.get(fingerprint_uuid)
+        if fingerprint is None:
+            fingerprint = Fingerprint.from_store(
+                store.extend(ids[indptr[ii]:indptr[ii + 1]], scores[indptr[ii]:indptr[ii + 1]]),
+                cutout=cutouts[cutout] if cutout >= 0 else None,
+                other_predictors=other_predictors.get(str(ii)),
+                embedding=None if embeddings is None else embeddings[ii],
+                uuid_in=fingerprint_uuid)
+        fingerprints.append(fingerprint)
+
+    return fingerprints
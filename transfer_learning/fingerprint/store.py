@@ -0,0 +1,180 @@
+import threading
+
+import numpy as np
+
+from ..tl_logging import get_logger
+log = get_logger('prediction store')
+
+
+class PredictionStore(object):
+    """
+    Predictions of many fingerprints stored as two parallel arrays, an
+    interned (wnid, label) vocabulary id and a float32 score, rather than
+    a list of tuples of strings per fingerprint. Each fingerprint refers
+    to a slice of the arrays, sorted by decreasing score.
+
+    Ids are int16 and are widened to int32 if there are ever more labels
+    than int16 can hold.
+
+    The arrays only grow: replace() reuses the slice of a fingerprint whose
+    predictions are reloaded if the new ones fit, otherwise the old slice is
+    left unused and counted in wasted. Updates are thread-safe.
+    """
+
+    def __init__(self):
+        # Maps (wnid, label) -> id and id -> (wnid, label)
+        self._vocabulary = {}
+        self._entries = []
+
+        self._ids = np.empty(0, dtype=np.int16)
+        self._scores = np.empty(0, dtype=np.float32)
+        self._size = 0
+        self._wasted = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def entries(self):
+        """
+        List of the (wnid, label) of each id.
+        """
+        return self._entries
+
+    @property
+    def wasted(self):
+        """
+        Number of entries in the arrays no longer used by any fingerprint.
+        """
+        return self._wasted
+
+    #
+    # Update methods
+    #
+
+    def intern(self, wnid, label):
+        """
+        The id of the (wnid, label), added to the vocabulary if new.
+        """
+        key = (wnid, label)
+        vid = self._vocabulary.get(key)
+        if vid is not None:
+            return vid
+
+        with self._lock:
+            vid = self._vocabulary.get(key)
+            if vid is None:
+                vid = len(self._entries)
+                self._entries.append(key)
+                self._vocabulary[key] = vid
+
+                if vid > np.iinfo(self._ids.dtype).max:
+                    log.info('Widening prediction ids to int32')
+                    self._ids = self._ids.astype(np.int32)
+
+        return vid
+
+    def encode(self, predictions):
+        """
+        Convert a list of (wnid, label, score) to (ids, scores) arrays, sorted
+        by decreasing score.
+        """
+        ids = np.array([self.intern(p[0], p[1]) for p in predictions], dtype=self._ids.dtype)
+        scores = np.array([p[2] for p in predictions], dtype=np.float32)
+
+        order = np.argsort(-scores, kind='stable')
+        return ids[order], scores[order]
+
+    def add(self, predictions):
+        """
+        Append the predictions of one fingerprint.
+
+        Parameters
+        ----------
+        predictions : list
+            List of (wnid, label, score).
+
+        Returns
+        -------
+        (start, stop) : tuple of int
+            The slice of the arrays holding the predictions.
+        """
+        return self.extend(*self.encode(predictions))
+
+    def extend(self, ids, scores):
+        """
+        Append the (ids, scores) arrays of one fingerprint, which must already
+        be sorted by decreasing score.
+
+        Returns
+        -------
+        (start, stop) : tuple of int
+            The slice of the arrays holding the predictions.
+        """
+        with self._lock:
+            start, stop = self._size, self._size + len(ids)
+            if stop > len(self._ids):
+                capacity = max(stop, 2 * len(self._ids), 1024)
+                self._ids = np.resize(self._ids, capacity)
+                self._scores = np.resize(self._scores, capacity)
+
+            self._ids[start:stop] = ids
+            self._scores[start:stop] = scores
+            self._size = stop
+
+        return start, stop
+
+    def replace(self, prediction_slice, predictions):
+        """
+        Replace the predictions in the slice of one fingerprint, in place if
+        they fit and otherwise by appending them.
+
+        Parameters
+        ----------
+        prediction_slice : tuple of int or None
+            The (start, stop) of the current predictions, None to just add them.
+        predictions : list
+            List of (wnid, label, score).
+
+        Returns
+        -------
+        (start, stop) : tuple of int
+            The slice of the arrays holding the predictions.
+        """
+        if prediction_slice is None:
+            return self.add(predictions)
+
+        ids, scores = self.encode(predictions)
+        start, stop = prediction_slice
+
+        with self._lock:
+            if len(ids) > stop - start:
+                self._wasted += stop - start
+                return self.extend(ids, scores)
+
+            self._ids[start:start + len(ids)] = ids
+            self._scores[start:start + len(ids)] = scores
+            self._wasted += stop - start - len(ids)
+
+        return start, start + len(ids)
+
+    #
+    # Query methods
+    #
+
+    def arrays(self, start, stop):
+        """
+        Read only views of the (ids, scores) in the slice.
+        """
+        ids, scores = self._ids[start:stop], self._scores[start:stop]
+        ids.flags.writeable = False
+        scores.flags.writeable = False
+        return ids, scores
+
+    def decode(self, ids, scores):
+        """
+        Convert (ids, scores) arrays back to a list of (wnid, label, score).
+        """
+        entries = self._entries
+        return [(entries[vid][0], entries[vid][1], score) for vid, score in zip(ids.tolist(), scores.tolist())]
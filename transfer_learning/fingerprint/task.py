@@ -3,9 +3,11 @@ from collections import OrderedDict
 import itertools
 
 from celery import group
+from celery.signals import worker_process_init
 
-from transfer_learning.celery import app
+from transfer_learning.celery import app, c as config
 from transfer_learning.fingerprint.processing import calculate as processing_calculate
+from transfer_learning.fingerprint.processing import FingerprintCalculator
 
 from ..tl_logging import get_logger
 import logging
@@ -47,6 +49,22 @@ def calculate_celery(cutouts, fc_save):
     return list(itertools.chain(*r))
 
 
+@worker_process_init.connect
+def warm_up_fingerprint_calculators(**kwargs):
+    """
+    Build the fingerprint calculators listed in the config.ini, e.g.,
+
+        [processor]
+        fingerprint_calculators = FingerprintCalculatorResnet
+
+    when the worker process starts so the first task does not have
+    to wait for the network weights to load.
+    """
+    class_names = config.get('processor', 'fingerprint_calculators', fallback='').split()
+    log.info('Warming up fingerprint calculators {}'.format(class_names))
+    FingerprintCalculator.warm_up(class_names)
+
+
 @app.task
 def calculate_task(cutouts, fc_save):
     log.debug('app.current_task {}'.format(app.current_task))
@@ -0,0 +1,230 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from transfer_learning.fingerprint import FingerprintCollection
+from transfer_learning.fingerprint.processing import FingerprintCalculator, _fingerprint_batch
+
+from .tl_logging import get_logger
+log = get_logger('pipeline')
+
+
+# Put on a queue when the stage feeding it has finished.
+_DONE = object()
+
+
+class Pipeline(object):
+    """
+    Streaming ingestion of Data into Fingerprints. Each Data is fetched
+    (downloaded or read, decoded and processed), cut out by the cutout
+    generator and the cutouts fingerprinted in batches. The stages run
+    concurrently, connected by bounded asyncio queues, so the downloads of
+    later data overlap the inference on the cutouts of earlier data and
+    only a bounded number of images are held in memory at a time.
+
+    The blocking work runs in thread pools: ``fetch_workers`` threads for the
+    fetching and cutouts and one thread for the fingerprint calculator.
+
+    Example
+    -------
+    >>> pipeline = Pipeline(BasicCutoutGenerator(output_size=224, step_size=112),
+    ...                     FingerprintCalculatorResnet().save())
+    >>> fingerprints = pipeline.calculate(data_collection)
+    """
+
+    def __init__(self, cutout_generator, fingerprint_calculator, cutout_processing=None,
+                 batch_size=32, fetch_workers=8, queue_size=4):
+        """
+        Parameters
+        ----------
+        cutout_generator : cutout generator
+            E.g., BasicCutoutGenerator, anything with create_cutouts(data, cutout_processing).
+        fingerprint_calculator : FingerprintCalculator or dict
+            The calculator or its save() dict.
+        cutout_processing : list, optional
+            ImageProcessing applied to each cutout.
+        batch_size : int
+            Number of cutouts sent to the fingerprint calculator at a time.
+        fetch_workers : int
+            Maximum number of data fetched at the same time.
+        queue_size : int
+            Maximum number of fetched data, and of batches of cutouts, waiting
+            for the next stage.
+        """
+        if isinstance(fingerprint_calculator, dict):
+            fingerprint_calculator = FingerprintCalculator.load_parameters(fingerprint_calculator)
+
+        self._cutout_generator = cutout_generator
+        self._fingerprint_calculator = fingerprint_calculator
+        self._cutout_processing = cutout_processing
+        self._batch_size = batch_size
+        self._fetch_workers = fetch_workers
+        self._queue_size = queue_size
+
+    #
+    # Stages
+    #
+
+    async def _fetch(self, datas, data_queue, executor):
+        """
+        Fetch the data with fetch_workers at a time, in the order they finish.
+        Data that fails to load is logged and skipped.
+        """
+        loop = asyncio.get_running_loop()
+        pending = asyncio.Queue()
+        for data in datas:
+            pending.put_nowait(data)
+
+        async def worker():
+            while not pending.empty():
+                data = pending.get_nowait()
+                try:
+                    await loop.run_in_executor(executor, data.get_data)
+                except Exception as e:
+                    log.error('Problem fetching {}: {}'.format(data.location, e))
+                    continue
+                await data_queue.put(data)
+
+        await asyncio.gather(*[worker() for _ in range(self._fetch_workers)])
+        await data_queue.put(_DONE)
+
+    def _cutouts(self, data):
+        """
+        The cutouts of the data and their (processed) arrays.
+        """
+        cutouts = self._cutout_generator.create_cutouts(data, self._cutout_processing)
+        return [(cutout, cutout.get_data()) for cutout in cutouts]
+
+    async def _cut(self, data_queue, batch_queue, executor):
+        """
+        Create the cutouts of each fetched data and group them into batches.
+        """
+        loop = asyncio.get_running_loop()
+
+        batch = []
+        while True:
+            data = await data_queue.get()
+            if data is _DONE:
+                break
+
+            try:
+                cutouts = await loop.run_in_executor(executor, self._cutouts, data)
+            except Exception as e:
+                log.error('Problem creating the cutouts of {}: {}'.format(data.location, e))
+                continue
+
+            for cutout in cutouts:
+                batch.append(cutout)
+                if len(batch) == self._batch_size:
+                    await batch_queue.put(batch)
+                    batch = []
+
+        if batch:
+            await batch_queue.put(batch)
+        await batch_queue.put(_DONE)
+
+    @staticmethod
+    async def _next_batch(batch_queue, stages):
+        """
+        The next batch from the queue, raising the error of a stage that fails
+        (or is cancelled) rather than waiting for a batch that never comes.
+        """
+        # result() raises the error of a failed stage
+        for stage in stages:
+            if stage.done():
+                stage.result()
+        running = [stage for stage in stages if not stage.done()]
+
+        get = asyncio.ensure_future(batch_queue.get())
+        try:
+            while True:
+                done, _ = await asyncio.wait([get] + running, return_when=asyncio.FIRST_COMPLETED)
+                if get in done:
+                    return get.result()
+
+                for stage in done:
+                    stage.result()
+                    running.remove(stage)
+        finally:
+            get.cancel()
+
+    #
+    # Regular methods
+    #
+
+    async def stream(self, datas):
+        """
+        Asynchronous generator of the fingerprints of the data, batch by batch.
+
+        Parameters
+        ----------
+        datas : DataCollection or list of Data
+            The data to ingest.
+        """
+        loop = asyncio.get_running_loop()
+
+        data_queue = asyncio.Queue(maxsize=self._queue_size)
+        batch_queue = asyncio.Queue(maxsize=self._queue_size)
+
+        fetch_executor = ThreadPoolExecutor(max_workers=self._fetch_workers)
+        inference_executor = ThreadPoolExecutor(max_workers=1)
+
+        stages = [
+            asyncio.ensure_future(self._fetch(list(datas), data_queue, fetch_executor)),
+            asyncio.ensure_future(self._cut(data_queue, batch_queue, fetch_executor))
+        ]
+
+        try:
+            while True:
+                batch = await self._next_batch(batch_queue, stages)
+                if batch is _DONE:
+                    break
+
+                cutouts = [cutout for cutout, _ in batch]
+                arrays = [array for _, array in batch]
+                fingerprints = await loop.run_in_executor(inference_executor, _fingerprint_batch,
+                                                          self._fingerprint_calculator, cutouts, arrays,
+                                                          self._batch_size)
+                for fingerprint in fingerprints:
+                    yield fingerprint
+
+            # Raise any error from the stages
+            await asyncio.gather(*stages)
+        finally:
+            for stage in stages:
+                stage.cancel()
+            fetch_executor.shutdown(wait=False)
+            inference_executor.shutdown(wait=False)
+
+    async def run(self, datas):
+        """
+        The fingerprints of the data.
+
+        Parameters
+        ----------
+        datas : DataCollection or list of Data
+            The data to ingest.
+
+        Returns
+        -------
+        FingerprintCollection
+            The fingerprints.
+        """
+        fingerprints = FingerprintCollection()
+        async for fingerprint in self.stream(datas):
+            fingerprints.add(fingerprint)
+        return fingerprints
+
+    def calculate(self, datas):
+        """
+        Run the pipeline to completion from synchronous code, see run().
+
+        It can not be called while an event loop is running in the thread,
+        e.g., in a Jupyter notebook, where ``await pipeline.run(datas)`` is used.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.run(datas))
+
+        raise RuntimeError('Pipeline.calculate() can not be called from a running event loop, '
+                           'use "await pipeline.run(datas)" instead')
@@ -1 +1,2 @@
 from .similarity import *
+from .storage import save_similarity, load_similarity
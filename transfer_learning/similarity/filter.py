@@ -0,0 +1,241 @@
+import ast
+import sys
+import operator
+from functools import lru_cache
+
+import numpy as np
+
+from transfer_learning.data import DataCollection
+from transfer_learning.fingerprint import FingerprintMatrix
+
+from ..tl_logging import get_logger
+log = get_logger('filter')
+
+
+#
+# Fingerprint filter expressions, e.g.,
+#
+#     instrument == 'WFC3' and πgolden_retriever > 0.2 or 'spiral' in target
+#
+# are compiled once into a predicate that is evaluated against the
+# columns of a FingerprintTable and returns a boolean mask.
+#
+
+# The prefix of a name that is a prediction label rather than a meta key.
+PREDICTION_PREFIX = 'π'
+
+_comparisons = {
+    ast.Gt: operator.gt,
+    ast.Lt: operator.lt,
+    ast.GtE: operator.ge,
+    ast.LtE: operator.le
+}
+
+
+class FingerprintTable(object):
+    """
+    Columnar view of the cutout meta and the predictions of a list of
+    fingerprints. The meta columns are read directly from the
+    DataCollection MetaTable, the prediction columns are slices of a
+    sparse fingerprint x label matrix built the first time a prediction
+    is used by a filter.
+    """
+
+    def __init__(self, fingerprints, meta_table=None):
+        self._fingerprints = fingerprints
+        self._meta_table = DataCollection._meta_table if meta_table is None else meta_table
+
+        # Row in the meta table of the data of each fingerprint
+        self._meta_rows = None
+
+        # Sparse (CSC) fingerprint x label predictions and the label -> column vocabulary
+        self._predictions = None
+        self._vocabulary = None
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    def _rows(self):
+        if self._meta_rows is None:
+            cutouts = [fp.cutout for fp in self._fingerprints]
+            self._meta_rows = self._meta_table.rows([c.data.uuid if c is not None and c.data is not None else None
+                                                     for c in cutouts])
+        return self._meta_rows
+
+    def meta_column(self, key):
+        """
+        The meta values for the key, as an object array (None where missing)
+        and a float array (NaN where missing or not a number).
+
+        Raises
+        ------
+        KeyError
+            If no data has the key in its meta.
+        """
+        if key not in self._meta_table:
+            raise KeyError('Meta key {} not found'.format(key))
+
+        rows = self._rows()
+        return self._meta_table.values(key, rows), self._meta_table.numbers(key, rows)
+
+    def prediction_column(self, label):
+        """
+        Float array of the prediction value for the label, NaN where the
+        fingerprint does not have the label. If a fingerprint has the label
+        more than once the first (highest) value is used.
+        """
+        if self._predictions is None:
+            matrix = FingerprintMatrix(self._fingerprints, sparse=True, dtype=np.float64, duplicates='first')
+            self._predictions = matrix.matrix.tocsc()
+            self._vocabulary = matrix.vocabulary
+
+        column = np.full(len(self._fingerprints), np.nan)
+
+        if label in self._vocabulary:
+            jj = self._vocabulary[label]
+            start, stop = self._predictions.indptr[jj], self._predictions.indptr[jj + 1]
+            column[self._predictions.indices[start:stop]] = self._predictions.data[start:stop]
+
+        return column
+
+    def column(self, name):
+        """
+        The (values, numbers) of the prediction column for names starting with
+        PREDICTION_PREFIX, otherwise of the meta column.
+        """
+        if name.startswith(PREDICTION_PREFIX):
+            numbers = self.prediction_column(name[len(PREDICTION_PREFIX):])
+            return numbers, numbers
+        else:
+            return self.meta_column(name)
+
+
+def _compare(op, column, literal):
+    """
+    Compare the column to the literal, as a float if the literal is a number
+    and as a string otherwise. Missing (or non-numeric) values never match.
+    """
+    values, numbers = column
+
+    if isinstance(literal, (int, float)):
+        with np.errstate(invalid='ignore'):
+            return op(numbers, float(literal))
+
+    if values.dtype == object:
+        present = np.array([value is not None for value in values], dtype=bool)
+    else:
+        present = ~np.isnan(values)
+
+    mask = np.zeros(len(values), dtype=bool)
+    strings = np.array([str(value) for value in values[present]], dtype=str)
+    mask[present] = op(strings, str(literal))
+
+    return mask
+
+
+def _name(node):
+    if not isinstance(node, ast.Name):
+        raise TypeError(node)
+    return node.id
+
+
+# Before Python 3.8 literals are parsed as ast.Num and ast.Str (ast.Constant
+# does not exist before 3.6), with the value in their n and s attributes.
+if sys.version_info < (3, 8):
+    _legacy_literals = {ast.Num: 'n', ast.Str: 's'}
+else:
+    _legacy_literals = {}
+
+
+def _literal(node):
+    if type(node) in _legacy_literals:
+        value = getattr(node, _legacy_literals[type(node)])
+    elif isinstance(node, getattr(ast, 'Constant', ())):
+        value = node.value
+    else:
+        raise TypeError(node)
+
+    if isinstance(value, (int, float, str)):
+        return value
+    raise TypeError(node)
+
+
+def _compile(node):
+    """
+    Recursively convert the AST node into a function of a FingerprintTable
+    that returns a boolean mask.
+    """
+
+    #
+    #  Comparators i.e., > < >= <= ==
+    #
+
+    if isinstance(node, ast.Compare):
+        if len(node.ops) != 1:
+            raise TypeError(node)
+
+        op = node.ops[0]
+
+        if isinstance(op, ast.Eq):
+            name, literal = _name(node.left), _literal(node.comparators[0])
+            return lambda table: _compare(operator.eq, table.column(name), literal)
+
+        elif type(op) in _comparisons:
+            name, literal = _name(node.left), _literal(node.comparators[0])
+            compare = _comparisons[type(op)]
+            return lambda table: _compare(compare, table.column(name), literal)
+
+        elif isinstance(op, ast.In):
+            literal, name = str(_literal(node.left)), _name(node.comparators[0])
+            return lambda table: np.array([isinstance(value, (str, list, tuple, set, dict)) and literal in value
+                                           for value in table.column(name)[0]], dtype=bool)
+
+        raise TypeError(node)
+
+    #
+    #  Boolean operators i.e.,  And and Or
+    #
+
+    elif isinstance(node, ast.BoolOp):
+        predicates = [_compile(value) for value in node.values]
+
+        if isinstance(node.op, ast.And):
+            combine = np.logical_and
+        else:
+            combine = np.logical_or
+
+        def predicate(table):
+            mask = predicates[0](table)
+            for other in predicates[1:]:
+                mask = combine(mask, other(table))
+            return mask
+
+        return predicate
+
+    else:
+        raise TypeError(node)
+
+
+@lru_cache(maxsize=64)
+def compile_filter(expression):
+    """
+    Compile the filter expression.
+
+    Parameters
+    ----------
+    expression : str
+        The filter, comparisons of meta keys (or π prefixed prediction
+        labels) combined with 'and' and 'or'.
+
+    Returns
+    -------
+    function
+        Takes a FingerprintTable and returns the boolean mask of matching fingerprints.
+
+    Raises
+    ------
+    TypeError
+        If there is an error in the parsing of the expression.
+    """
+    log.debug('Compiling filter {}'.format(expression))
+    return _compile(ast.parse(expression, mode='eval').body)
@@ -0,0 +1,269 @@
+import importlib.util
+
+import numpy as np
+from scipy.sparse import issparse
+from scipy.spatial import cKDTree
+
+from ..tl_logging import get_logger
+log = get_logger('neighbors')
+
+
+class NeighborIndex(object):
+    """
+    Index over a set of points that returns the k nearest to a query,
+    built once so that find_similar does not have to sort every point
+    on each call.
+    """
+
+    def __init__(self, X, metric='euclidean'):
+        self._metric = metric
+        self._N = X.shape[0]
+
+    def __len__(self):
+        return self._N
+
+    def query(self, point, k, mask=None):
+        """
+        Find the k nearest points.
+
+        Parameters
+        ----------
+        point : numpy array or int
+            The query (a row index for the AdjacencyIndex).
+        k : int
+            Number of neighbours to search.
+        mask : numpy array of bool, optional
+            Only return points where the mask is True. The tree indexes
+            search the k nearest and then drop the masked ones, so can return
+            fewer than k.
+
+        Returns
+        -------
+        distances, indices : numpy arrays
+            The nearest, closest first.
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def _apply_mask(distances, indices, mask):
+        if mask is None:
+            return distances, indices
+        keep = mask[indices]
+        return distances[keep], indices[keep]
+
+
+class KDTreeIndex(NeighborIndex):
+    """
+    KD-tree for low-dimensional data, e.g., the 2D tSNE embedding.
+    """
+
+    # Minkowski p for each supported metric
+    _metrics = {
+        'euclidean': 2, 'l2': 2,
+        'cityblock': 1, 'manhattan': 1, 'l1': 1,
+        'chebyshev': np.inf
+    }
+
+    def __init__(self, X, metric='euclidean'):
+        super(KDTreeIndex, self).__init__(X, metric)
+
+        if metric not in self._metrics:
+            raise ValueError('Metric {} not one of {}'.format(metric, list(self._metrics)))
+
+        self._p = self._metrics[metric]
+        self._tree = cKDTree(np.asarray(X))
+
+    def query(self, point, k, mask=None):
+        k = min(k, self._N)
+        distances, indices = self._tree.query(np.asarray(point), k=k, p=self._p)
+        return self._apply_mask(np.atleast_1d(distances), np.atleast_1d(indices), mask)
+
+
+class BallTreeIndex(NeighborIndex):
+    """
+    Ball tree (scikit-learn) for the higher-dimensional fingerprint vectors.
+    """
+
+    # scipy names that are different in scikit-learn
+    _metric_names = {'cityblock': 'manhattan'}
+
+    def __init__(self, X, metric='euclidean'):
+        super(BallTreeIndex, self).__init__(X, metric)
+
+        from sklearn.neighbors import BallTree
+
+        if issparse(X):
+            X = X.toarray()
+
+        self._tree = BallTree(X, metric=self._metric_names.get(metric, metric))
+
+    def query(self, point, k, mask=None):
+        k = min(k, self._N)
+        distances, indices = self._tree.query(np.asarray(point).reshape(1, -1), k=k)
+        return self._apply_mask(distances[0], indices[0], mask)
+
+
+class BruteForceIndex(NeighborIndex):
+    """
+    Exact search over every point (scikit-learn), for high-dimensional data
+    where a tree is no faster. Sparse X is used as it is, without a dense copy.
+    """
+
+    def __init__(self, X, metric='euclidean'):
+        super(BruteForceIndex, self).__init__(X, metric)
+
+        from sklearn.neighbors import NearestNeighbors
+
+        self._nearest = NearestNeighbors(algorithm='brute', metric=BallTreeIndex._metric_names.get(metric, metric))
+        self._nearest.fit(X)
+
+    def query(self, point, k, mask=None):
+        k = min(k, self._N)
+        if not issparse(point):
+            point = np.asarray(point).reshape(1, -1)
+        distances, indices = self._nearest.kneighbors(point, n_neighbors=k)
+        return self._apply_mask(distances[0], indices[0], mask)
+
+
+class HNSWIndex(NeighborIndex):
+    """
+    Approximate index (hnswlib) for large sets of fingerprint vectors. The
+    returned euclidean distances are approximate in the neighbours found,
+    not in their values.
+    """
+
+    _spaces = {'euclidean': 'l2', 'sqeuclidean': 'l2', 'cosine': 'cosine'}
+
+    def __init__(self, X, metric='euclidean', ef=200, M=16):
+        super(HNSWIndex, self).__init__(X, metric)
+
+        import hnswlib
+
+        if metric not in self._spaces:
+            raise ValueError('Metric {} not one of {}'.format(metric, list(self._spaces)))
+
+        if issparse(X):
+            X = X.toarray()
+
+        self._index = hnswlib.Index(space=self._spaces[metric], dim=X.shape[1])
+        self._index.init_index(max_elements=self._N, ef_construction=ef, M=M)
+        self._index.add_items(np.asarray(X, dtype=np.float32), np.arange(self._N))
+        self._index.set_ef(ef)
+
+    def query(self, point, k, mask=None):
+        k = min(k, self._N)
+        self._index.set_ef(max(k, self._index.ef))
+        indices, distances = self._index.knn_query(np.asarray(point, dtype=np.float32).reshape(1, -1), k=k)
+
+        # hnswlib's l2 space is the squared distance
+        distances = distances[0].astype(np.float64)
+        if self._metric == 'euclidean':
+            distances = np.sqrt(distances)
+
+        return self._apply_mask(distances, indices[0].astype(np.int64), mask)
+
+
+class AdjacencyIndex(NeighborIndex):
+    """
+    Nearest neighbours read from a precomputed N x N adjacency matrix, the
+    query is a row index. The mask is applied to the row before the k best
+    are selected with argpartition, so only those are sorted.
+    """
+
+    def __init__(self, adjacency, similarity=False):
+        """
+        Parameters
+        ----------
+        adjacency : numpy array or scipy.sparse matrix
+            The N x N adjacency.
+        similarity : bool
+            True if larger values are closer (e.g., Jaccard), False for distances.
+        """
+        super(AdjacencyIndex, self).__init__(adjacency)
+        self._adjacency = adjacency
+        self._similarity = similarity
+
+    def query(self, row, k, mask=None):
+        k = min(k, self._N)
+
+        values = self._adjacency[row]
+        if issparse(values):
+            # Anything not stored in a top_k distance matrix is infinitely far.
+            dense = np.full(values.shape[1], 0.0 if self._similarity else np.inf)
+            dense[values.indices] = values.data
+            values = dense
+
+        values = np.asarray(values).ravel()
+        keys = -values if self._similarity else values
+
+        if mask is not None:
+            candidates = np.flatnonzero(mask)
+            keys = keys[candidates]
+        else:
+            candidates = np.arange(self._N)
+
+        k = min(k, len(candidates))
+        if k == 0:
+            return values[:0], candidates[:0]
+
+        inds = np.argpartition(keys, k - 1)[:k] if k < len(keys) else np.arange(len(keys))
+        inds = candidates[inds[np.argsort(keys[inds], kind='stable')]]
+
+        return values[inds], inds
+
+
+# Indexes that can be created by name, see create_index()
+_indexes = {
+    'kdtree': KDTreeIndex,
+    'balltree': BallTreeIndex,
+    'brute': BruteForceIndex,
+    'hnsw': HNSWIndex
+}
+
+# Largest number of dimensions 'auto' uses each tree for
+KDTREE_MAX_DIMENSIONS = 16
+BALLTREE_MAX_DIMENSIONS = 64
+
+
+def auto_method(n_features, metric='euclidean'):
+    """
+    The index create_index() uses for 'auto': a KD-tree for low dimensional
+    data, otherwise HNSW if hnswlib is installed, otherwise a ball tree for
+    moderate dimensions and brute force above that.
+    """
+    if n_features <= KDTREE_MAX_DIMENSIONS and metric in KDTreeIndex._metrics:
+        return 'kdtree'
+    if metric in HNSWIndex._spaces and importlib.util.find_spec('hnswlib') is not None:
+        return 'hnsw'
+    if n_features <= BALLTREE_MAX_DIMENSIONS:
+        return 'balltree'
+    return 'brute'
+
+
+def create_index(X, metric='euclidean', method='auto'):
+    """
+    Create the neighbour index for the points in X.
+
+    Parameters
+    ----------
+    X : numpy array or scipy.sparse matrix
+        N x D points.
+    metric : str
+        Distance metric (scipy naming).
+    method : str
+        'kdtree', 'balltree', 'brute', 'hnsw' or 'auto', see auto_method().
+
+    Returns
+    -------
+    NeighborIndex
+        The index.
+    """
+    if method == 'auto':
+        method = auto_method(X.shape[1], metric)
+
+    if method not in _indexes:
+        raise ValueError('Neighbor index {} not one of {}'.format(method, list(_indexes)))
+
+    log.debug('Creating {} index for {} points with metric {}'.format(method, X.shape[0], metric))
+
+    return _indexes[method](X, metric)
@@ -813,7 +813,7 @@ if __name__ == '__main__':
 
         with open('hubble_similarity_tsne.pck', 'rb') as fp:
             stsne = pickle.load(fp)
-            similarity_tsne = Similarity.factory(stsne)
+            similarity_tsne = Similarity.factory(stsne, lazy=True)
 
             sd = SimilarityDisplay(similarity_tsne)
             sd.instance().exec_()
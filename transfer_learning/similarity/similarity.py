@@ -1,21 +1,23 @@
-import ast
-import operator
 import weakref
 import uuid
-import itertools
+import multiprocessing
 
 import numpy as np
 from sklearn.manifold import TSNE
-from scipy.sparse import csc_matrix
-from scipy.spatial.distance import pdist, squareform
-from transfer_learning.fingerprint import Fingerprint
+from sklearn.neighbors import NearestNeighbors
+from scipy.sparse import csc_matrix, csr_matrix, issparse
+from scipy.spatial.distance import pdist, cdist, squareform
+from transfer_learning.cutout import BoundingBoxIndex
+from transfer_learning.fingerprint import Fingerprint, FingerprintCollection, FingerprintMatrix, LazyFingerprints
+from .filter import FingerprintTable, compile_filter
+from .neighbors import AdjacencyIndex, create_index
 
 from ..tl_logging import get_logger
 import logging
 log = get_logger('similarity', level=logging.DEBUG)
 
 
-def calculate(fingerprints, similarity_calculator, serialize_output=False):
+def calculate(fingerprints, similarity_calculator, serialize_output=False, normalized=False, **kwargs):
     """
     This function might be called locally and in that case we want to return the
     actual similarity calculator instance.  Or it might be run rmeotely (via celery)
@@ -27,6 +29,12 @@ def calculate(fingerprints, similarity_calculator, serialize_output=False):
        List of fingerprint objects to which the similarity is calculated.
     similarity_calculator : str
        String representation of the similarity calculator ('tsne', 'jaccard', 'distance')
+    serialize_output : bool
+       Return the save() dict rather than the instance.
+    normalized : bool
+       If serializing, each cutout and data is saved once and referenced by uuid.
+    kwargs : dict
+       Passed to the similarity calculator constructor (e.g., feature='embedding').
 
     Returns
     -------
@@ -38,35 +46,294 @@ def calculate(fingerprints, similarity_calculator, serialize_output=False):
 
     # Create the right similarity calculator
     if similarity_calculator == 'tsne':
-        sim = tSNE()
+        sim = tSNE(**kwargs)
     elif similarity_calculator == 'jaccard':
-        sim = Jaccard()
+        sim = Jaccard(**kwargs)
     elif similarity_calculator == 'distance':
-        sim = Distance()
+        sim = Distance(**kwargs)
 
     # Calculate the similarity
     sim.calculate(fingerprints)
 
     # Return the thing
     if serialize_output:
-        return sim.save()
+        return sim.save(normalized=normalized)
     else:
         return sim
 
 
+def _save_matrix(matrix):
+    """
+    Convert a dense or sparse (CSR) similarity matrix to something that can
+    be pickled or converted to json.
+    """
+    if isinstance(matrix, np.memmap):
+        return {
+            'format': 'npy',
+            'filename': matrix.filename
+        }
+    elif issparse(matrix):
+        matrix = csr_matrix(matrix)
+        return {
+            'format': 'csr',
+            'shape': list(matrix.shape),
+            'data': matrix.data.tolist(),
+            'indices': matrix.indices.tolist(),
+            'indptr': matrix.indptr.tolist()
+        }
+    else:
+        return matrix.tolist()
+
+
+def _load_matrix(thematrix):
+    """
+    Inverse of _save_matrix(). Arrays and sparse matrices (e.g., memory-mapped
+    by load_similarity()) are used as they are.
+    """
+    if isinstance(thematrix, np.ndarray) or issparse(thematrix):
+        return thematrix
+    elif isinstance(thematrix, dict) and thematrix.get('format') == 'csr':
+        return csr_matrix((thematrix['data'], thematrix['indices'], thematrix['indptr']),
+                          shape=tuple(thematrix['shape']))
+    elif isinstance(thematrix, dict) and thematrix.get('format') == 'npy':
+        return np.load(thematrix['filename'], mmap_mode='r')
+    else:
+        return np.array(thematrix)
+
+
+def _save_fingerprints(fingerprints, normalized=False):
+    """
+    The 'fingerprint' entry of a similarity save() dict, plus the 'cutouts'
+    and 'datas' the fingerprints refer to by uuid if normalized.
+    """
+    thedict = {'fingerprint': [fp.save(normalized=normalized) for fp in fingerprints]}
+    if normalized:
+        thedict.update(FingerprintCollection._save_records(fingerprints))
+    return thedict
+
+
+def _load_fingerprints(thedict, lazy=False):
+    """
+    Fingerprints from the similarity save() dict, already loaded Fingerprints are used as they are.
+    If lazy, each fingerprint is only created when it is first accessed.
+    """
+    if lazy:
+        return LazyFingerprints(thedict['fingerprint'], thedict.get('cutouts'), thedict.get('datas'))
+
+    FingerprintCollection._load_records(thedict)
+    return [x if isinstance(x, Fingerprint) else Fingerprint.factory(x) for x in thedict['fingerprint']]
+
+
+#
+# Blocked pairwise distances. The worker state is module level so
+# the fingerprint matrix is only sent once to each worker process.
+#
+
+_block_X = None
+_block_metric = None
+
+
+def _init_distance_block(X, metric):
+    global _block_X, _block_metric
+    _block_X = X
+    _block_metric = metric
+
+
+def _distance_block(start_stop):
+    start, stop = start_stop
+    return start, cdist(_block_X[start:stop], _block_X, metric=_block_metric)
+
+
+def blocked_distances(X, metric='euclidean', block_size=1024, n_jobs=1, top_k=None, filename=None):
+    """
+    Pairwise distances between the rows of X computed block_size rows at a
+    time so the full N x N matrix never has to be built in memory.
+
+    Parameters
+    ----------
+    X : numpy array
+        N x D matrix, one row per fingerprint.
+    metric : str
+        Any metric understood by scipy.spatial.distance.cdist.
+    block_size : int
+        Number of rows computed at a time.
+    n_jobs : int
+        Number of processes used to compute the blocks.
+    top_k : int, optional
+        If set, only keep the top_k nearest for each row and return a sparse CSR matrix.
+    filename : str, optional
+        If set (and top_k is not), write the float32 distances to this memory-mapped .npy file.
+
+    Returns
+    -------
+    distances : numpy array, numpy memmap or scipy.sparse.csr_matrix
+        The N x N distances.
+    """
+    N = X.shape[0]
+    blocks = [(start, min(start + block_size, N)) for start in range(0, N, block_size)]
+
+    if top_k is not None:
+        k = min(top_k, N)
+        indices = [None] * len(blocks)
+        data = [None] * len(blocks)
+    elif filename is not None:
+        distances = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=(N, N))
+    else:
+        distances = np.zeros((N, N))
+
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs, initializer=_init_distance_block, initargs=(X, metric))
+        results = pool.imap_unordered(_distance_block, blocks)
+    else:
+        pool = None
+        _init_distance_block(X, metric)
+        results = map(_distance_block, blocks)
+
+    try:
+        for start, block in results:
+            log.debug('Calculated distances for rows {} to {}'.format(start, start + block.shape[0]))
+
+            if top_k is not None:
+                nearest = np.argpartition(block, k - 1, axis=1)[:, :k]
+                indices[start // block_size] = nearest
+                data[start // block_size] = np.take_along_axis(block, nearest, axis=1)
+            else:
+                distances[start:start + block.shape[0]] = block
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _init_distance_block(None, None)
+
+    if top_k is not None:
+        return csr_matrix((np.concatenate(data).ravel(), np.concatenate(indices).ravel(),
+                           np.arange(0, N * k + 1, k)), shape=(N, N))
+
+    if filename is not None:
+        distances.flush()
+
+    return distances
+
+
+def _dense_distances(distances):
+    """
+    Dense version of the distances. The entries missing from a sparse (top_k)
+    matrix are NaN rather than 0, which would mean identical.
+    """
+    if not issparse(distances):
+        return distances
+
+    coo = distances.tocoo()
+    dense = np.full(coo.shape, np.nan)
+    dense[coo.row, coo.col] = coo.data
+    return dense
+
+
+def _perplexity_weights(distances, perplexity, n_steps=64):
+    """
+    Gaussian weights of each row of neighbour distances, with the bandwidth of
+    each row found by bisection so its entropy is log(perplexity). These are the
+    conditional probabilities tSNE uses for its input affinities.
+
+    Parameters
+    ----------
+    distances : numpy array
+        N x k distances to the k nearest neighbours.
+    perplexity : float
+        Effective number of neighbours, at most k.
+    n_steps : int
+        Number of bisection steps.
+
+    Returns
+    -------
+    numpy array
+        N x k weights, each row sums to 1.
+    """
+    D = np.asarray(distances, dtype=np.float64)**2
+    D = D - D.min(axis=1, keepdims=True)
+    target = np.log(min(perplexity, D.shape[1]))
+
+    beta = np.ones(len(D))
+    lower, upper = np.zeros(len(D)), np.full(len(D), np.inf)
+    for _ in range(n_steps):
+        P = np.exp(-D * beta[:, None])
+        sum_P = P.sum(axis=1)
+        entropy = np.log(sum_P) + beta * (D * P).sum(axis=1) / sum_P
+
+        # Too much entropy means the Gaussian is too wide so increase beta.
+        wide = entropy > target
+        lower = np.where(wide, beta, lower)
+        upper = np.where(wide, upper, beta)
+        beta = np.where(np.isinf(upper), 2 * beta, (lower + upper) / 2)
+
+    P = np.exp(-D * beta[:, None])
+    return P / P.sum(axis=1, keepdims=True)
+
+
+#
+# 2D embedding engines of the tSNE similarity. Each takes the (optionally
+# reduced) fingerprint matrix and returns the N x 2 embedding.
+#
+
+def _reduce_dimensions(X, n_components, random_state=None):
+    """
+    PCA of X (TruncatedSVD if X is sparse) down to n_components, if it has more.
+    """
+    if n_components is None or n_components >= min(X.shape):
+        return X
+
+    log.info('Reducing the {} matrix to {} components'.format(X.shape, n_components))
+
+    if issparse(X):
+        from sklearn.decomposition import TruncatedSVD
+        return TruncatedSVD(n_components=n_components, random_state=random_state).fit_transform(X)
+    else:
+        from sklearn.decomposition import PCA
+        return PCA(n_components=n_components, random_state=random_state).fit_transform(X)
+
+
+def _embed_tsne(X, perplexity, method, n_jobs, init, random_state):
+    # sklearn can not PCA initialize from a sparse matrix
+    if issparse(X) and init == 'pca':
+        X = X.toarray()
+
+    # n_jobs is only passed when set, TSNE only has it from scikit-learn 0.22.
+    kwargs = {} if n_jobs is None else {'n_jobs': n_jobs}
+    return TSNE(n_components=2, perplexity=min(perplexity, X.shape[0] - 1), method=method,
+                init=init, random_state=random_state, **kwargs).fit_transform(X)
+
+
+def _embed_umap(X, perplexity, method, n_jobs, init, random_state):
+    import umap
+
+    # The perplexity is used as the number of neighbours, the nearest UMAP equivalent.
+    kwargs = {} if n_jobs is None else {'n_jobs': n_jobs}
+    return umap.UMAP(n_components=2, n_neighbors=max(2, min(int(perplexity), X.shape[0] - 1)),
+                     random_state=random_state, **kwargs).fit_transform(X)
+
+
+_embedding_engines = {
+    'tsne': _embed_tsne,
+    'umap': _embed_umap
+}
+
+
 class Similarity:
 
     _similarity_collection = weakref.WeakValueDictionary()
 
+    # Fingerprint features a similarity can be calculated from.
+    _features = ['predictions', 'embedding']
+
     @staticmethod
-    def factory(thedict):
+    def factory(thedict, lazy=False):
 
         for sc in Similarity.__subclasses__():
             print('Comparing {} {}'.format(sc._similarity_type, thedict['similarity_type']))
             if sc._similarity_type == thedict['similarity_type']:
                 print('          same')
                 sim = sc()
-                sim.load(thedict)
+                sim.load(thedict, lazy=lazy)
 
         return sim
 
@@ -111,9 +378,16 @@ class Similarity:
 
         self._similarity_collection[self._uuid] = self
 
-        # These are the inds that will be used in the return
-        # If empty, then send all.
-        self._fingerprint_filter_inds = []
+        # These are the inds that will be used in the return, both as
+        # the sorted indices and a boolean mask. If None, then send all.
+        self._fingerprint_filter_inds = None
+        self._fingerprint_filter_mask = None
+
+        # Built when find_similar does not allow overlapping bounding boxes.
+        self._bounding_box_index = None
+
+        # Meta and prediction columns used by set_filter_fingerprints.
+        self._filter_table = None
 
     def __str__(self):
         return 'Similarity {} based on {}...'.format(
@@ -184,195 +458,155 @@ class Similarity:
     def load(self, thedict):
         raise Exception('load function must be defined in subclass')
 
-    def set_filter_fingerprints(self, thefilter):
-        """
-        Return a list of all indices that match the string items
-        in the list.
+    def _save_parameters(self):
+        raise Exception('_save_parameters function must be defined in subclass')
 
-        Currently this is just an inclusive thing but in the future
-        might need to change to have exclusion as well.
+    def _set_filter_inds(self, inds=None):
+        """
+        Set the fingerprints used in the display and find_similar.
 
         Parameters
-        -----------
-        thelist : list
-            List of strings of things to look for in the meta.
-
-        overlapping_bounding_boxes : bool
-            Allow overlapping bounding boxes
-
+        ----------
+        inds : list of int, optional
+            Indices of the fingerprints to use, None for all of them.
         """
-        log.info('filter is {}'.format(thefilter))
-
-        #
-        # If nothing in the list, then show everything
-        #
-
-        if len(thefilter) == 0:
-            self._fingerprint_filter_inds = list(range(len(self._fingerprints)))
-
-        #
-        # Otherwise how a subset.
-        #
+        self._fingerprint_filter_mask = np.zeros(len(self._fingerprints), dtype=bool)
 
+        if inds is None:
+            self._fingerprint_filter_mask[:] = True
         else:
-            # This is the meat of the filtering, and rgith now just looks to see
-            # if any of the string elements in "thelist" are found within some
-            # subset of the value of the meta in data.
-
-            metas = [dict(list(x.cutout.data.meta.items())+[('id_number', ii), ('predictions', x.predictions)])
-                     for ii, x in enumerate(self._fingerprints)]
+            self._fingerprint_filter_mask[np.asarray(inds, dtype=np.int64)] = True
 
-            filtered_metas = self._eval_expr(thefilter, metas)
-            self._fingerprint_filter_inds = [x['id_number'] for x in filtered_metas]
-
-        return len(self._fingerprint_filter_inds)
-    #
-    # Next section are methods for parsing the fingerprint meta and predictions
-    # for updating the display.
-    #
+        self._fingerprint_filter_inds = np.flatnonzero(self._fingerprint_filter_mask)
 
-    def _eval_expr(self, expr, tdict):
-        return self.eval_(ast.parse(expr, mode='eval').body, tdict)
-
-    def dp(self, meta, key):
+    def _filtered_inds(self):
         """
-        This method determines if the key is a prediction query
-        or just a regular meta lookup.
+        Indices of the filtered fingerprints, None if none are filtered out so
+        data_filtered can return the data itself rather than a (fancy indexed)
+        copy, which would read all of a memory-mapped adjacency.
         """
+        if self._fingerprint_filter_mask is None or self._fingerprint_filter_mask.all():
+            return None
+        return self._fingerprint_filter_inds
 
-        # Prediction query
-        if key.startswith('π'):
-            _, k = key.split('π')
-            return next((p[2] for p in meta['predictions'] if p[1] == k), None)
-
-        # Meta dictionary lookup
-        else:
-            return meta[key]
-
-    def _compare(self, op, node, tdict):
-        tocompare = self.eval_(node.comparators[0], tdict)
-        if isinstance(tocompare, (int, float)):
-            cast = float
-        else:
-            cast = str
-        return [x for x in tdict
-                if(self.dp(x, str(node.left.id)) is not None and
-                   op(cast(self.dp(x, str(node.left.id))), cast(self.eval_(node.comparators[0], tdict)))
-                   )
-                ]
+    def _reset_filter(self):
+        """
+        Reset the filter (and the bounding box index and filter table) after the fingerprints change.
+        """
+        self._bounding_box_index = None
+        self._filter_table = None
+        self._set_filter_inds()
 
-    def eval_(self, node, tdict):
+    def _select_similar(self, neighbor_index, query, n, allow_overlapping_bounding_boxes):
         """
-        Recursive node evaulator that was modeled after some code on the
-        internets.
+        Select the n nearest fingerprints that are in the filter (and optionally
+        do not overlap each other). The neighbour index is queried for a growing
+        number of neighbours, masked by the filter, rather than sorting all the
+        fingerprints.
 
         Parameters
-        -----------
-        node : ast.node.Node
-            A Python AST node.
-
-        tdict : List of dicts
-            List of dictionaries that contain the fingerprint info.
-
-        Raises
-        ------
-        TypeError
-            If there is an error in the parsing of the original query.
+        ----------
+        neighbor_index : NeighborIndex
+            Index built after calculate / load.
+        query : numpy array or int
+            The query passed to the index.
+        n : int
+            Number to return.
+        allow_overlapping_bounding_boxes: bool
+            Whether to allow overlapping bb or not.
 
+        Returns
+        -------
+        list
+            List of (index, distance) tuples, nearest first.
         """
+        N = len(neighbor_index)
+        k = min(N, 4 * n)
 
-        #
-        # Number
-        #
-
-        if isinstance(node, ast.Num):  # <number>
-            return node.n
+        if not allow_overlapping_bounding_boxes and self._bounding_box_index is None:
+            if isinstance(self._fingerprints, LazyFingerprints):
+                # From the records, so the fingerprints are not all loaded
+                self._bounding_box_index = BoundingBoxIndex.from_bounding_boxes(*self._fingerprints.bounding_boxes())
+            else:
+                self._bounding_box_index = BoundingBoxIndex([fp.cutout for fp in self._fingerprints])
 
-        #
-        #  String
-        #
+        while True:
+            distances, indices = neighbor_index.query(query, k, mask=self._fingerprint_filter_mask)
 
-        elif isinstance(node, ast.Str):  # <operator> <operand> e.g., -1
-            return node.s
+            selected = []
+            for distance, ind in zip(distances, indices):
 
-        #
-        #  Comparators i.e., > < >= <= ==
-        #
+                # Check to see if we allow overlapping bounding boxes
+                # If not, make sure this one doesn't overlap with any from the same image so far.
+                if(allow_overlapping_bounding_boxes or
+                   not self._bounding_box_index.overlaps(ind, [ii for ii, _ in selected])):
+                    selected.append((int(ind), distance))
+                    if len(selected) == n:
+                        return selected
 
-        elif isinstance(node, ast.Compare):  # <operator> <operand> e.g., -1
-            if isinstance(node.ops[0], ast.Eq):
-                return [x for x in tdict if x[str(node.left.id)] == self.eval_(node.comparators[0], tdict)]
+            if k >= N:
+                return selected
 
-            elif isinstance(node.ops[0], ast.Gt):
-                return self._compare(operator.gt, node, tdict)
+            k = min(N, 4 * k)
 
-            elif isinstance(node.ops[0], ast.Lt):
-                return self._compare(operator.lt, node, tdict)
+    def set_filter_fingerprints(self, thefilter):
+        """
+        Set the fingerprints to use based on a filter expression over
+        the meta and predictions (see filter.compile_filter).
 
-            elif isinstance(node.ops[0], ast.GtE):
-                return self._compare(operator.gte, node, tdict)
+        Currently this is just an inclusive thing but in the future
+        might need to change to have exclusion as well.
 
-            elif isinstance(node.ops[0], ast.LtE):
-                return self._compare(operator.lte, node, tdict)
+        Parameters
+        -----------
+        thefilter : str
+            The filter expression, empty to use all the fingerprints.
 
-            elif isinstance(node.ops[0], ast.In):
-                return [x for x in tdict if str(node.left.s) in x[node.comparators[0].id]]
+        Returns
+        -------
+        int
+            The number of fingerprints left.
+        """
+        log.info('filter is {}'.format(thefilter))
 
         #
-        #  Boolean operators i.e.,  And and Or
+        # If nothing in the list, then show everything
         #
 
-        elif isinstance(node, ast.BoolOp):  # <operator> <operand> e.g., -1
-
-            #
-            # And
-            #  Creating sets would be great, but dictionaries aren't hashable
-            #  so had to do this based on an 'id_number' being injected into the dicts
-            #
-
-            if isinstance(node.op, ast.And):
-                """
-                Dictionaries must be injected with a key 'id_number' that has a unique value.
-                """
-
-                #
-                # Create a list of lists of id_number
-                #
-
-                id_numbers = []
-                for ii in range(len(node.values)):
-                    li = self.eval_(node.values[ii], tdict)
-                    id_numbers.append(set([x['id_number'] for x in li]))
-
-                #
-                #  Now need to determine the ones common in each
-                #
-
-                u = set.intersection(*id_numbers)
+        if len(thefilter) == 0:
+            self._set_filter_inds()
 
-                return [x for x in li if x['id_number'] in u]
+        #
+        # Otherwise how a subset.
+        #
 
-            #
-            # Or
-            #
+        else:
+            # The expression is compiled once and evaluated over the columns
+            # of the (cached) meta and prediction table.
+            if self._filter_table is None:
+                self._filter_table = FingerprintTable(self._fingerprints)
 
-            if isinstance(node.op, ast.Or):
-                id_numbers = set()
-                toreturn = []
-                for nv in node.values:
-                    li = self.eval_(nv, tdict)
-                    toreturn = toreturn + [x for x in li
-                                           if x['id_number'] not in id_numbers and not id_numbers.add(x['id_number'])]
-                return toreturn
+            mask = compile_filter(thefilter)(self._filter_table)
+            self._set_filter_inds(np.flatnonzero(mask))
 
-        else:
-            raise TypeError(node)
+        return len(self._fingerprint_filter_inds)
 
 
 class tSNE(Similarity):
 
     _similarity_type = 'tsne'
 
+    # Options of the 2D embedding, see _embedding_engines
+    _embedding_defaults = {
+        'engine': 'tsne',
+        'perplexity': 30.0,
+        'method': 'barnes_hut',
+        'n_jobs': None,
+        'init': 'pca',
+        'reduce_components': None,
+        'random_state': None
+    }
+
     def __init__(self, *args, **kwargs):
         """
         This function might be called locally and in that case we want to return the
@@ -383,6 +617,23 @@ class tSNE(Similarity):
         ----------
         display_type : string
            String representation of the display, can be 'plot', 'hexbin'.
+        feature : string
+           Fingerprint feature to embed, 'predictions' (default) or 'embedding'.
+        engine : string
+           'tsne' (sklearn, default) or 'umap' (if umap-learn is installed).
+        perplexity : float
+           tSNE perplexity, or the number of neighbours for UMAP.
+        method : string
+           sklearn tSNE gradient method, 'barnes_hut' (default) or 'exact'.
+        n_jobs : int
+           Number of parallel jobs of the engine, needs scikit-learn 0.22 for tsne.
+        init : string
+           tSNE initialization, 'pca' (default) or 'random'.
+        reduce_components : int
+           If set, reduce the fingerprint matrix to this many components (PCA,
+           or TruncatedSVD if sparse) before the embedding.
+        random_state : int
+           Seed of the embedding.
 
         Returns
         -------
@@ -397,6 +648,9 @@ class tSNE(Similarity):
         else:
             display_type = 'plot'
 
+        feature = kwargs.pop('feature', 'predictions')
+        embedding = {key: kwargs.pop(key, value) for key, value in tSNE._embedding_defaults.items()}
+
         super().__init__(tSNE._similarity_type, *args, **kwargs)
         log.info('Created {}'.format(self._similarity_type))
 
@@ -405,6 +659,15 @@ class tSNE(Similarity):
         self._fingerprints = []
         self._filename_index = []
         self._distance_measure = 'l2'
+        self._neighbor_index = None
+
+        if feature not in self._features:
+            raise ValueError('Feature {} not one of {}'.format(feature, self._features))
+        self._feature = feature
+
+        if embedding['engine'] not in _embedding_engines:
+            raise ValueError('Engine {} not one of {}'.format(embedding['engine'], list(_embedding_engines)))
+        self._embedding = embedding
 
         # Display types
         self._display_type = display_type
@@ -425,7 +688,10 @@ class tSNE(Similarity):
 
     @property
     def data_filtered(self):
-        return self._Y[self._fingerprint_filter_inds]
+        inds = self._filtered_inds()
+        if inds is None:
+            return self._Y
+        return self._Y[inds]
 
     #
     #  Calculation Methods
@@ -453,62 +719,102 @@ class tSNE(Similarity):
         if self._fingerprint_filter is not None:
             fingerprints = self._fingerprint_filter(fingerprints)
 
+        self._fingerprints.extend(fingerprints)
+
+        X = FingerprintMatrix(fingerprints, feature=self._feature).matrix
+
+        log.debug('X is {}'.format(X))
+        log.debug('Fingerprint list {}'.format(self._fingerprints))
+
         #
-        # Calculate the unique labels
+        # Compute the tSNE of the data.
         #
 
-        labels = []
-        values = {}
-        for ii, fp in enumerate(fingerprints):
-            log.debug('    fingerprint is {}'.format(fp))
+        log.info('Calculating the {} embedding...'.format(self._embedding['engine']))
+        self._Y = self._embed(X)
+        log.debug('self._Y is {}'.format(self._Y))
+        log.info('Done calculation')
 
-            #
-            # Add to unique label list
-            #
+        self._reset_filter()
+        self._build_neighbor_index()
 
-            labels.extend([pred[1] for pred in fp.predictions if pred[1] not in labels])
+    def _embed(self, X):
+        """
+        The 2D embedding of the fingerprint matrix with the engine options.
+        """
+        options = dict(self._embedding)
+        engine = _embedding_engines[options.pop('engine')]
+        X = _reduce_dimensions(X, options.pop('reduce_components'), options['random_state'])
+        return engine(X, **options)
 
-            #
-            # Store the predictions for next processing
-            #
+    def add_fingerprints(self, fingerprints, n_neighbors=10, perplexity=None):
+        """
+        Place new fingerprints into the existing tSNE embedding without moving
+        the existing points. Each new point is the mean of the tSNE points of its
+        nearest existing fingerprints (in the feature space), weighted by the
+        perplexity calibrated Gaussian that tSNE uses for its affinities. If
+        there is no embedding yet then it is calculated.
 
-            values[ii] = fp.predictions
+        Parameters
+        ----------
+        fingerprints : list of Fingerprint instances
+           The new fingerprints.
+        n_neighbors : int
+           Number of existing fingerprints each new one is placed relative to.
+        perplexity : float
+           Effective number of those neighbours, at most n_neighbors. The
+           perplexity of the embedding if not set.
 
-            self._fingerprints.append(fp)
-        log.info('Unique labels {}'.format(labels))
+        Returns
+        -------
+        N/A
+        """
+        if self._Y is None:
+            self.calculate(fingerprints)
+            return
 
-        #
-        # Set up the similarity matrix X based on the predictions
-        #
+        log.info('Adding {} fingerprints to the tSNE of {}'.format(len(fingerprints), len(self._fingerprints)))
+
+        if self._fingerprint_filter is not None:
+            fingerprints = self._fingerprint_filter(fingerprints)
 
-        X = np.zeros((len(fingerprints), len(labels)))
-        for ii, fp in enumerate(fingerprints):
-            inds = [labels.index(prediction[1]) for prediction in values[ii]]
-            X[ii][inds] = [prediction[2] for prediction in values[ii]]
+        if len(fingerprints) == 0:
+            return
 
-        log.debug('X is {}'.format(X))
-        log.debug('Fingerprint list {}'.format(self._fingerprints))
+        # Build the matrix over all the fingerprints so the prediction columns line up.
+        existing = list(self._fingerprints)
+        X = FingerprintMatrix(existing + list(fingerprints), feature=self._feature,
+                              sparse=self._feature == 'predictions').matrix
+        X_existing, X_new = X[:len(existing)], X[len(existing):]
 
-        #
-        # Compute the tSNE of the data.
-        #
+        nearest = NearestNeighbors(n_neighbors=min(n_neighbors, len(existing))).fit(X_existing)
+        distances, indices = nearest.kneighbors(X_new)
+        weights = _perplexity_weights(distances, perplexity or self._embedding['perplexity'])
 
-        log.info('Calculating the tSNE...')
-        self._Y = TSNE(n_components=2).fit_transform(X)
-        log.debug('self._Y is {}'.format(self._Y))
-        log.info('Done calculation')
+        self._fingerprints.extend(fingerprints)
+        self._Y = np.vstack([self._Y, np.einsum('ij,ijk->ik', weights, self._Y[indices])])
+
+        self._reset_filter()
+        self._build_neighbor_index()
+
+    def _build_neighbor_index(self):
+        """
+        Build the KD-tree over the tSNE points used by find_similar.
+        """
+        self._neighbor_index = create_index(self._Y, metric=self._distance_measure, method='kdtree')
 
     #
     #  Utility Methods
     #
 
-    def save(self):
+    def save(self, normalized=False):
         """
         Save function converts the instance to a dict.
 
         Parameters
         ----------
-        None
+        normalized : bool
+            Save each cutout and data once and refer to them by uuid.
 
         Returns
         -------
@@ -520,13 +826,18 @@ class tSNE(Similarity):
             'uuid': self._uuid,
             'similarity_type': self._similarity_type,
             'similarity': self._Y.tolist(),
-            'fingerprint': [fp.save() for fp in self._fingerprints],
-            'parameters': {
-                'distance_measure': self._distance_measure
-            }
+            **_save_fingerprints(self._fingerprints, normalized),
+            'parameters': self._save_parameters()
         }
 
-    def load(self, thedict, db=None):
+    def _save_parameters(self):
+        return {
+            'distance_measure': self._distance_measure,
+            'feature': self._feature,
+            'embedding': self._embedding
+        }
+
+    def load(self, thedict, db=None, lazy=False):
         """
         Reload the internal variables from the dictionary.
 
@@ -536,6 +847,9 @@ class tSNE(Similarity):
             The first parameter.
         db : str
             database object
+        lazy : bool
+            Only create each fingerprint (and its cutout and data) when it is first
+            used, and build the neighbour index on the first find_similar.
 
         Returns
         -------
@@ -545,12 +859,18 @@ class tSNE(Similarity):
 
         self._uuid = thedict['uuid']
         self._similarity_type = thedict['similarity_type']
-        self._Y = np.array(thedict['similarity'])
-        self._fingerprints = [Fingerprint.factory(x) for x in thedict['fingerprint']]
+        self._Y = _load_matrix(thedict['similarity'])
+        self._fingerprints = _load_fingerprints(thedict, lazy)
         self._parameters = thedict['parameters']
         self._distance_measure = self._parameters['distance_measure']
+        self._feature = self._parameters.get('feature', 'predictions')
+        self._embedding = dict(tSNE._embedding_defaults, **self._parameters.get('embedding', {}))
+
+        self._reset_filter()
 
-        self._fingerprint_filter_inds = list(range(len(self._fingerprints)))
+        self._neighbor_index = None
+        if not lazy:
+            self._build_neighbor_index()
 
     #
     #  Display methods
@@ -619,6 +939,9 @@ class tSNE(Similarity):
                 log.error('ERROR: No definition for {} so using {} instead.'.format(
                     distance_measure, self._distance_measure))
 
+            if self._Y is not None:
+                self._build_neighbor_index()
+
     def display(self, tsne_axis):
         """
         Display the plot into the matplotlib axis in the
@@ -705,34 +1028,19 @@ class tSNE(Similarity):
         """
         log.info('')
 
-        if self._fingerprint_filter_inds is None:
-            self._fingerprint_filter_inds = list(range(len(self._fingerprints)))
-
-        distances = self._distance_measures[self._distance_measure](self._Y, point)
+        if self._fingerprint_filter_mask is None:
+            self._set_filter_inds()
 
-        log.debug('Filtering based, n distances {}  n filter_inds {}'.format(
-                  len(distances), len(self._fingerprint_filter_inds)))
+        if self._neighbor_index is None:
+            self._build_neighbor_index()
 
-        inds = []
-        for ind in np.argsort(distances):
+        selected = self._select_similar(self._neighbor_index, point, n, allow_overlapping_bounding_boxes)
 
-            # First, make sure this index is one of the filtered ones.
-            if ind in self._fingerprint_filter_inds:
-
-                # Next check to see if we allow overlapping bounding boxes
-                # If not, make sure this one doesn't overlap with any in the list so far.
-                if(allow_overlapping_bounding_boxes or
-                   not any([self._fingerprints[ind].cutout.bounding_box.overlap(self._fingerprints[ii].cutout.bounding_box) for ii in inds])):
-                    inds.append(ind)
-                    if len(inds) == n:
-                        break
-
-        # Now we want to look only in the "search_inds" if that is passed in
         return [{
                     'tsne_point': self._Y[ind],
-                    'distance': distances[ind],
+                    'distance': distance,
                     'fingerprint': self._fingerprints[ind]
-                } for ind in inds[:n]]
+                } for ind, distance in selected]
 
     def cutout_point(self, cutout):
         """
@@ -807,10 +1115,13 @@ class Jaccard(Similarity):
 
     _similarity_type = 'jaccard'
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, top_k=None, block_size=1024, *args, **kwargs):
         """
         Create the empty instance of the similarity measure.
 
+        :param top_k: If set, only keep the top_k most similar fingerprints for each
+                      fingerprint and store the adjacency as a sparse matrix.
+        :param block_size: Number of rows computed at a time when top_k is set.
         :param args:
         :param kwargs:
         """
@@ -822,22 +1133,29 @@ class Jaccard(Similarity):
         self._fingerprints = []
         self._filename_index = []
         self._fingerprint_adjacency = None
+        self._neighbor_index = None
         self._predictions = []
 
         # Top n_predictions to use in the jaccard comparison
         # TODO: This might be good to be a funciton of # of fingerprints (?)
         self._n_predictions = 10
 
+        self._top_k = top_k
+        self._block_size = block_size
+
     @property
     def data(self):
         return self._fingerprint_adjacency
 
     @property
     def data_filtered(self):
-        if self._fingerprint_filter_inds:
-            return self._fingerprint_adjacency[self._fingerprint_filter_inds, :][:, self._fingerprint_filter_inds]
+        inds = self._filtered_inds()
+        if inds is not None:
+            data = self._fingerprint_adjacency[inds, :][:, inds]
         else:
-            return self._fingerprint_adjacency
+            data = self._fingerprint_adjacency
+
+        return data.toarray() if issparse(data) else data
 
     #
     # Calculation Methods
@@ -859,17 +1177,24 @@ class Jaccard(Similarity):
 
         self._fingerprints = fingerprints
 
-        self._predictions = [set([tt[1] for tt in fp.predictions[:self._n_predictions]]) for fp in fingerprints]
+        # Sparse N x L set inclusion matrix of the top labels in each fingerprint
+        incidence = FingerprintMatrix(fingerprints, sparse=True, dtype=np.float64,
+                                      top=self._n_predictions, binary=True).matrix
 
-        up = list(set(list(itertools.chain(*[list(x) for x in self._predictions]))))
+        if self._top_k is None:
+            sparse_adjacency = csc_matrix(incidence.T)
+            self._fingerprint_adjacency = self.jaccard_similarities(sparse_adjacency).toarray().T
+        else:
+            self._fingerprint_adjacency = self.top_k_jaccard_similarities(incidence, self._top_k, self._block_size)
 
-        A = np.zeros((len(self._predictions), len(up)))
-        for ii, prediction in enumerate(self._predictions):
-            indices = [up.index(x) for x in prediction]
-            A[ii, indices] = 1.0
+        self._reset_filter()
+        self._build_neighbor_index()
 
-        sparse_adjacency = csc_matrix(A.transpose())
-        self._fingerprint_adjacency = self.jaccard_similarities(sparse_adjacency).toarray().T
+    def _build_neighbor_index(self):
+        """
+        Index the adjacency rows (most similar first) for find_similar.
+        """
+        self._neighbor_index = AdjacencyIndex(self._fingerprint_adjacency, similarity=True)
 
     def jaccard_similarities(self, mat):
         """
@@ -895,6 +1220,53 @@ class Jaccard(Similarity):
 
         return similarities
 
+    def top_k_jaccard_similarities(self, incidence, top_k, block_size=1024):
+        """
+        Compute the jaccard similarities but only keep the top_k largest for
+        each row. The rows are computed block_size at a time so memory stays
+        O(N * top_k) rather than O(N^2).
+
+        :param incidence: Sparse N x L matrix that defines set inclusion for all unique labels.
+        :param top_k: Number of similarities to keep for each row.
+        :param block_size: Number of rows to compute at a time.
+        :return: Sparse N x N CSR matrix of the top_k Jaccard similarities for each row.
+        """
+        log.debug('Calculate the top {} Jaccard_similarities'.format(top_k))
+
+        incidence = csr_matrix(incidence)
+        incidence_t = incidence.T.tocsc()
+        set_sizes = incidence.getnnz(axis=1)
+        N = incidence.shape[0]
+
+        indptr = [0]
+        indices = []
+        data = []
+        for start in range(0, N, block_size):
+            stop = min(start + block_size, N)
+
+            # Size of the intersection for every pair in this block of rows.
+            intersection = csr_matrix(incidence[start:stop] * incidence_t)
+
+            rows = start + np.repeat(np.arange(stop - start), np.diff(intersection.indptr))
+            similarity = intersection.data / (set_sizes[rows] + set_sizes[intersection.indices] - intersection.data)
+
+            for ii in range(stop - start):
+                lo, hi = intersection.indptr[ii], intersection.indptr[ii + 1]
+                row_indices = intersection.indices[lo:hi]
+                row_similarity = similarity[lo:hi]
+
+                if len(row_similarity) > top_k:
+                    keep = np.argpartition(-row_similarity, top_k - 1)[:top_k]
+                    row_indices, row_similarity = row_indices[keep], row_similarity[keep]
+
+                indices.append(row_indices)
+                data.append(row_similarity)
+                indptr.append(indptr[-1] + len(row_indices))
+
+        return csr_matrix((np.concatenate(data) if data else np.zeros(0),
+                           np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32),
+                           indptr), shape=(N, N))
+
     #
     #  Display Methods
     #
@@ -909,7 +1281,8 @@ class Jaccard(Similarity):
         :return:
         """
 
-        tsne_axis.imshow(self._fingerprint_adjacency, origin='upper')
+        adjacency = self._fingerprint_adjacency
+        tsne_axis.imshow(adjacency.toarray() if issparse(adjacency) else adjacency, origin='upper')
         tsne_axis.grid('on')
         tsne_axis.set_title('Jaccard')
 
@@ -936,8 +1309,8 @@ class Jaccard(Similarity):
         """
         log.info('')
 
-        if self._fingerprint_filter_inds is None:
-            self._fingerprint_filter_inds = list(range(len(self._fingerprints)))
+        if self._fingerprint_filter_mask is None:
+            self._set_filter_inds()
 
         row, col = int(point[0]), int(point[1])
 
@@ -945,32 +1318,19 @@ class Jaccard(Similarity):
         # therefore we will need to map the point back to the full set.
         row = self._fingerprint_filter_inds[row]
 
-        # find the Main fingerprint for this point in the image
-        distances = self._fingerprint_adjacency[row]
-        log.debug('length of dsistances is {}'.format(len(distances)))
-
-        inds = []
-        for ind in np.argsort(distances):
+        if self._neighbor_index is None:
+            self._build_neighbor_index()
 
-            # First, make sure this index is one of the filtered ones.
-            if ind in self._fingerprint_filter_inds:
-
-                # Next check to see if we allow overlapping bounding boxes
-                # If not, make sure this one doesn't overlap with any in the list so far.
-                if(allow_overlapping_bounding_boxes or
-                   not any([self._fingerprints[ind].cutout.bounding_box.overlap(self._fingerprints[ii].cutout.bounding_box) for ii in inds])):
-                    inds.append(ind)
-                    if len(inds) == n:
-                        break
+        # Find the fingerprints closest to the Main fingerprint for this point in the image.
+        selected = self._select_similar(self._neighbor_index, row, n, allow_overlapping_bounding_boxes)
 
-        log.debug('Closest indexes are {}'.format(inds[:n]))
-        log.debug('Size of the fingerprint list {}'.format(len(self._fingerprints)))
+        log.debug('Closest indexes are {}'.format(selected))
 
         return [{
                     'tsne_point': self._fingerprint_adjacency[ind],
-                    'distance': distances[ind],
+                    'distance': distance,
                     'fingerprint': self._fingerprints[ind]
-                } for ind in inds[:n]]
+                } for ind, distance in selected]
 
     def cutout_point(self, cutout):
         """
@@ -1035,26 +1395,37 @@ class Jaccard(Similarity):
     #  Utility Methods
     #
 
-    def save(self):
+    def save(self, normalized=False):
         log.info('Returning the dictionary of information')
         return {
             'uuid': self._uuid,
             'similarity_type': self._similarity_type,
-            'similarity': self._fingerprint_adjacency.tolist(),
-            'fingerprint': [fp.save() for fp in self._fingerprints],
-            'parameters': {
-            }
+            'similarity': _save_matrix(self._fingerprint_adjacency),
+            **_save_fingerprints(self._fingerprints, normalized),
+            'parameters': self._save_parameters()
+        }
+
+    def _save_parameters(self):
+        return {
+            'n_predictions': self._n_predictions,
+            'top_k': self._top_k
         }
 
-    def load(self, thedict, db=None):
+    def load(self, thedict, db=None, lazy=False):
         log.info('Loading the dictionary of information')
         self._uuid = thedict['uuid']
         self._similarity_type = thedict['similarity_type']
-        self._fingerprint_adjacency = np.array(thedict['similarity'])
-        self._fingerprints = [Fingerprint.factory(x) for x in thedict['fingerprint']]
+        self._fingerprint_adjacency = _load_matrix(thedict['similarity'])
+        self._fingerprints = _load_fingerprints(thedict, lazy)
         self._parameters = thedict['parameters']
+        self._n_predictions = self._parameters.get('n_predictions', self._n_predictions)
+        self._top_k = self._parameters.get('top_k')
 
-        self._fingerprint_filter_inds = list(range(len(self._fingerprints)))
+        self._reset_filter()
+
+        self._neighbor_index = None
+        if not lazy:
+            self._build_neighbor_index()
 
 
 class Distance(Similarity):
@@ -1064,7 +1435,8 @@ class Distance(Similarity):
 
     _similarity_type = 'distance'
 
-    def __init__(self, metric='euclidean', *args, **kwargs):
+    def __init__(self, metric='euclidean', feature='predictions', block_size=None, n_jobs=1,
+                 top_k=None, filename=None, neighbor_index='auto', *args, **kwargs):
 
         super(Distance, self).__init__(Distance._similarity_type, *args, **kwargs)
 
@@ -1073,6 +1445,8 @@ class Distance(Similarity):
         # Each line / element in these should correpsond
         self._filename_index = []
         self._fingerprint_adjacency = None
+        self._X = None
+        self._neighbor_index = None
         self._predictions = []
 
         if not isinstance(metric, (str)):
@@ -1080,13 +1454,33 @@ class Distance(Similarity):
 
         self._metric = metric
 
+        if feature not in self._features:
+            raise ValueError('Feature {} not one of {}'.format(feature, self._features))
+        self._feature = feature
+
+        # Large sets of fingerprints are calculated in blocks of rows (see blocked_distances),
+        # optionally keeping only the top_k nearest or writing to a memory-mapped file.
+        self._block_size = block_size
+        self._n_jobs = n_jobs
+        self._top_k = top_k
+        self._filename = filename
+
+        # Index used by find_similar: 'adjacency' reads the adjacency rows, 'auto' the
+        # adjacency rows unless only the top_k are kept, otherwise the method passed to
+        # create_index() ('kdtree', 'balltree', 'brute' or 'hnsw').
+        self._neighbor_method = neighbor_index
+
     @property
     def data(self):
         return self._fingerprint_adjacency
 
     @property
     def data_filtered(self):
-        return self._fingerprint_adjacency[:, self._fingerprint_filter_inds][self._fingerprint_filter_inds, :]
+        data = self._fingerprint_adjacency
+        inds = self._filtered_inds()
+        if inds is not None:
+            data = data[:, inds][inds, :]
+        return _dense_distances(data)
 
     @classmethod
     def is_similarity_for(cls, similarity_type):
@@ -1106,28 +1500,48 @@ class Distance(Similarity):
         # Store as we need it for the find_nearest...
         self._fingerprints = fingerprints
 
-        # Calculate the unique labels
-        labels = []
-        values = {}
-        for ii, fp in enumerate(fingerprints):
-            # Add to unique label list
-            labels.extend([pred[1] for pred in fp.predictions if pred[1] not in labels])
+        self._X = FingerprintMatrix(fingerprints, feature=self._feature).matrix
 
-            # Store the predictions for next processing
-            values[ii] = fp.predictions
-
-        unique_labels = list(set(labels))
-        log.debug('Unique labels {}'.format(unique_labels))
+        if self._block_size is None and self._top_k is None and self._filename is None:
+            self._fingerprint_adjacency = squareform(pdist(self._X, metric=self._metric))
+        else:
+            self._fingerprint_adjacency = blocked_distances(self._X, metric=self._metric,
+                                                            block_size=self._block_size or 1024,
+                                                            n_jobs=self._n_jobs, top_k=self._top_k,
+                                                            filename=self._filename)
 
-        self._X = np.zeros((len(fingerprints), len(unique_labels)))
-        for ii, fp in enumerate(fingerprints):
-            inds = [unique_labels.index(prediction[1]) for prediction in values[ii]]
-            self._X[ii][inds] = [prediction[2] for prediction in values[ii]]
+        self._reset_filter()
+        self._build_neighbor_index()
 
-        self._fingerprint_adjacency = squareform(pdist(self._X, metric=self._metric))
+    def _build_neighbor_index(self):
+        """
+        Build the index over the fingerprint vectors used by find_similar. The
+        adjacency rows are used if the metric is not supported by the index, or
+        for 'auto' if the full (not top_k) adjacency is available, as selecting
+        from a row is faster than a tree search over many dimensions, or if the
+        fingerprints were loaded lazily, as the vectors would load all of them.
+        """
+        full_adjacency = self._fingerprint_adjacency is not None and not issparse(self._fingerprint_adjacency)
+        lazy = isinstance(self._fingerprints, LazyFingerprints) and self._X is None
+        if self._neighbor_method == 'auto' and (full_adjacency or lazy):
+            self._X = None
+            self._neighbor_index = AdjacencyIndex(self._fingerprint_adjacency)
+            return
+
+        if self._neighbor_method != 'adjacency':
+            try:
+                if self._X is None:
+                    self._X = FingerprintMatrix(self._fingerprints, feature=self._feature).matrix
+                self._neighbor_index = create_index(self._X, metric=self._metric, method=self._neighbor_method)
+                return
+            except ValueError as e:
+                log.warning('Using the adjacency for find_similar: {}'.format(e))
+
+        self._X = None
+        self._neighbor_index = AdjacencyIndex(self._fingerprint_adjacency)
 
     def get_similarity(self):
-        return Similarity('distance', self._fingerprint_adjacency.tolist(), [fp.uuid for fp in self._fingerprints])
+        return Similarity('distance', _save_matrix(self._fingerprint_adjacency), [fp.uuid for fp in self._fingerprints])
 
     def display(self, tsne_axis):
         """
@@ -1139,7 +1553,8 @@ class Distance(Similarity):
         :return:
         """
 
-        tsne_axis.imshow(self._fingerprint_adjacency, origin='upper')
+        # Non-neighbours of a top_k result are NaN, which imshow leaves blank.
+        tsne_axis.imshow(_dense_distances(self._fingerprint_adjacency), origin='upper')
         tsne_axis.grid('on')
         tsne_axis.set_title('Distance [{}]'.format(self._metric))
 
@@ -1164,8 +1579,8 @@ class Distance(Similarity):
         """
         log.info('')
 
-        if self._fingerprint_filter_inds is None:
-            self._fingerprint_filter_inds = list(range(len(self._fingerprints)))
+        if self._fingerprint_filter_mask is None:
+            self._set_filter_inds()
 
         row, col = int(point[0]), int(point[1])
 
@@ -1173,53 +1588,58 @@ class Distance(Similarity):
         # therefore we will need to map the point back to the full set.
         row = self._fingerprint_filter_inds[row]
 
-        # find the Main fingerprint for this point in the image
-        distances = self._fingerprint_adjacency[row]
-        log.debug('length of dsistances is {}'.format(len(distances)))
+        if self._neighbor_index is None:
+            self._build_neighbor_index()
 
-        inds = []
-        for ind in np.argsort(distances):
+        # Find the fingerprints closest to the Main fingerprint for this point in the image.
+        query = self._X[row] if self._X is not None else row
+        selected = self._select_similar(self._neighbor_index, query, n, allow_overlapping_bounding_boxes)
 
-            # First, make sure this index is one of the filtered ones.
-            if ind in self._fingerprint_filter_inds:
-
-                # Next check to see if we allow overlapping bounding boxes
-                # If not, make sure this one doesn't overlap with any in the list so far.
-                if(allow_overlapping_bounding_boxes or
-                   not any([self._fingerprints[ind].cutout.bounding_box.overlap(self._fingerprints[ii].cutout.bounding_box) for ii in inds])):
-                    inds.append(ind)
-                    if len(inds) == n:
-                        break
+        log.debug('Closest indexes are {}'.format(selected))
 
         return [{
                     'tsne_point': self._fingerprint_adjacency[ind],
-                    'distance': distances[ind],
+                    'distance': distance,
                     'fingerprint': self._fingerprints[ind]
-                } for ind in inds[:n]]
+                } for ind, distance in selected]
 
     #
     #  Utility Methods
     #
 
-    def save(self):
+    def save(self, normalized=False):
         log.info('Returning the dictionary of information')
         return {
             'uuid': self._uuid,
             'similarity_type': self._similarity_type,
-            'similarity': self._fingerprint_adjacency.tolist(),
-            'fingerprint': [fp.save() for fp in self._fingerprints],
-            'parameters': {
-                'metric': self._metric
-            }
+            'similarity': _save_matrix(self._fingerprint_adjacency),
+            **_save_fingerprints(self._fingerprints, normalized),
+            'parameters': self._save_parameters()
         }
 
-    def load(self, thedict, db=None):
+    def _save_parameters(self):
+        return {
+            'metric': self._metric,
+            'feature': self._feature,
+            'top_k': self._top_k,
+            'neighbor_index': self._neighbor_method
+        }
+
+    def load(self, thedict, db=None, lazy=False):
         log.info('Loading the dictionary of information')
         self._uuid = thedict['uuid']
         self._similarity_type = thedict['similarity_type']
-        self._fingerprint_adjacency = np.array(thedict['similarity'])
-        self._fingerprints = [Fingerprint.factory(x) for x in thedict['fingerprint']]
+        self._fingerprint_adjacency = _load_matrix(thedict['similarity'])
+        self._fingerprints = _load_fingerprints(thedict, lazy)
         self._parameters = thedict['parameters']
         self._metric = self._parameters['metric']
+        self._top_k = self._parameters.get('top_k')
+        self._neighbor_method = self._parameters.get('neighbor_index', 'auto')
+        self._feature = self._parameters.get('feature', 'predictions')
+
+        self._reset_filter()
 
-        self._fingerprint_filter_inds = list(range(len(self._fingerprints)))
+        self._X = None
+        self._neighbor_index = None
+        if not lazy:
+            self._build_neighbor_index()
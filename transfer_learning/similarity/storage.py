@@ -0,0 +1,108 @@
+import os
+import json
+
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+from transfer_learning.fingerprint.storage import save_fingerprints, load_fingerprints
+
+from .similarity import Similarity
+
+from ..tl_logging import get_logger
+log = get_logger('similarity storage')
+
+
+#
+# Binary layout of a similarity in a directory, so the matrix can be
+# memory-mapped rather than converted to and from nested lists:
+#
+#   manifest.json               uuid, similarity_type, parameters, matrix format
+#   similarity.npy              dense matrix (tSNE points or N x N adjacency)
+#   similarity_data.npy         \
+#   similarity_indices.npy       | or the CSR arrays of a sparse (top_k) adjacency
+#   similarity_indptr.npy       /
+#   fingerprints/               see fingerprint.storage.save_fingerprints()
+#
+
+FORMAT_VERSION = 1
+
+
+def save_similarity(similarity, path):
+    """
+    Save the similarity and its fingerprints to the directory.
+
+    Parameters
+    ----------
+    similarity : Similarity
+        A calculated similarity (tSNE, Jaccard, Distance).
+    path : str
+        Directory, created if it does not exist.
+    """
+    log.info('Saving {} to {}'.format(similarity, path))
+
+    os.makedirs(path, exist_ok=True)
+
+    matrix = similarity.data
+    if issparse(matrix):
+        matrix = csr_matrix(matrix)
+        np.save(os.path.join(path, 'similarity_data.npy'), matrix.data)
+        np.save(os.path.join(path, 'similarity_indices.npy'), matrix.indices)
+        np.save(os.path.join(path, 'similarity_indptr.npy'), matrix.indptr)
+        matrix_format = {'format': 'csr', 'shape': list(matrix.shape)}
+    else:
+        np.save(os.path.join(path, 'similarity.npy'), np.asarray(matrix))
+        matrix_format = {'format': 'dense'}
+
+    save_fingerprints(similarity._fingerprints, os.path.join(path, 'fingerprints'))
+
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'uuid': similarity.uuid,
+        'similarity_type': similarity.similarity_type,
+        'parameters': similarity._save_parameters(),
+        'matrix': matrix_format
+    }
+
+    with open(os.path.join(path, 'manifest.json'), 'w') as fp:
+        json.dump(manifest, fp)
+
+
+def load_similarity(path, mmap_mode='r'):
+    """
+    Load a similarity saved with save_similarity().
+
+    Parameters
+    ----------
+    path : str
+        Directory the similarity was saved to.
+    mmap_mode : str or None
+        Memory-map mode for the matrix and embeddings, None to read them into memory.
+
+    Returns
+    -------
+    Similarity
+        The similarity (tSNE, Jaccard, Distance).
+    """
+    log.info('Loading similarity from {}'.format(path))
+
+    with open(os.path.join(path, 'manifest.json')) as fp:
+        manifest = json.load(fp)
+
+    if manifest['format_version'] > FORMAT_VERSION:
+        raise ValueError('Similarity format version {} is not supported'.format(manifest['format_version']))
+
+    if manifest['matrix']['format'] == 'csr':
+        matrix = csr_matrix((np.load(os.path.join(path, 'similarity_data.npy'), mmap_mode=mmap_mode),
+                             np.load(os.path.join(path, 'similarity_indices.npy'), mmap_mode=mmap_mode),
+                             np.load(os.path.join(path, 'similarity_indptr.npy'), mmap_mode=mmap_mode)),
+                            shape=tuple(manifest['matrix']['shape']))
+    else:
+        matrix = np.load(os.path.join(path, 'similarity.npy'), mmap_mode=mmap_mode)
+
+    return Similarity.factory({
+        'uuid': manifest['uuid'],
+        'similarity_type': manifest['similarity_type'],
+        'similarity': matrix,
+        'fingerprint': load_fingerprints(os.path.join(path, 'fingerprints'), mmap_mode=mmap_mode),
+        'parameters': manifest['parameters']
+    })